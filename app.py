@@ -2,21 +2,19 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-from scipy.spatial.distance import jensenshannon
 from datetime import datetime, date, timedelta
 import re
 import hashlib
 import time
 import uuid
 import itertools
-import bcrypt
+import json
+import sqlite3
+import threading
 import base64
-import gspread
-from google.oauth2.service_account import Credentials
-import plotly.graph_objects as go
-import plotly.express as px
 import pytz
-from collections import Counter
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict
 
 # --- A. 定数と基本設定 ---
 st.set_page_config(layout="wide", page_title="Harmony Navigator", page_icon="🧭")
@@ -41,6 +39,23 @@ LONG_ELEMENTS = {
 ALL_ELEMENT_COLS = sorted([f's_element_{e}' for d in LONG_ELEMENTS.values() for e in d])
 Q_COLS = ['q_' + d for d in DOMAINS]
 S_COLS = ['s_' + d for d in DOMAINS]
+# 詳細項目 -> ドメインの所属行列（ALL_ELEMENT_COLS × DOMAINS の 0/1 行列。各行に 1 が1つだけ立つ）
+_ELEMENT_DOMAIN = {f's_element_{e}': d for d, elements in LONG_ELEMENTS.items() for e in elements}
+ELEMENT_DOMAIN_MATRIX = np.array([[1.0 if _ELEMENT_DOMAIN[col] == d else 0.0 for d in DOMAINS] for col in ALL_ELEMENT_COLS])
+# 記録ごとに保存する派生指標と、その計算に使った alpha・計算式のバージョン・入力の digest
+# （計算式を変更したら METRICS_VERSION を上げると、保存済みの指標は次の読み込み時に再計算される。
+#   q や s がシート上で直接編集された行も、入力の digest が一致しなくなるため再計算される）
+METRIC_COLS = ['S', 'U', 'H']
+METRICS_META_COLS = ['metrics_alpha', 'metrics_version', 'metrics_input_digest']
+# 派生指標の計算に使う入力列と、入力の digest での列ごとの重み（列名から決まる 40 ビットの奇数）
+METRICS_INPUT_COLS = Q_COLS + S_COLS + ['mode']
+METRICS_INPUT_WEIGHTS = np.array([int.from_bytes(hashlib.sha256(col.encode('utf-8')).digest()[:5], 'big') | 1
+                                  for col in METRICS_INPUT_COLS], dtype=np.float64)
+METRICS_VERSION = 1
+DEFAULT_ALPHA = 0.6
+# RHI のリスク許容度スライダーの範囲（最小値, 最大値, 刻み）と、その刻みでの格子点
+RHI_PARAM_RANGES = {'lambda': (0.0, 2.0, 0.1), 'gamma': (0.0, 2.0, 0.1), 'tau': (0.0, 1.0, 0.05)}
+RHI_PARAM_GRIDS = {name: np.round(np.arange(lo, hi + step / 2, step), 2) for name, (lo, hi, step) in RHI_PARAM_RANGES.items()}
 
 CAPTION_TEXT = "0: 全く当てはまらない | 25: あまり当てはまらない | 50: どちらとも言えない| 75: やや当てはまる | 100: 完全に当てはまる"
 
@@ -162,14 +177,18 @@ DEMOGRAPHIC_OPTIONS = {
     'country': ['未選択', '日本', 'アメリカ合衆国', 'その他']
 }
 # ゲーミフィケーション機能：アチーブメント定義
+# 実績の定義。event の発生時に、そのイベントの context（_achievement_context などで作る dict）で condition を判定する
+# - record_saved: 記録の保存時（context: record_count, streak, has_deep, has_balanced_day）
+# - rhi_evaluated: ダッシュボードで RHI を計算した時（context: rhi）
 ACHIEVEMENTS = {
-    'record_1': {'name': '最初の航海日誌', 'description': '最初の記録をつけました。', 'emoji': '🎉', 'condition': lambda df: len(df) >= 1},
-    'record_7': {'name': '航海士の習慣', 'description': '7日間、連続で記録をつけました。', 'emoji': '🗓️', 'condition': lambda df, streak: streak >= 7},
-    'record_30': {'name': '熟練の航海士', 'description': '30日間、連続で記録をつけました。', 'emoji': '📅', 'condition': lambda df, streak: streak >= 30},
-    'deep_dive_1': {'name': '深海への探求者', 'description': '初めてディープ・ダイブモードで記録しました。', 'emoji': '🔬', 'condition': lambda df: 'deep' in df['mode'].values},
-    'q_updated': {'name': '羅針盤の調整', 'description': '価値観（q_t）を更新しました。', 'emoji': '🧭', 'condition': lambda df: len(df.dropna(subset=Q_COLS, how='all')) > 1},
-    'rhi_plus': {'name': '順風満帆', 'description': '初めてRHIがプラスになりました。', 'emoji': '⛵', 'condition': lambda df, rhi_results: rhi_results and rhi_results.get('RHI', 0) > 0},
-    'balance_master': {'name': '調和の達人', 'description': '全てのドメインの充足度が70点以上になった日がありました。', 'emoji': '⚖️', 'condition': lambda df: (df[S_COLS] >= 70).all(axis=1).any()}
+    'record_1': {'name': '最初の航海日誌', 'description': '最初の記録をつけました。', 'emoji': '🎉', 'event': 'record_saved', 'condition': lambda ctx: ctx['record_count'] >= 1},
+    'record_7': {'name': '航海士の習慣', 'description': '7日間、連続で記録をつけました。', 'emoji': '🗓️', 'event': 'record_saved', 'condition': lambda ctx: ctx['streak'] >= 7},
+    'record_30': {'name': '熟練の航海士', 'description': '30日間、連続で記録をつけました。', 'emoji': '📅', 'event': 'record_saved', 'condition': lambda ctx: ctx['streak'] >= 30},
+    'deep_dive_1': {'name': '深海への探求者', 'description': '初めてディープ・ダイブモードで記録しました。', 'emoji': '🔬', 'event': 'record_saved', 'condition': lambda ctx: ctx['has_deep']},
+    # 記録には毎回その時点の価値観（q_t）も保存されるため、2件目以降の記録で価値観を更新したことになる
+    'q_updated': {'name': '羅針盤の調整', 'description': '価値観（q_t）を更新しました。', 'emoji': '🧭', 'event': 'record_saved', 'condition': lambda ctx: ctx['record_count'] > 1},
+    'rhi_plus': {'name': '順風満帆', 'description': '初めてRHIがプラスになりました。', 'emoji': '⛵', 'event': 'rhi_evaluated', 'condition': lambda ctx: ctx['rhi'] > 0},
+    'balance_master': {'name': '調和の達人', 'description': '全てのドメインの充足度が70点以上になった日がありました。', 'emoji': '⚖️', 'event': 'record_saved', 'condition': lambda ctx: ctx['has_balanced_day']}
 }
 # レベル2介入提案機能：介入レシピ定義
 INTERVENTION_RECIPES = {
@@ -217,13 +236,22 @@ INTERVENTION_RECIPES = {
 }
 
 # --- B. 暗号化エンジン ---
+# 復号した日誌をセッション内で保持するメモリの上限（バイト。平文の UTF-8 での大きさで数える）
+DECRYPTED_LOG_CACHE_MAX_BYTES = 8 * 1024 * 1024
+
 class EncryptionManager:
     def __init__(self, password: str):
         self.password_bytes = password.encode('utf-8')
         self.key = hashlib.sha256(self.password_bytes).digest()
+        # 暗号文のハッシュ -> 平文 の LRU キャッシュ（セッションごとに1つ。ログアウト時に wipe_cache で消去する）
+        self._decrypted_cache = OrderedDict()
+        self._decrypted_cache_bytes = 0
+        # 鍵を繰り返した鍵ストリーム（必要な長さまで伸ばして使い回す）
+        self._key_buffer = self.key
 
     @staticmethod
     def hash_password(password: str) -> str:
+        import bcrypt
         password_bytes = password.encode('utf-8')
         salt = bcrypt.gensalt()
         hashed_bytes = bcrypt.hashpw(password_bytes, salt)
@@ -231,6 +259,7 @@ class EncryptionManager:
 
     @staticmethod
     def check_password(password: str, hashed_password: str) -> bool:
+        import bcrypt
         password_bytes = password.encode('utf-8')
         hashed_bytes = hashed_password.encode('utf-8')
         try:
@@ -238,81 +267,193 @@ class EncryptionManager:
         except (ValueError, TypeError):
             return False
 
+    def _xor_with_key(self, chunks: list) -> list:
+        """
+        各バイト列を、先頭から鍵を繰り返した鍵ストリームと XOR する。
+        全てのバイト列と鍵ストリームをそれぞれ1つに連結し、NumPy の1回の演算でまとめて処理する。
+        """
+        total_length = sum(len(chunk) for chunk in chunks)
+        if total_length == 0:
+            return [b''] * len(chunks)
+        longest = max(len(chunk) for chunk in chunks)
+        if len(self._key_buffer) < longest:
+            self._key_buffer = self.key * (longest // len(self.key) + 1)
+        data = np.frombuffer(b''.join(chunks), dtype=np.uint8)
+        keystream = np.frombuffer(b''.join(self._key_buffer[:len(chunk)] for chunk in chunks), dtype=np.uint8)
+        xored = np.bitwise_xor(data, keystream).tobytes()
+        results, offset = [], 0
+        for chunk in chunks:
+            results.append(xored[offset:offset + len(chunk)])
+            offset += len(chunk)
+        return results
+
+    def encrypt_logs(self, log_texts: list) -> list:
+        """複数の日誌をまとめて暗号化する（encrypt_log を1件ずつ呼んだ場合と同じ結果）"""
+        indices = [i for i, text in enumerate(log_texts) if text]
+        encrypted = [""] * len(log_texts)
+        for i, encrypted_bytes in zip(indices, self._xor_with_key([log_texts[i].encode('utf-8') for i in indices])):
+            encrypted[i] = base64.b64encode(encrypted_bytes).decode('utf-8')
+        return encrypted
+
+    def decrypt_logs(self, encrypted_logs: list) -> list:
+        """
+        複数の日誌をまとめて復号する（decrypt_log を1件ずつ呼んだ場合と同じ結果）。
+        セッション内で復号済みの日誌はキャッシュから返し、残りだけを一度に復号する。
+        """
+        decrypted = [""] * len(encrypted_logs)
+        pending = []
+        for i, encrypted_log in enumerate(encrypted_logs):
+            if not encrypted_log or pd.isna(encrypted_log):
+                continue
+            cache_key = hashlib.sha256(encrypted_log.encode('utf-8')).digest()
+            cached = self._decrypted_cache.get(cache_key)
+            if cached is not None:
+                self._decrypted_cache.move_to_end(cache_key)
+                decrypted[i] = cached[0]
+                continue
+            try:
+                pending.append((i, cache_key, base64.b64decode(encrypted_log.encode('utf-8'))))
+            except Exception:
+                decrypted[i] = "[復号に失敗しました]"
+        for (i, cache_key, _), decrypted_bytes in zip(pending, self._xor_with_key([chunk for _, _, chunk in pending])):
+            try:
+                decrypted[i] = decrypted_bytes.decode('utf-8')
+            except UnicodeDecodeError:
+                decrypted[i] = "[復号に失敗しました]"
+                continue
+            self._remember_decrypted(cache_key, decrypted[i], len(decrypted_bytes))
+        return decrypted
+
     def encrypt_log(self, log_text: str) -> str:
-        if not log_text:
-            return ""
-        encrypted_bytes = bytes([b ^ self.key[i % len(self.key)] for i, b in enumerate(log_text.encode('utf-8'))])
-        return base64.b64encode(encrypted_bytes).decode('utf-8')
+        return self.encrypt_logs([log_text])[0]
 
     def decrypt_log(self, encrypted_log: str) -> str:
-        if not encrypted_log or pd.isna(encrypted_log):
-            return ""
-        try:
-            encrypted_bytes = base64.b64decode(encrypted_log.encode('utf-8'))
-            decrypted_bytes = bytes([b ^ self.key[i % len(self.key)] for i, b in enumerate(encrypted_bytes)])
-            return decrypted_bytes.decode('utf-8')
-        except Exception:
-            return "[復号に失敗しました]"
+        return self.decrypt_logs([encrypted_log])[0]
+
+    def _remember_decrypted(self, cache_key: bytes, decrypted_log: str, size: int) -> None:
+        if size > DECRYPTED_LOG_CACHE_MAX_BYTES:
+            return
+        self._decrypted_cache[cache_key] = (decrypted_log, size)
+        self._decrypted_cache_bytes += size
+        while self._decrypted_cache_bytes > DECRYPTED_LOG_CACHE_MAX_BYTES:
+            _, (_, evicted_size) = self._decrypted_cache.popitem(last=False)
+            self._decrypted_cache_bytes -= evicted_size
+
+    def wipe_cache(self) -> None:
+        """復号済みの平文をメモリから消去する"""
+        self._decrypted_cache.clear()
+        self._decrypted_cache_bytes = 0
 
 # --- C. コア計算 & ユーティリティ関数 ---
-def calculate_s_domains_from_row(row: pd.Series) -> pd.Series:
-    s_domain_scores = {}
-    
-    for domain, elements in LONG_ELEMENTS.items():
-        domain_scores_list = []
-        for e in elements:
-            col = f's_element_{e}'
-            if col in row and pd.notna(row[col]):
-                domain_scores_list.append(row[col])
-        
-        if domain_scores_list:
-            s_domain_scores['s_' + domain] = int(round(np.mean(domain_scores_list)))
-        else:
-            s_domain_scores['s_' + domain] = row.get('s_' + domain, np.nan)
-            
-    return pd.Series(s_domain_scores)
+def calculate_s_domains(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    詳細項目のスコアをドメインごとに平均し（欠損値は除外して四捨五入）、S_COLS のテーブルを返す。
+    新しい1件の記録でも履歴全体でも、ELEMENT_DOMAIN_MATRIX との1回の行列積で計算する。
+    詳細項目が1つも無いドメインは、既存の s_ の値（無ければ NaN）をそのまま使う。
+    """
+    element_values = df.reindex(columns=ALL_ELEMENT_COLS).astype('Float64').to_numpy(dtype=np.float64, na_value=np.nan)
+    present = ~np.isnan(element_values)
+    sums = np.where(present, element_values, 0.0) @ ELEMENT_DOMAIN_MATRIX
+    counts = present.astype(np.float64) @ ELEMENT_DOMAIN_MATRIX
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.round(sums / counts)
+    fallback = df.reindex(columns=S_COLS).astype('Float64').to_numpy(dtype=np.float64, na_value=np.nan)
+    return pd.DataFrame(np.where(counts > 0, means, fallback), columns=S_COLS, index=df.index)
+
+def _calculate_unity_batch(q_values: np.ndarray, s_values: np.ndarray) -> np.ndarray:
+    """
+    価値観 q と経験 s の分布の一致度 U = 1 - JSD（自然対数）を全行まとめて計算する。
+    どちらかの合計が 0 の行は 0 とする。
+    """
+    q_sum = q_values.sum(axis=1, keepdims=True)
+    s_sum = s_values.sum(axis=1, keepdims=True)
+    valid = (q_sum[:, 0] != 0) & (s_sum[:, 0] != 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        p = q_values / q_sum
+        q = s_values / s_sum
+        m = (p + q) / 2.0
+        left = np.where(p > 0, p * np.log(p / m), 0.0).sum(axis=1)
+        right = np.where(q > 0, q * np.log(q / m), 0.0).sum(axis=1)
+    jsd = (left + right) / 2.0
+    return np.where(valid, 1.0 - jsd, 0.0)
+
+def _metrics_inputs(df: pd.DataFrame) -> tuple:
+    """派生指標の計算に使う入力（q と s の行列、ディープ・ダイブの行か）。欠損値は NaN のまま返す"""
+    q_values = df.reindex(columns=Q_COLS).to_numpy(dtype=np.float64, na_value=np.nan)
+    s_values = df.reindex(columns=S_COLS).to_numpy(dtype=np.float64, na_value=np.nan, copy=True)
+    deep = (df['mode'] == 'deep').to_numpy(dtype=bool, na_value=False) if 'mode' in df.columns else np.zeros(len(df), dtype=bool)
+    return q_values, s_values, deep
+
+def _metrics_input_digest(q_values: np.ndarray, s_values: np.ndarray, deep: np.ndarray) -> np.ndarray:
+    """
+    記録ごとの、派生指標の計算に使う入力（q, s と記録モード）の digest（2^32 未満の整数）。
+    各列の値（欠損値は -1）と METRICS_INPUT_WEIGHTS の積和を 2^32 で割った余りで、積和は float64 で誤差なく表せる範囲に収まるため、
+    行列積でまとめて計算しても、書き込み時と読み込み時（スプレッドシートの数値のセルを経由しても）で同じ値になる。
+    """
+    n = len(DOMAINS)
+    digest = (np.where(np.isnan(q_values), -1.0, q_values) @ METRICS_INPUT_WEIGHTS[:n]
+              + np.where(np.isnan(s_values), -1.0, s_values) @ METRICS_INPUT_WEIGHTS[n:2 * n]
+              + deep * METRICS_INPUT_WEIGHTS[2 * n])
+    return np.mod(digest, 2.0 ** 32)
 
-@st.cache_data
-def calculate_metrics(df: pd.DataFrame, alpha: float = 0.6) -> pd.DataFrame:
+def _stale_metrics_mask(df: pd.DataFrame, input_digest: np.ndarray = None) -> np.ndarray:
+    """
+    保存済みの派生指標が無い、古い計算式のバージョンで計算された、または計算後に入力が変わった行を True とする。
+    input_digest を省略した場合は df から計算する。
+    """
+    if any(col not in df.columns for col in METRIC_COLS + METRICS_META_COLS):
+        return np.ones(len(df), dtype=bool)
+    if input_digest is None:
+        input_digest = _metrics_input_digest(*_metrics_inputs(df))
+    stored = df[METRIC_COLS].astype('Float64').to_numpy(dtype=np.float64, na_value=np.nan)
+    versions = df['metrics_version'].astype('Float64').to_numpy(dtype=np.float64, na_value=np.nan)
+    stored_digest = df['metrics_input_digest'].astype('Float64').to_numpy(dtype=np.float64, na_value=np.nan)
+    return np.isnan(stored).any(axis=1) | (versions != METRICS_VERSION) | (stored_digest != input_digest)
+
+def calculate_metrics(df: pd.DataFrame, alpha: float = DEFAULT_ALPHA, recompute_all: bool = False) -> pd.DataFrame:
+    """
+    各記録の S, U, H を返す。保存済みの指標がある行はそれを使い、新しい行と計算式のバージョンが古い行、保存後に入力が変わった行だけを計算する。
+    alpha が保存時と異なる行は、保存済みの S と U から H だけを計算し直す。
+    recompute_all=True の場合は、保存済みの指標を使わずに全ての行を計算する（書き込む行に指標を付けるときに使う）。
+    """
     df_copy = df.copy()
     if df_copy.empty:
         return df_copy
 
-    def get_s_domains_based_on_mode(row):
-        if row.get('mode') == 'deep':
-            return calculate_s_domains_from_row(row)
-        else:
-            return row[S_COLS]
-
-    s_domain_updates = df_copy.apply(get_s_domains_based_on_mode, axis=1)
-    df_copy[S_COLS] = s_domain_updates
-
-    for col in Q_COLS + S_COLS:
-         if col in df_copy.columns:
-            df_copy[col] = df_copy[col].fillna(0)
-    
-    s_vectors_normalized = df_copy[S_COLS].values / 100.0
-    q_vectors = df_copy[Q_COLS].values / 100.0
-    
-    df_copy['S'] = np.nansum(q_vectors * s_vectors_normalized, axis=1)
-    
-    def calculate_unity(row):
-        q_vec = row[Q_COLS].values.astype(float)
-        s_vec_raw = row[S_COLS].values.astype(float)
-        
-        if np.sum(q_vec) == 0: return 0.0
-        q_vec_norm = q_vec / np.sum(q_vec)
-        
-        if np.sum(s_vec_raw) == 0: return 0.0
-        s_tilde = s_vec_raw / np.sum(s_vec_raw)
-        
-        jsd_sqrt = jensenshannon(q_vec_norm, s_tilde)
-        jsd = float(jsd_sqrt) ** 2
-        return 1.0 - jsd
-
-    df_copy['U'] = df_copy.apply(calculate_unity, axis=1)
-    df_copy['H'] = alpha * df_copy['S'] + (1 - alpha) * df_copy['U']
-    
+    # 圧縮して保持しているスコア列（欠損値つき整数）を、計算用に float に戻す
+    score_cols = [c for c in NUMERIC_COLS if c in df_copy.columns]
+    object_cols = [c for c in score_cols if df_copy[c].dtype == object]
+    if object_cols:
+        df_copy[object_cols] = df_copy[object_cols].apply(pd.to_numeric, errors='coerce')
+    df_copy[score_cols] = df_copy[score_cols].astype(np.float64)
+
+    q_values, s_values, deep = _metrics_inputs(df_copy)
+    input_digest = _metrics_input_digest(q_values, s_values, deep)
+    stale = np.ones(len(df_copy), dtype=bool) if recompute_all else _stale_metrics_mask(df_copy, input_digest)
+
+    # 再計算する行のうち、ディープ・ダイブの行だけ、詳細項目からドメイン充足度を計算し直す
+    recompute_deep = stale & deep
+    if recompute_deep.any():
+        s_values[recompute_deep] = calculate_s_domains(df_copy.loc[recompute_deep]).to_numpy()
+
+    q_values = np.nan_to_num(q_values, nan=0.0)
+    s_values = np.nan_to_num(s_values, nan=0.0)
+    df_copy[Q_COLS] = q_values
+    df_copy[S_COLS] = s_values
+
+    metrics = df_copy.reindex(columns=METRIC_COLS).astype('Float64').to_numpy(dtype=np.float64, na_value=np.nan)
+    if stale.any():
+        q_stale, s_stale = q_values[stale], s_values[stale]
+        metrics[stale, 0] = np.sum((q_stale / 100.0) * (s_stale / 100.0), axis=1)
+        metrics[stale, 1] = _calculate_unity_batch(q_stale, s_stale)
+    stored_alpha = df_copy.reindex(columns=['metrics_alpha']).astype('Float64').to_numpy(dtype=np.float64, na_value=np.nan)[:, 0]
+    recompute_h = stale | (stored_alpha != alpha)
+    metrics[recompute_h, 2] = alpha * metrics[recompute_h, 0] + (1 - alpha) * metrics[recompute_h, 1]
+
+    df_copy[METRIC_COLS] = metrics
+    df_copy['metrics_alpha'] = alpha
+    df_copy['metrics_version'] = METRICS_VERSION
+    df_copy['metrics_input_digest'] = input_digest.astype(np.int64)
     return df_copy
 
 def calculate_ahp_weights(comparisons: dict, items: list) -> np.ndarray:
@@ -344,7 +485,154 @@ def calculate_ahp_weights(comparisons: dict, items: list) -> np.ndarray:
         
     return int_weights
 
-def analyze_discrepancy(df_processed: pd.DataFrame):
+# ズレの指数加重統計の重み（直近の記録ほど重く、おおよそ直近10件分を反映する）
+GAP_EW_ALPHA = 0.1
+
+def _gap_digest(record_date, gap: float) -> int:
+    return int.from_bytes(hashlib.sha256(f"{record_date}\n{float(gap)!r}".encode('utf-8')).digest()[:16], 'big')
+
+class GapStats:
+    """
+    実感と調和度のズレ（G − H×100）の逐次統計。
+    Welford 法の件数・平均・偏差平方和（M2）と、指数加重の平均・分散を保持し、記録の保存ごとに O(1) で更新する。
+    最新の記録の書き換えに対応するため、最後に追加したズレと、その直前の指数加重統計も保持する。
+    digest は統計に含めた (記録日, ズレ) ごとのハッシュの XOR で、最新より前の記録が編集された場合など、
+    保存した統計が現在の履歴と一致しているかの確認に使う。
+    """
+    def __init__(self, alpha: float = DEFAULT_ALPHA, metrics_version: int = METRICS_VERSION):
+        self.alpha = alpha
+        self.metrics_version = metrics_version
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.ew_mean = 0.0
+        self.ew_var = 0.0
+        self.prev_ew = (0.0, 0.0)
+        self.last_date = None
+        self.last_gap = None
+        self.digest = 0
+
+    @property
+    def std(self) -> float:
+        """標本標準偏差（pandas の std と同じ ddof=1。2件未満は NaN）"""
+        return float(np.sqrt(self.m2 / (self.count - 1))) if self.count > 1 else np.nan
+
+    @property
+    def ew_std(self) -> float:
+        return float(np.sqrt(self.ew_var))
+
+    def add(self, gap: float, record_date: date) -> None:
+        """最新の日付の記録のズレを追加する"""
+        self.prev_ew = (self.ew_mean, self.ew_var)
+        self.count += 1
+        delta = gap - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (gap - self.mean)
+        if self.count == 1:
+            self.ew_mean, self.ew_var = gap, 0.0
+        else:
+            ew_delta = gap - self.ew_mean
+            self.ew_mean += GAP_EW_ALPHA * ew_delta
+            self.ew_var = (1 - GAP_EW_ALPHA) * (self.ew_var + GAP_EW_ALPHA * ew_delta ** 2)
+        self.last_date, self.last_gap = record_date, gap
+        self.digest ^= _gap_digest(record_date, gap)
+
+    def replace_last(self, gap: float) -> None:
+        """最新の記録を書き換えた場合に、そのズレを差し替える"""
+        old_gap, record_date = self.last_gap, self.last_date
+        if self.count == 1:
+            self.count, self.mean, self.m2 = 0, 0.0, 0.0
+        else:
+            # Welford 法の逆操作で、古いズレを取り除く
+            old_mean = self.mean
+            self.mean = (self.count * old_mean - old_gap) / (self.count - 1)
+            self.m2 = max(self.m2 - (old_gap - old_mean) * (old_gap - self.mean), 0.0)
+            self.count -= 1
+        self.ew_mean, self.ew_var = self.prev_ew
+        self.digest ^= _gap_digest(record_date, old_gap)
+        self.add(gap, record_date)
+
+    @staticmethod
+    def _history(df_analysis: pd.DataFrame) -> tuple:
+        gaps = (df_analysis['g_happiness'].astype(np.float64) - df_analysis['H'].astype(np.float64) * 100.0).to_numpy()
+        dates = pd.to_datetime(df_analysis['date']).dt.date.to_numpy() if 'date' in df_analysis.columns else [None] * len(gaps)
+        return gaps, dates
+
+    @classmethod
+    def from_history(cls, df_analysis: pd.DataFrame, alpha: float = DEFAULT_ALPHA) -> 'GapStats':
+        """日付順の履歴（H と g_happiness が揃った行）から作り直す"""
+        stats = cls(alpha=alpha)
+        for gap, record_date in zip(*cls._history(df_analysis)):
+            stats.add(float(gap), record_date)
+        return stats
+
+    @classmethod
+    def expected_digest(cls, df_analysis: pd.DataFrame) -> int:
+        digest = 0
+        for gap, record_date in zip(*cls._history(df_analysis)):
+            digest ^= _gap_digest(record_date, gap)
+        return digest
+
+    def to_json(self) -> str:
+        return json.dumps({
+            'alpha': self.alpha, 'metrics_version': self.metrics_version,
+            'count': self.count, 'mean': self.mean, 'm2': self.m2,
+            'ew_mean': self.ew_mean, 'ew_var': self.ew_var, 'prev_ew': list(self.prev_ew),
+            'last_date': self.last_date.isoformat() if self.last_date else None, 'last_gap': self.last_gap,
+            'digest': f"{self.digest:032x}",
+        })
+
+    @classmethod
+    def from_json(cls, text) -> 'GapStats':
+        """保存した文字列から復元する。空や壊れた値の場合は None を返す"""
+        try:
+            values = json.loads(text)
+            stats = cls(alpha=values['alpha'], metrics_version=values['metrics_version'])
+            stats.count, stats.mean, stats.m2 = int(values['count']), values['mean'], values['m2']
+            stats.ew_mean, stats.ew_var, stats.prev_ew = values['ew_mean'], values['ew_var'], tuple(values['prev_ew'])
+            stats.last_date = date.fromisoformat(values['last_date']) if values['last_date'] else None
+            stats.last_gap = values['last_gap']
+            stats.digest = int(values['digest'], 16)
+            return stats
+        except (TypeError, ValueError, KeyError):
+            return None
+
+def update_gap_stats_on_save(stats: GapStats, record_date: date, new_gap: float, replaced_gaps: list):
+    """
+    保存した記録の分だけ、ズレの統計を O(1) で更新する。
+    最新より前の日付の編集など、逐次更新できない場合は None（次回の表示時に履歴から作り直す）を返す。
+    """
+    if stats is None:
+        return None
+    if not replaced_gaps and (stats.last_date is None or record_date > stats.last_date):
+        stats.add(new_gap, record_date)
+        return stats
+    if len(replaced_gaps) == 1 and record_date == stats.last_date:
+        stats.replace_last(new_gap)
+        return stats
+    return None
+
+def get_gap_stats(users_sheet_id: str, user_id: str, df_processed: pd.DataFrame) -> GapStats:
+    """
+    ユーザーのズレの統計を返す。セッション内ではメモリ上の値を使い、初回だけ users テーブルに保存した値を読み込む。
+    保存した値が無い、履歴と一致しない（件数や digest が異なる）、または H の計算条件が異なる場合は、履歴から作り直して保存する。
+    """
+    stats = st.session_state.get('gap_stats')
+    if stats is not None:
+        return stats
+    df_analysis = df_processed.dropna(subset=['H', 'g_happiness'])
+    user_row = read_user_data('users', users_sheet_id, user_id)
+    user_row = user_row if 'gap_stats' in user_row.columns else pd.DataFrame()
+    if not user_row.empty:
+        stats = GapStats.from_json(user_row['gap_stats'].iloc[0])
+    if (stats is None or stats.count != len(df_analysis) or stats.digest != GapStats.expected_digest(df_analysis)
+            or stats.alpha != DEFAULT_ALPHA or stats.metrics_version != METRICS_VERSION):
+        stats = GapStats.from_history(df_analysis)
+        update_user_state(users_sheet_id, user_id, {'gap_stats': stats.to_json()})
+    st.session_state.gap_stats = stats
+    return stats
+
+def analyze_discrepancy(df_processed: pd.DataFrame, gap_stats: GapStats = None):
     df_analysis = df_processed.dropna(subset=['H', 'g_happiness']).copy()
     
     if df_analysis.empty:
@@ -381,8 +669,11 @@ def analyze_discrepancy(df_processed: pd.DataFrame):
                     素晴らしいスタートです！
                     """)
     else:
-        df_analysis['gap'] = df_analysis['g_happiness'] - (df_analysis['H'] * 100.0)
-        std_gap = df_analysis['gap'].std()
+        if gap_stats is not None and gap_stats.count > 1:
+            std_gap = gap_stats.std
+        else:
+            df_analysis['gap'] = df_analysis['g_happiness'] - (df_analysis['H'] * 100.0)
+            std_gap = df_analysis['gap'].std()
         dynamic_threshold = max(15, 1.0 * std_gap) 
 
         with st.expander("▼ これは、あなたの過去データに基づいた統計的診断です", expanded=True):
@@ -415,41 +706,173 @@ def calculate_rhi_metrics(df_period: pd.DataFrame, lambda_rhi: float, gamma_rhi:
     frac_below = (df_period['H'] < tau_rhi).mean()
     rhi = mean_H - (lambda_rhi * std_H) - (gamma_rhi * frac_below)
     return {'mean_H': mean_H, 'std_H': std_H, 'frac_below': frac_below, 'RHI': rhi}
-def generate_intervention_proposal(df_period: pd.DataFrame, rhi_results: dict):
+
+class RollingRHI:
+    """
+    日付順の H の系列（欠損値なし）から、任意の期間の RHI を計算するエンジン。
+    累積和を1回だけ作っておき、各期間の平均・標準偏差・閾値未満の割合を期間の長さによらず O(1) で求める。
+    閾値 τ ごとの累積カウントも初回だけ作って使い回すため、スライダーを動かしてもデータを走査し直さない。
+    """
+    def __init__(self, h_values):
+        self._h = np.asarray(h_values, dtype=np.float64)
+        self.n = len(self._h)
+        # 累積和の桁落ちを抑えるため、全体の平均を引いてから累積する
+        self._center = float(self._h.mean()) if self.n else 0.0
+        centered = self._h - self._center
+        self._cum_sum = np.concatenate([[0.0], np.cumsum(centered)])
+        self._cum_sq = np.concatenate([[0.0], np.cumsum(centered ** 2)])
+        self._cum_below = {}
+
+    def _below_counts(self, tau_rhi: float) -> np.ndarray:
+        counts = self._cum_below.get(tau_rhi)
+        if counts is None:
+            counts = np.concatenate([[0], np.cumsum(self._h < tau_rhi)])
+            self._cum_below[tau_rhi] = counts
+        return counts
+
+    def _window_stats(self, ends: np.ndarray, window: int, lambda_rhi: float, gamma_rhi: float, tau_rhi: float) -> dict:
+        """ends（系列の先頭から数えた期間の終端）ごとに、直近 window 件の指標を計算する"""
+        starts = np.maximum(ends - window, 0)
+        lengths = ends - starts
+        mean_centered = (self._cum_sum[ends] - self._cum_sum[starts]) / lengths
+        variance = (self._cum_sq[ends] - self._cum_sq[starts]) / lengths - mean_centered ** 2
+        std_H = np.sqrt(np.maximum(variance, 0.0))
+        below = self._below_counts(tau_rhi)
+        frac_below = (below[ends] - below[starts]) / lengths
+        mean_H = mean_centered + self._center
+        rhi = mean_H - (lambda_rhi * std_H) - (gamma_rhi * frac_below)
+        return {'mean_H': mean_H, 'std_H': std_H, 'frac_below': frac_below, 'RHI': rhi}
+
+    def summary(self, window: int, lambda_rhi: float, gamma_rhi: float, tau_rhi: float) -> dict:
+        """直近 window 件の指標（calculate_rhi_metrics に末尾 window 件を渡した場合と同じ値）"""
+        if self.n == 0:
+            return {'mean_H': 0, 'std_H': 0, 'frac_below': 0, 'RHI': 0}
+        stats = self._window_stats(np.array([self.n]), window, lambda_rhi, gamma_rhi, tau_rhi)
+        return {key: float(values[0]) for key, values in stats.items()}
+
+    def series(self, window: int, lambda_rhi: float, gamma_rhi: float, tau_rhi: float) -> pd.DataFrame:
+        """各記録を終端とする直近 window 件の指標の時系列（記録が window 件に満たない先頭部分は、それまでの全件で計算）"""
+        return pd.DataFrame(self._window_stats(np.arange(1, self.n + 1), window, lambda_rhi, gamma_rhi, tau_rhi))
+
+    def sweep(self, window: int, lambda_grid: np.ndarray, gamma_grid: np.ndarray, tau_grid: np.ndarray) -> 'RHISurface':
+        """直近 window 件の RHI を、λ・γ・τ の格子の全ての組み合わせについて一度に計算する"""
+        window_h = np.sort(self._h[max(self.n - window, 0):])
+        if len(window_h) == 0:
+            return RHISurface(lambda_grid, gamma_grid, tau_grid, 0.0, 0.0, np.zeros(len(tau_grid)))
+        # 並べ替えた H に対する二分探索で、全ての τ の「閾値未満の件数」をまとめて求める
+        frac_below = np.searchsorted(window_h, tau_grid, side='left') / len(window_h)
+        return RHISurface(lambda_grid, gamma_grid, tau_grid, float(window_h.mean()), float(window_h.std()), frac_below)
+
+class RHISurface:
+    """
+    RollingRHI.sweep の結果。λ × γ × τ の格子上の RHI を保持し、スライダーの値から計算せずに引けるようにする。
+    """
+    def __init__(self, lambda_grid, gamma_grid, tau_grid, mean_H: float, std_H: float, frac_below: np.ndarray):
+        self.lambda_grid = np.asarray(lambda_grid, dtype=np.float64)
+        self.gamma_grid = np.asarray(gamma_grid, dtype=np.float64)
+        self.tau_grid = np.asarray(tau_grid, dtype=np.float64)
+        self.mean_H = mean_H
+        self.std_H = std_H
+        self.frac_below = frac_below
+        self.rhi = (mean_H
+                    - self.lambda_grid[:, None, None] * std_H
+                    - self.gamma_grid[None, :, None] * frac_below[None, None, :])
+
+    @staticmethod
+    def _grid_index(grid: np.ndarray, value: float):
+        i = int(np.argmin(np.abs(grid - value)))
+        return i if abs(grid[i] - value) < 1e-9 else None
+
+    def lookup(self, lambda_rhi: float, gamma_rhi: float, tau_rhi: float):
+        """格子点上の値なら calculate_rhi_metrics と同じ形式の dict を、格子に無い値なら None を返す"""
+        i = self._grid_index(self.lambda_grid, lambda_rhi)
+        j = self._grid_index(self.gamma_grid, gamma_rhi)
+        k = self._grid_index(self.tau_grid, tau_rhi)
+        if i is None or j is None or k is None:
+            return None
+        return {'mean_H': self.mean_H, 'std_H': self.std_H, 'frac_below': float(self.frac_below[k]), 'RHI': float(self.rhi[i, j, k])}
+
+    def slice_at_tau(self, tau_rhi: float) -> pd.DataFrame:
+        """指定した τ での RHI の表（行: γ, 列: λ）"""
+        k = self._grid_index(self.tau_grid, tau_rhi)
+        if k is None:
+            k = int(np.argmin(np.abs(self.tau_grid - tau_rhi)))
+        return pd.DataFrame(self.rhi[:, :, k].T, index=self.gamma_grid, columns=self.lambda_grid)
+
+def get_rhi_engine(h_values, cache_key: tuple) -> RollingRHI:
+    """同じデータ（cache_key が同じ）の RollingRHI を、セッション内で再利用する"""
+    cached = st.session_state.get('rhi_engine')
+    if cached is None or cached[0] != cache_key:
+        cached = (cache_key, RollingRHI(h_values))
+        st.session_state.rhi_engine = cached
+    return cached[1]
+
+def _get_period_cache(name: str, cache_key: tuple) -> dict:
+    """分析期間ごとの計算結果を入れる、セッション内の辞書（データが変わったら空にする）"""
+    cached_key, period_cache = st.session_state.get(name, (None, {}))
+    if cached_key != cache_key:
+        period_cache = {}
+        st.session_state[name] = (cache_key, period_cache)
+    return period_cache
+
+def get_rhi_surface(engine: RollingRHI, window: int, cache_key: tuple) -> RHISurface:
+    """同じデータ・同じ分析期間の RHISurface を、セッション内で再利用する"""
+    surfaces = _get_period_cache('rhi_surfaces', cache_key)
+    if window not in surfaces:
+        surfaces[window] = engine.sweep(window, RHI_PARAM_GRIDS['lambda'], RHI_PARAM_GRIDS['gamma'], RHI_PARAM_GRIDS['tau'])
+    return surfaces[window]
+
+class DomainImpact:
+    """
+    期間の記録から、各ドメインを1つずつ除外した場合の S, U, H を7通りまとめて計算する反実仮想エンジン。
+    除外したドメインの q は 0 にし、残りのドメインで元の合計（通常は 100）になるように正規化し直す。
+    """
+    def __init__(self, df_period: pd.DataFrame, alpha: float = DEFAULT_ALPHA):
+        q_values = np.nan_to_num(df_period.reindex(columns=Q_COLS).to_numpy(dtype=np.float64, na_value=np.nan), nan=0.0)
+        s_values = np.nan_to_num(df_period.reindex(columns=S_COLS).to_numpy(dtype=np.float64, na_value=np.nan), nan=0.0)
+        self.n = len(df_period)
+        # 先頭は「何も除外しない」場合、続いて DOMAINS の順に1つずつ除外した場合（shape: 8 × ドメイン数）
+        keep = np.vstack([np.ones(len(DOMAINS)), 1.0 - np.eye(len(DOMAINS))])
+        q_kept = q_values[None, :, :] * keep[:, None, :]
+        s_kept = s_values[None, :, :] * keep[:, None, :]
+        q_sums = q_kept.sum(axis=2, keepdims=True)
+        q_totals = q_values.sum(axis=1, keepdims=True)[None, :, :]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            q_kept = np.where(q_sums > 0, q_kept * (q_totals / q_sums), 0.0)
+        S = np.sum((q_kept / 100.0) * (s_kept / 100.0), axis=2)
+        U = _calculate_unity_batch(q_kept.reshape(-1, len(DOMAINS)), s_kept.reshape(-1, len(DOMAINS))).reshape(S.shape)
+        self.h_values = alpha * S + (1 - alpha) * U
+
+    def rhi_deltas(self, lambda_rhi: float, gamma_rhi: float, tau_rhi: float) -> pd.Series:
+        """各ドメインを除外した場合の RHI から、除外しない場合の RHI を引いた値（大きいほど、そのドメインが RHI を下げている）"""
+        mean_H = self.h_values.mean(axis=1)
+        std_H = self.h_values.std(axis=1)
+        frac_below = (self.h_values < tau_rhi).mean(axis=1)
+        rhi = mean_H - (lambda_rhi * std_H) - (gamma_rhi * frac_below)
+        return pd.Series(rhi[1:] - rhi[0], index=DOMAINS).sort_values(ascending=False)
+
+def get_domain_impact(df_period: pd.DataFrame, window: int, alpha: float, cache_key: tuple) -> DomainImpact:
+    """同じデータ・同じ分析期間・同じ alpha の DomainImpact を、セッション内で再利用する"""
+    impacts = _get_period_cache('domain_impacts', (cache_key, alpha))
+    if window not in impacts:
+        impacts[window] = DomainImpact(df_period, alpha=alpha)
+    return impacts[window]
+
+def generate_intervention_proposal(domain_impact: DomainImpact, lambda_rhi: float, gamma_rhi: float, tau_rhi: float):
     """
     分析結果に基づき、パーソナライズされた介入提案を生成する。
-    RHIへの悪影響が最も大きいドメインを特定し、レシピを提案する。
+    除外するとRHIが最も改善する（RHIへの悪影響が最も大きい）ドメインを特定し、レシピを提案する。
     """
-    if df_period.empty or not rhi_results:
+    if domain_impact is None or domain_impact.n == 0:
         return None, None
 
-    # RHIへの各要素の寄与度（悪影響度）を計算
-    mean_h = rhi_results.get('mean_H', 0)
-    std_h = rhi_results.get('std_H', 0)
-    
-    # 各ドメインを一つずつ除外した場合のRHIの変化をシミュレーション
-    impacts = {}
-    for domain_to_exclude in DOMAINS:
-        temp_s_cols = [s for s in S_COLS if 's_' + domain_to_exclude not in s]
-        
-        # 悪影響を計算するため、単純化して標準偏差への寄与を測る
-        # あるドメインの変動が全体の変動にどれだけ寄与したか
-        domain_std = df_period['s_' + domain_to_exclude].std()
-        
-        # ズレ（U）への影響も考慮する
-        q_val = df_period['q_' + domain_to_exclude].mean()
-        s_val = df_period['s_' + domain_to_exclude].mean()
-        gap_contribution = q_val * (1 - (s_val / 100.0)) # 価値が高いのに満たされていない度合い
-        
-        # 影響度をスコアリング（標準偏差と価値-充足ギャップを重視）
-        impact_score = (domain_std / 100.0) * 0.7 + gap_contribution * 0.3
-        impacts[domain_to_exclude] = impact_score
-
-    if not impacts:
+    impacts = domain_impact.rhi_deltas(lambda_rhi, gamma_rhi, tau_rhi)
+    # どのドメインを除外しても RHI が改善しない場合は、提案しない
+    if impacts.iloc[0] <= 0:
         return None, None
 
     # 最も悪影響が大きいドメインを特定
-    focus_domain = max(impacts, key=impacts.get)
+    focus_domain = impacts.index[0]
     
     # そのドメインに対応する介入レシピをランダムに2つ提案
     recipes = INTERVENTION_RECIPES.get(focus_domain, [])
@@ -463,6 +886,8 @@ def generate_intervention_proposal(df_period: pd.DataFrame, rhi_results: dict):
 # --- D. データ永続化層 ---
 @st.cache_resource(ttl=3600)
 def get_gspread_client():
+    import gspread
+    from google.oauth2.service_account import Credentials
     try:
         scopes = [
             "https://www.googleapis.com/auth/spreadsheets",
@@ -474,219 +899,1273 @@ def get_gspread_client():
         st.error("Google Sheetsへの認証に失敗しました。Secretsの設定とGCPのAPI設定を確認してください。")
         return None
 
-@st.cache_data(ttl=60)
-def read_data(sheet_name: str, spreadsheet_id: str) -> pd.DataFrame:
-    gc = get_gspread_client()
-    if gc is None: return pd.DataFrame()
-    try:
-        sh = gc.open_by_key(spreadsheet_id)
-        worksheet = sh.worksheet(sheet_name)
-        df = pd.DataFrame(worksheet.get_all_records())
+class StorageError(Exception):
+    """ストレージバックエンドの操作に失敗したことを示す"""
+
+class StorageUnavailableError(StorageError):
+    """バックエンドへの接続（クライアント）が初期化されていないことを示す"""
+
+class TableNotFoundError(StorageError):
+    """指定したテーブル（ワークシート）が見つからないことを示す"""
+
+# users テーブルに保存する、ユーザーごとの集計状態（JSON 文字列）
+USER_STATE_COLS = ['gap_stats', 'achievements']
+# スキーマから外した列。既存のテーブルに残っている場合は値ごと取り除く
+# （keyword_index は固定の書き出しで始まる JSON を XOR 暗号化していたため、鍵の大部分を推測できてしまう）
+RETIRED_COLS = {'users': ['keyword_index']}
+
+def _get_db_schema_cols(sheet_name: str) -> list:
+    """シートごとの保存カラム順を返す"""
+    db_schema_cols = ['user_id', 'password_hash', 'consent'] + list(DEMOGRAPHIC_OPTIONS.keys()) + USER_STATE_COLS
+    if sheet_name == 'data':
+        element_cols_ordered = [f's_element_{e}' for domain_key in DOMAINS for e in LONG_ELEMENTS[domain_key]]
+        db_schema_cols = (
+            ['user_id', 'date', 'record_timestamp', 'consent', 'mode'] + 
+            Q_COLS + S_COLS + 
+            ['g_happiness', 'event_log'] +
+            element_cols_ordered +
+            METRIC_COLS + METRICS_META_COLS
+        )
+    return db_schema_cols
+
+# 行単位の書き込み（アップサート）で、既存行を特定するためのキー
+UPSERT_KEY_COLS = {
+    'users': ['user_id'],
+    'data': ['user_id', 'date'],
+}
 
-        if df.empty:
-            return df
-        
-        if 'date' in df.columns:
-            df['date'] = pd.to_datetime(df['date'], errors='coerce').dt.date
-        if 'record_timestamp' in df.columns:
-             df['record_timestamp'] = pd.to_datetime(df['record_timestamp'], errors='coerce')
+def _serialize_table(sheet_name: str, df: pd.DataFrame) -> pd.DataFrame:
+    """DataFrameを保存用の文字列のテーブル（スプレッドシートのセル値と同じ表現）に変換する"""
+    df_copy = df.copy()
+    
+    if 'date' in df_copy.columns:
+        df_copy['date'] = pd.to_datetime(df_copy['date'], errors='coerce').dt.strftime('%Y-%m-%d')
 
-        demographic_cols = list(DEMOGRAPHIC_OPTIONS.keys())
-        all_cols_to_process = Q_COLS + S_COLS + ALL_ELEMENT_COLS + ['g_happiness'] + demographic_cols
-        
-        for col in [c for c in all_cols_to_process if c in df.columns]:
-            if col not in demographic_cols:
-                 df[col] = pd.to_numeric(df[col], errors='coerce')
-            
+    if 'record_timestamp' in df_copy.columns:
+        # Attempt to coerce column to datetimes. This yields a Series.
+        timestamps = pd.to_datetime(df_copy['record_timestamp'], errors='coerce')
+
+        try:
+            # Use the dtype of the Series for robust detection
+            if pd.api.types.is_datetime64_any_dtype(timestamps.dtype):
+                # If timezone-aware, convert to UTC and then remove tz for consistent storage
+                try:
+                    # timestamps.dt.tz might not exist for some pandas versions; use getattr safely
+                    if getattr(timestamps.dt, 'tz', None) is not None:
+                        # Convert to UTC then drop tz info
+                        timestamps = timestamps.dt.tz_convert('UTC').dt.tz_localize(None)
+                    # Format as ISO with trailing Z to indicate UTC when possible
+                    df_copy['record_timestamp'] = timestamps.apply(lambda x: x.isoformat() + 'Z' if pd.notna(x) else '')
+                except Exception:
+                    # Fallback: try simple isoformat if .dt access fails
+                    df_copy['record_timestamp'] = timestamps.apply(lambda x: x.isoformat() if pd.notna(x) else '')
+            else:
+                # Fallback: handle object-dtype entries (python datetimes or strings)
+                def _to_iso(val):
+                    try:
+                        if pd.isna(val):
+                            return ''
+                        ts = pd.to_datetime(val, errors='coerce')
+                        if pd.isna(ts):
+                            return ''
+                        # If tz-aware, convert to UTC then produce ISO + 'Z'
+                        if hasattr(ts, 'tzinfo') and ts.tzinfo is not None:
+                            try:
+                                # pandas Timestamp may need tz_convert; try to normalize to UTC
+                                ts_utc = ts.tz_convert('UTC') if hasattr(ts, 'tz_convert') else ts
+                                # remove tzinfo for consistent formatting
+                                try:
+                                    ts_utc = ts_utc.tz_localize(None)
+                                except Exception:
+                                    pass
+                                return ts_utc.isoformat() + 'Z'
+                            except Exception:
+                                pass
+                        return ts.isoformat()
+                    except Exception:
+                        return ''
+                df_copy['record_timestamp'] = df_copy['record_timestamp'].apply(_to_iso)
+        except Exception:
+            # Ensure column exists and is safe to write if anything unexpected occurs
+            df_copy['record_timestamp'] = df_copy['record_timestamp'].apply(lambda x: '' if pd.isna(x) else str(x))
+
+    db_schema_cols = _get_db_schema_cols(sheet_name)
+    for col in db_schema_cols:
+        if col not in df_copy.columns:
+            df_copy[col] = '' 
+
+    df_to_write = df_copy[db_schema_cols]
+    # カテゴリ型や欠損値つき整数型は '' で埋められないため、先に object 型にする
+    df_to_write = df_to_write.astype(object).fillna('').astype(str)
+    return df_to_write
+
+# まとめて数値に変換する列（スコアは全て 0〜100 の数値）
+NUMERIC_COLS = Q_COLS + S_COLS + ALL_ELEMENT_COLS + ['g_happiness']
+# 保存済みの派生指標（0〜1 の小数を含むため、圧縮せずに float のまま保持する）
+STORED_METRIC_COLS = METRIC_COLS + METRICS_META_COLS
+# 保存する派生指標の小数点以下の桁数（スプレッドシートの表示形式で丸められない桁数に揃える）
+STORED_METRIC_DECIMALS = 6
+# スプレッドシートの真偽値セル（USER_ENTERED で TRUE/FALSE になる）と、SQLiteに保存した文字列表現
+CONSENT_TRUE_VALUES = {'TRUE', 'True', 'true', '1'}
+
+# スコア列の格納型（0〜100 の整数を欠損値つきで保持する）
+SCORE_DTYPE = 'UInt8'
+SCORE_RANGE = (0, 100)
+# 語彙が固定されているカテゴリ列（記録されている値が語彙に無い場合は、カテゴリに追加して保持する）
+CATEGORY_VOCABULARIES = {'mode': ['quick', 'deep'], **DEMOGRAPHIC_OPTIONS}
+CATEGORY_COLS = ['user_id'] + list(CATEGORY_VOCABULARIES.keys())
+
+def compact_data_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    スキーマに基づいて、キャッシュするテーブルの列をメモリ効率の良い型に変換する。
+    スコア列は欠損値つきの小さな整数、ID・記録モード・プロフィール項目はカテゴリ型にする。
+    範囲外の値や小数を含むスコア列は float64 のまま残す。
+    """
+    for col in [c for c in NUMERIC_COLS if c in df.columns]:
+        if df[col].dtype == SCORE_DTYPE:
+            continue
+        values = pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+        valid = values[~np.isnan(values)]
+        if ((valid >= SCORE_RANGE[0]) & (valid <= SCORE_RANGE[1]) & (valid == np.round(valid))).all():
+            df[col] = pd.Series(values, index=df.index).astype(SCORE_DTYPE)
+
+    for col in [c for c in CATEGORY_COLS if c in df.columns]:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            continue
+        vocabulary = CATEGORY_VOCABULARIES.get(col, [])
+        observed = [v for v in pd.unique(df[col].dropna()) if v not in vocabulary]
+        df[col] = pd.Categorical(df[col], categories=list(vocabulary) + observed)
+    return df
+
+def _decode_values(header: list, rows: list, index=None) -> pd.DataFrame:
+    """
+    バックエンドから読み込んだセル値の行列（get_all_values と同じ形式）を、アプリで扱う型のテーブルに変換する。
+    行ごとの dict を作らずに列単位で処理し、数値列は1回の変換でまとめて float にした上で compact_data_frame で圧縮する。
+    """
+    n_cols = len(header)
+    if not rows:
+        return pd.DataFrame(columns=header)
+    if any(len(row) != n_cols for row in rows):
+        rows = [list(row[:n_cols]) + [''] * (n_cols - len(row)) for row in rows]
+    matrix = np.array(rows, dtype=object).reshape(len(rows), n_cols)
+
+    columns = {}
+    numeric_idx = [j for j, col in enumerate(header) if col in NUMERIC_COLS or col in STORED_METRIC_COLS]
+    if numeric_idx:
+        block = matrix[:, numeric_idx]
+        block[block == ''] = np.nan
+        try:
+            numeric_block = block.astype(np.float64)
+        except (ValueError, TypeError):
+            # 数値として解釈できないセルが混ざっている場合だけ、列ごとに欠損値へ置き換える
+            numeric_block = np.column_stack([pd.to_numeric(block[:, k], errors='coerce').astype(np.float64) for k in range(block.shape[1])])
+        for k, j in enumerate(numeric_idx):
+            columns[header[j]] = numeric_block[:, k]
+
+    for j, col in enumerate(header):
+        if col in columns:
+            continue
+        values = matrix[:, j]
+        if col == 'date':
+            columns[col] = pd.to_datetime(pd.Series(values), errors='coerce').dt.date.values
+        elif col == 'record_timestamp':
+            columns[col] = pd.to_datetime(pd.Series(values), errors='coerce')
+        elif col == 'consent':
+            columns[col] = np.isin(values.astype(str), list(CONSENT_TRUE_VALUES))
+        else:
+            columns[col] = values
+
+    df = pd.DataFrame(columns, columns=header)
+    if index is not None:
+        df.index = index
+    return compact_data_frame(df)
+
+def _normalize_key_frame(sheet_name: str, df: pd.DataFrame) -> pd.Series:
+    """アップサートのキー列を、比較可能な文字列のタプルに正規化する"""
+    key_cols = UPSERT_KEY_COLS[sheet_name]
+    normalized = pd.DataFrame(index=df.index)
+    for col in key_cols:
+        values = df[col] if col in df.columns else pd.Series('', index=df.index)
+        if col == 'date':
+            # シート側は表示形式（例: 2024/01/05）で返ってくることがあるため、日付として解釈し直す
+            normalized[col] = pd.to_datetime(values, errors='coerce').dt.strftime('%Y-%m-%d').fillna('')
+        else:
+            normalized[col] = values.astype(object).fillna('').astype(str)
+    return pd.Series(list(normalized.itertuples(index=False, name=None)), index=df.index)
+
+def _merge_rows(sheet_name: str, df_existing: pd.DataFrame, df: pd.DataFrame, replace_existing: bool) -> pd.DataFrame:
+    """既存のテーブルに行を追加（replace_existing=True ならキーが一致する行を置換）した結果を返す"""
+    if df_existing.empty:
         return df
-    except (gspread.exceptions.SpreadsheetNotFound, gspread.exceptions.WorksheetNotFound):
+    if replace_existing:
+        existing_keys = _normalize_key_frame(sheet_name, df_existing)
+        new_keys = set(_normalize_key_frame(sheet_name, df))
+        df_existing = df_existing[~existing_keys.isin(new_keys)]
+    return pd.concat([df_existing, df], ignore_index=True)
+
+class StorageBackend(ABC):
+    """
+    users / data テーブルの読み書きを抽象化するインターフェース。
+    location はバックエンドごとのテーブルの所在（Google Sheetsではスプレッドシートの ID）を表す。
+    read_* は _decode_values で型変換済みのテーブルを返す。
+    """
+    @abstractmethod
+    def read_table(self, table: str, location: str) -> pd.DataFrame:
+        """テーブル全体を読み込む（一括スキャン）"""
+
+    @abstractmethod
+    def read_user(self, table: str, location: str, user_id: str) -> pd.DataFrame:
+        """指定したユーザーの行だけを読み込む"""
+
+    @abstractmethod
+    def write_table(self, table: str, location: str, df: pd.DataFrame) -> None:
+        """テーブル全体を書き換える"""
+
+    @abstractmethod
+    def upsert_rows(self, table: str, location: str, df: pd.DataFrame, replace_existing: bool = True) -> None:
+        """UPSERT_KEY_COLS が一致する行を置換し、それ以外の行を追加する"""
+
+    @abstractmethod
+    def delete_user(self, table: str, location: str, user_id: str) -> None:
+        """指定したユーザーの行を全て削除する"""
+
+class GSheetsBackend(StorageBackend):
+    """
+    Google Sheets（gspread）をテーブルの保存先とするバックエンド。
+    ユーザー単位の読み込みのために、user_id 列から作った「user_id -> 行範囲」のインデックスを保持する。
+    一括スキャンは、前回取得時の行数（ウォーターマーク）以降に追記された行だけを取得して差分同期する。
+    """
+    # インデックスを作り直すまでの秒数（他のプロセスによる追記を取り込むため）
+    ROW_INDEX_TTL_SECONDS = 60
+    # 1回の batch_get で取得する行範囲の最大数（リクエストURLの長さを抑えるため）
+    ROW_RANGE_BATCH_SIZE = 100
+    # 差分同期では他のプロセスによる既存行の上書きを検知できないため、この秒数ごとに全件を読み直す
+    FULL_RELOAD_INTERVAL_SECONDS = 600
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._row_indexes = {}
+        self._snapshots = {}
+
+    def _worksheet(self, table: str, location: str):
+        import gspread
+        gc = get_gspread_client()
+        if gc is None:
+            raise StorageUnavailableError("Google Sheetsのクライアントが初期化されていません。")
+        try:
+            return gc.open_by_key(location).worksheet(table)
+        except (gspread.exceptions.SpreadsheetNotFound, gspread.exceptions.WorksheetNotFound) as e:
+            raise TableNotFoundError(table) from e
+
+    @staticmethod
+    def _column_letter(col_number: int) -> str:
+        import gspread
+        return re.sub(r'\d+', '', gspread.utils.rowcol_to_a1(1, col_number))
+
+    def _build_row_index(self, worksheet) -> dict:
+        """ヘッダー行と user_id 列（A列）だけを取得し、ユーザーごとの連続した行範囲を求める"""
+        header_rows, id_rows = worksheet.batch_get(['1:1', 'A:A'])
+        return self._row_index_from_values(header_rows, id_rows)
+
+    @staticmethod
+    def _row_index_from_values(header_rows, id_rows) -> dict:
+        header = list(header_rows[0]) if header_rows else []
+        user_ids = pd.Series([row[0] if row else '' for row in id_rows[1:]], dtype=object)
+
+        ranges = {}
+        if not user_ids.empty:
+            run_starts = np.flatnonzero(user_ids.ne(user_ids.shift()).values)
+            run_ends = np.append(run_starts[1:], len(user_ids)) - 1
+            for start, end in zip(run_starts, run_ends):
+                ranges.setdefault(user_ids.iat[start], []).append((int(start) + 2, int(end) + 2))
+        return {'built_at': time.time(), 'header': header, 'ranges': ranges, 'n_rows': len(user_ids)}
+
+    def _get_row_index(self, table: str, location: str, worksheet, refresh: bool = False) -> dict:
+        with self._lock:
+            index = self._row_indexes.get((location, table))
+            if index is not None and not refresh and time.time() - index['built_at'] < self.ROW_INDEX_TTL_SECONDS:
+                return index
+        index = self._build_row_index(worksheet)
+        with self._lock:
+            self._row_indexes[(location, table)] = index
+        return index
+
+    def _invalidate_row_index(self, table: str, location: str) -> None:
+        with self._lock:
+            self._row_indexes.pop((location, table), None)
+
+    def _record_appended_rows(self, table: str, location: str, user_ids: list, response) -> None:
+        """末尾に追加した行を、作り直さずにインデックスへ反映する"""
+        import gspread
+        try:
+            updated_range = response['updates']['updatedRange']
+            first_row = gspread.utils.a1_range_to_grid_range(updated_range.split('!')[-1])['startRowIndex'] + 1
+        except (KeyError, TypeError, ValueError):
+            self._invalidate_row_index(table, location)
+            return
+        with self._lock:
+            index = self._row_indexes.get((location, table))
+            if index is None:
+                return
+            for row_number, user_id in enumerate(user_ids, start=first_row):
+                user_ranges = index['ranges'].setdefault(user_id, [])
+                if user_ranges and user_ranges[-1][1] == row_number - 1:
+                    user_ranges[-1] = (user_ranges[-1][0], row_number)
+                else:
+                    user_ranges.append((row_number, row_number))
+            index['n_rows'] = max(index['n_rows'], first_row + len(user_ids) - 2)
+
+    def _invalidate_snapshot(self, table: str, location: str) -> None:
+        with self._lock:
+            self._snapshots.pop((location, table), None)
+
+    def _patch_snapshot(self, table: str, location: str, updated_rows: dict) -> None:
+        """自プロセスで上書きした行（行番号 -> セル値）を、読み直さずにスナップショットへ反映する"""
+        with self._lock:
+            snapshot = self._snapshots.get((location, table))
+            if snapshot is None:
+                return
+            df = snapshot['df']
+            positions = [row_number - 2 for row_number in updated_rows]
+            if list(df.columns) != snapshot['header'] or max(positions) >= len(df):
+                self._snapshots.pop((location, table), None)
+                return
+            df_patch = _decode_values(snapshot['header'], list(updated_rows.values()), index=positions)
+            snapshot['df'] = compact_data_frame(pd.concat([df.drop(index=positions), df_patch]).sort_index())
+
+    def _full_reload(self, table: str, location: str, worksheet) -> pd.DataFrame:
+        values = worksheet.get_all_values()
+        header = list(values[0]) if values else []
+        df = _decode_values(header, values[1:])
+        with self._lock:
+            self._snapshots[(location, table)] = {
+                'header': header,
+                'n_rows': len(df),
+                'df': df,
+                'full_at': time.time(),
+            }
+        return df.copy()
+
+    def read_table(self, table: str, location: str) -> pd.DataFrame:
+        worksheet = self._worksheet(table, location)
+        with self._lock:
+            snapshot = self._snapshots.get((location, table))
+        if snapshot is None or time.time() - snapshot['full_at'] > self.FULL_RELOAD_INTERVAL_SECONDS:
+            return self._full_reload(table, location, worksheet)
+
+        # ウォーターマーク：ヘッダー行と、A列（user_id）から求めた行数。ついでに行範囲インデックスも更新する
+        header_rows, id_rows = worksheet.batch_get(['1:1', 'A:A'])
+        index = self._row_index_from_values(header_rows, id_rows)
+        with self._lock:
+            self._row_indexes[(location, table)] = index
+
+        if index['header'] != snapshot['header'] or index['n_rows'] < snapshot['n_rows']:
+            # 行が減った、またはヘッダーが変わった場合だけ全件を読み直す
+            return self._full_reload(table, location, worksheet)
+        if index['n_rows'] == snapshot['n_rows']:
+            return snapshot['df'].copy()
+
+        header = index['header']
+        last_col = self._column_letter(len(header))
+        tail_values = worksheet.get(f"A{snapshot['n_rows'] + 2}:{last_col}{index['n_rows'] + 1}")
+        df_tail = _decode_values(header, tail_values)
+        # カテゴリが異なる列は連結で object 型に戻るため、連結後に圧縮し直す
+        df = df_tail if snapshot['df'].empty else compact_data_frame(pd.concat([snapshot['df'], df_tail], ignore_index=True))
+        with self._lock:
+            self._snapshots[(location, table)] = dict(snapshot, n_rows=len(df), df=df)
+        return df.copy()
+
+    def _read_user_from_table(self, table: str, location: str, user_id: str, header: list) -> pd.DataFrame:
+        """全件を読み込んで、指定したユーザーの行に絞り込む"""
+        df = self.read_table(table, location)
+        if df.empty or 'user_id' not in df.columns:
+            return pd.DataFrame(columns=header)
+        return df[df['user_id'] == user_id].reset_index(drop=True)
+
+    def read_user(self, table: str, location: str, user_id: str) -> pd.DataFrame:
+        worksheet = self._worksheet(table, location)
+        for attempt in range(2):
+            index = self._get_row_index(table, location, worksheet, refresh=attempt > 0)
+            header = index['header']
+            if not header or header[0] != 'user_id':
+                # 古いスキーマでは A列が user_id とは限らないため、全件を読み込んで絞り込む
+                return self._read_user_from_table(table, location, user_id, header)
+
+            user_ranges = index['ranges'].get(user_id, [])
+            if not user_ranges:
+                return pd.DataFrame(columns=header)
+
+            last_col = self._column_letter(len(header))
+            a1_ranges = [f"A{start}:{last_col}{end}" for start, end in user_ranges]
+            rows = []
+            for i in range(0, len(a1_ranges), self.ROW_RANGE_BATCH_SIZE):
+                for value_range in worksheet.batch_get(a1_ranges[i:i + self.ROW_RANGE_BATCH_SIZE]):
+                    rows.extend(list(row) + [''] * (len(header) - len(row)) for row in value_range)
+
+            # 他のプロセスが行を削除して行番号がずれた場合は、インデックスを作り直して読み直す
+            if all(row and row[0] == user_id for row in rows):
+                return _decode_values(header, rows)
+        # 作り直したインデックスでも行が一致しない（読み込みの間にも行が動いている）場合は、全件を読み込んで絞り込む
+        self._invalidate_row_index(table, location)
+        return self._read_user_from_table(table, location, user_id, header)
+
+    @staticmethod
+    def _row_numbers_by_key(table: str, key_rows: list, row_numbers: list) -> dict:
+        """キー列のセル値の行と、その行番号から「キー -> 行番号の一覧」を作る"""
+        key_cols = UPSERT_KEY_COLS[table]
+        df_keys = pd.DataFrame([list(row[:len(key_cols)]) + [''] * (len(key_cols) - len(row)) for row in key_rows], columns=key_cols)
+        row_numbers_by_key = {}
+        for row_number, key in zip(row_numbers, _normalize_key_frame(table, df_keys)):
+            row_numbers_by_key.setdefault(key, []).append(row_number)
+        return row_numbers_by_key
+
+    def _scan_key_rows(self, table: str, worksheet) -> dict:
+        """キー列（先頭の列）を全行取得して、既存行の行番号を特定する"""
+        key_values = worksheet.get(f"A2:{self._column_letter(len(UPSERT_KEY_COLS[table]))}")
+        return self._row_numbers_by_key(table, key_values, range(2, len(key_values) + 2))
+
+    def _indexed_key_rows(self, table: str, location: str, worksheet, user_ids: list):
+        """
+        行範囲インデックスを使い、書き込むユーザーの行と、インデックスの作成後に末尾へ追記された行のキー列だけを取得して、
+        既存行の行番号を特定する。他のプロセスによる削除などで行番号がずれていた場合は None を返す。
+        """
+        index = self._get_row_index(table, location, worksheet)
+        if not index['header'] or index['header'][0] != 'user_id':
+            return None
+        key_last_col = self._column_letter(len(UPSERT_KEY_COLS[table]))
+        user_ranges = [(user_id, start, end) for user_id in dict.fromkeys(user_ids) for start, end in index['ranges'].get(user_id, [])]
+        # 末尾は、シートの範囲外を指定しないよう、インデックスの最後の行（行が無ければヘッダー行）から取得する
+        tail_start = index['n_rows'] + 1
+        a1_ranges = [f"A{start}:{key_last_col}{end}" for _, start, end in user_ranges] + [f"A{tail_start}:{key_last_col}"]
+        value_ranges = []
+        for i in range(0, len(a1_ranges), self.ROW_RANGE_BATCH_SIZE):
+            value_ranges.extend(worksheet.batch_get(a1_ranges[i:i + self.ROW_RANGE_BATCH_SIZE]))
+
+        key_rows, row_numbers = [], []
+        for (user_id, start, end), rows in zip(user_ranges, value_ranges):
+            if len(rows) != end - start + 1 or not all(row and row[0] == user_id for row in rows):
+                return None
+            key_rows.extend(rows)
+            row_numbers.extend(range(start, end + 1))
+        tail_rows = value_ranges[-1]
+        if not tail_rows:
+            # インデックスの最後の行が無い（行が削除された）
+            return None
+        key_rows.extend(tail_rows[1:])
+        row_numbers.extend(range(tail_start + 1, tail_start + len(tail_rows)))
+        return self._row_numbers_by_key(table, key_rows, row_numbers)
+
+    def write_table(self, table: str, location: str, df: pd.DataFrame) -> None:
+        worksheet = self._worksheet(table, location)
+        df_to_write = _serialize_table(table, df)
+        worksheet.clear()
+        worksheet.update([df_to_write.columns.values.tolist()] + df_to_write.values.tolist(), value_input_option='USER_ENTERED')
+        self._invalidate_row_index(table, location)
+        self._invalidate_snapshot(table, location)
+
+    def upsert_rows(self, table: str, location: str, df: pd.DataFrame, replace_existing: bool = True) -> None:
+        worksheet = self._worksheet(table, location)
+
+        db_schema_cols = _get_db_schema_cols(table)
+        header = worksheet.row_values(1)
+        if header != db_schema_cols:
+            # スキーマ移行が必要な場合のみ、従来の全件書き換えにフォールバックする
+            df_existing = self.read_table(table, location)
+            self.write_table(table, location, _merge_rows(table, df_existing, df, replace_existing))
+            return
+
+        df_to_write = _serialize_table(table, df)
+        last_col = self._column_letter(len(db_schema_cols))
+
+        updates = []
+        rows_to_delete = []
+        rows_to_append = df_to_write.values.tolist()
+
+        if replace_existing:
+            # 書き込むユーザーの行だけでキーを照合し、行番号がずれていた場合だけキー列を全行取得する
+            row_numbers_by_key = self._indexed_key_rows(table, location, worksheet, df_to_write['user_id'].tolist())
+            if row_numbers_by_key is None:
+                self._invalidate_row_index(table, location)
+                row_numbers_by_key = self._scan_key_rows(table, worksheet)
+
+            rows_to_append = []
+            for key, row_values in zip(_normalize_key_frame(table, df_to_write), df_to_write.values.tolist()):
+                row_numbers = row_numbers_by_key.pop(key, [])
+                if row_numbers:
+                    target_row = row_numbers[0]
+                    updates.append({'range': f"A{target_row}:{last_col}{target_row}", 'values': [row_values]})
+                    # 同じキーの重複行は、従来の置換処理と同様に取り除く
+                    rows_to_delete.extend(row_numbers[1:])
+                else:
+                    rows_to_append.append(row_values)
+
+        if updates:
+            worksheet.batch_update(updates, value_input_option='USER_ENTERED')
+        for row_number in sorted(rows_to_delete, reverse=True):
+            worksheet.delete_rows(row_number)
+        if rows_to_delete:
+            # 行の削除で後続の行番号がずれるため、インデックスとスナップショットは作り直す
+            self._invalidate_row_index(table, location)
+            self._invalidate_snapshot(table, location)
+        elif updates:
+            self._patch_snapshot(table, location, {int(re.match(r'A(\d+):', u['range']).group(1)): u['values'][0] for u in updates})
+        if rows_to_append:
+            response = worksheet.append_rows(rows_to_append, value_input_option='USER_ENTERED', table_range='A1')
+            self._record_appended_rows(table, location, [row[0] for row in rows_to_append], response)
+
+    def delete_user(self, table: str, location: str, user_id: str) -> None:
+        df_existing = self.read_table(table, location)
+        if df_existing.empty or 'user_id' not in df_existing.columns:
+            return
+        self.write_table(table, location, df_existing[df_existing['user_id'] != user_id])
+
+class SQLiteBackend(StorageBackend):
+    """
+    ローカルのSQLiteファイルをテーブルの保存先とするバックエンド。オフラインでの負荷・レイテンシ検証用。
+    値はGoogle Sheetsと同じ文字列表現（_serialize_table）で保存するため、読み込み後の型変換も共通になる。
+    location は使用しない。
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            for table in UPSERT_KEY_COLS:
+                self._ensure_table(table)
+
+    @staticmethod
+    def _quote(name: str) -> str:
+        return '"' + name.replace('"', '""') + '"'
+
+    def _ensure_table(self, table: str) -> None:
+        db_schema_cols = _get_db_schema_cols(table)
+        cols_sql = ', '.join(f"{self._quote(c)} TEXT" for c in db_schema_cols)
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS {self._quote(table)} ({cols_sql})")
+        # スキーマに列が追加された場合は、既存のテーブルに列を足す
+        existing_cols = {row[1] for row in self._conn.execute(f"PRAGMA table_info({self._quote(table)})")}
+        for col in db_schema_cols:
+            if col not in existing_cols:
+                self._conn.execute(f"ALTER TABLE {self._quote(table)} ADD COLUMN {self._quote(col)} TEXT")
+        for col in RETIRED_COLS.get(table, []):
+            if col in existing_cols:
+                self._conn.execute(f"ALTER TABLE {self._quote(table)} DROP COLUMN {self._quote(col)}")
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {self._quote(f'idx_{table}_user_id')} ON {self._quote(table)} (user_id)")
+        if table == 'data':
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS {self._quote('idx_data_user_id_date')} ON {self._quote('data')} (user_id, date)")
+
+    def _select(self, table: str, where: str = "", params: tuple = ()) -> pd.DataFrame:
+        db_schema_cols = _get_db_schema_cols(table)
+        # 後から追加された列の NULL は、シートの空セルと同じ '' として扱う
+        cols_sql = ', '.join(f"COALESCE({self._quote(c)}, '')" for c in db_schema_cols)
+        with self._lock:
+            rows = self._conn.execute(f"SELECT {cols_sql} FROM {self._quote(table)} {where} ORDER BY rowid", params).fetchall()
+        return _decode_values(db_schema_cols, rows)
+
+    def _insert_sql(self, table: str) -> str:
+        db_schema_cols = _get_db_schema_cols(table)
+        cols_sql = ', '.join(self._quote(c) for c in db_schema_cols)
+        placeholders = ', '.join('?' for _ in db_schema_cols)
+        return f"INSERT INTO {self._quote(table)} ({cols_sql}) VALUES ({placeholders})"
+
+    def read_table(self, table: str, location: str) -> pd.DataFrame:
+        return self._select(table)
+
+    def read_user(self, table: str, location: str, user_id: str) -> pd.DataFrame:
+        return self._select(table, "WHERE user_id = ?", (user_id,))
+
+    def write_table(self, table: str, location: str, df: pd.DataFrame) -> None:
+        df_to_write = _serialize_table(table, df)
+        with self._lock, self._conn:
+            self._conn.execute(f"DELETE FROM {self._quote(table)}")
+            self._conn.executemany(self._insert_sql(table), df_to_write.values.tolist())
+
+    def upsert_rows(self, table: str, location: str, df: pd.DataFrame, replace_existing: bool = True) -> None:
+        df_to_write = _serialize_table(table, df)
+        key_cols = UPSERT_KEY_COLS[table]
+        db_schema_cols = _get_db_schema_cols(table)
+        set_sql = ', '.join(f"{self._quote(c)} = ?" for c in db_schema_cols)
+        where_sql = ' AND '.join(f"{self._quote(c)} = ?" for c in key_cols)
+
+        with self._lock, self._conn:
+            for key, row_values in zip(_normalize_key_frame(table, df_to_write), df_to_write.values.tolist()):
+                rowids = []
+                if replace_existing:
+                    rowids = [r[0] for r in self._conn.execute(f"SELECT rowid FROM {self._quote(table)} WHERE {where_sql} ORDER BY rowid", key)]
+                if rowids:
+                    self._conn.execute(f"UPDATE {self._quote(table)} SET {set_sql} WHERE rowid = ?", row_values + [rowids[0]])
+                    # 同じキーの重複行は、Google Sheetsバックエンドと同様に取り除く
+                    self._conn.executemany(f"DELETE FROM {self._quote(table)} WHERE rowid = ?", [(r,) for r in rowids[1:]])
+                else:
+                    self._conn.execute(self._insert_sql(table), row_values)
+
+    def delete_user(self, table: str, location: str, user_id: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(f"DELETE FROM {self._quote(table)} WHERE user_id = ?", (user_id,))
+
+# st.secrets の [storage] backend で選択できるバックエンド
+STORAGE_BACKENDS = {
+    'gsheets': GSheetsBackend,
+    'sqlite': SQLiteBackend,
+}
+
+def _get_storage_settings() -> dict:
+    try:
+        return dict(st.secrets["storage"])
+    except (KeyError, FileNotFoundError):
+        return {}
+
+def get_storage_backend_name() -> str:
+    return _get_storage_settings().get('backend', 'gsheets')
+
+@st.cache_resource
+def get_storage_backend() -> StorageBackend:
+    settings = _get_storage_settings()
+    backend_name = settings.get('backend', 'gsheets')
+    if backend_name not in STORAGE_BACKENDS:
+        raise ValueError(f"未知のストレージバックエンドです: {backend_name}")
+    if backend_name == 'sqlite':
+        return SQLiteBackend(settings.get('sqlite_path', 'harmony_navigator.db'))
+    return STORAGE_BACKENDS[backend_name]()
+
+def get_sheet_ids() -> tuple:
+    """
+    users / data テーブルの所在（users_sheet_id, data_sheet_id）を返す。
+    Google Sheets 以外のバックエンドでは、未設定の場合にテーブル名で代用する。
+    """
+    try:
+        gsheets_settings = st.secrets["connections"]["gsheets"]
+        return gsheets_settings["users_sheet_id"], gsheets_settings["data_sheet_id"]
+    except (KeyError, FileNotFoundError):
+        if get_storage_backend_name() == 'gsheets':
+            raise KeyError("users_sheet_id / data_sheet_id")
+        return 'users', 'data'
+
+class DataVersionRegistry:
+    """
+    テーブル単位・ユーザー単位のデータバージョンを管理する。
+    読み込みキャッシュのキーにバージョンを含め、書き込み時は影響する範囲のバージョンだけを進めることで、
+    他のユーザーの温まったキャッシュや認証済みクライアントを捨てずに、変更されたデータだけを無効化する。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+
+    def get(self, key: tuple) -> int:
+        with self._lock:
+            return self._versions.get(key, 0)
+
+    def bump(self, key: tuple) -> None:
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+
+@st.cache_resource
+def get_data_version_registry() -> DataVersionRegistry:
+    return DataVersionRegistry()
+
+def get_data_version(sheet_name: str, spreadsheet_id: str, user_id: str = None) -> tuple:
+    """
+    テーブル全体（user_id=None）または指定ユーザーのパーティションの現在のバージョンを返す。
+    テーブル全体の書き換えは全ユーザーに影響するため、世代番号としてどちらのバージョンにも含める。
+    """
+    registry = get_data_version_registry()
+    generation = registry.get(('generation', sheet_name, spreadsheet_id))
+    if user_id is None:
+        return generation, registry.get(('table', sheet_name, spreadsheet_id))
+    return generation, registry.get(('user', sheet_name, spreadsheet_id, user_id))
+
+def _bump_data_version(sheet_name: str, spreadsheet_id: str, user_ids=None) -> None:
+    """書き込みの影響範囲のバージョンを進める。user_ids=None はテーブル全体の書き換えを表す。"""
+    registry = get_data_version_registry()
+    if user_ids is None:
+        registry.bump(('generation', sheet_name, spreadsheet_id))
+        return
+    registry.bump(('table', sheet_name, spreadsheet_id))
+    for user_id in set(user_ids):
+        registry.bump(('user', sheet_name, spreadsheet_id, user_id))
+
+def _run_read(read_fn, sheet_name: str) -> pd.DataFrame:
+    """読み込み処理を実行し、失敗した場合はエラーを表示して空のテーブルを返す"""
+    try:
+        return read_fn()
+    except StorageUnavailableError:
+        pass
+    except TableNotFoundError:
         st.error(f"スプレッドシートまたはワークシート'{sheet_name}'が見つかりません。")
     except Exception as e:
         st.error(f"データの読み込み中にエラー: {e}")
     return pd.DataFrame()
 
-def write_data(sheet_name: str, spreadsheet_id: str, df: pd.DataFrame) -> bool:
-    gc = get_gspread_client()
-    if gc is None:
-        st.error("データベースクライアントが初期化されておらず、書き込みできません。")
-        return False
-    try:
-        sh = gc.open_by_key(spreadsheet_id)
-        worksheet = sh.worksheet(sheet_name)
-        
-        df_copy = df.copy()
-        
-        if 'date' in df_copy.columns:
-            df_copy['date'] = pd.to_datetime(df_copy['date'], errors='coerce').dt.strftime('%Y-%m-%d')
+@st.cache_data(ttl=60, max_entries=16)
+def _read_data_cached(sheet_name: str, spreadsheet_id: str, data_version: tuple) -> pd.DataFrame:
+    return _run_read(lambda: get_storage_backend().read_table(sheet_name, spreadsheet_id), sheet_name)
 
-        if 'record_timestamp' in df_copy.columns:
-            # Attempt to coerce column to datetimes. This yields a Series.
-            timestamps = pd.to_datetime(df_copy['record_timestamp'], errors='coerce')
+@st.cache_data(ttl=60, max_entries=1000)
+def _read_user_data_cached(sheet_name: str, spreadsheet_id: str, user_id: str, data_version: tuple) -> pd.DataFrame:
+    return _run_read(lambda: get_storage_backend().read_user(sheet_name, spreadsheet_id, user_id), sheet_name)
 
-            try:
-                # Use the dtype of the Series for robust detection
-                if pd.api.types.is_datetime64_any_dtype(timestamps.dtype):
-                    # If timezone-aware, convert to UTC and then remove tz for consistent storage
-                    try:
-                        # timestamps.dt.tz might not exist for some pandas versions; use getattr safely
-                        if getattr(timestamps.dt, 'tz', None) is not None:
-                            # Convert to UTC then drop tz info
-                            timestamps = timestamps.dt.tz_convert('UTC').dt.tz_localize(None)
-                        # Format as ISO with trailing Z to indicate UTC when possible
-                        df_copy['record_timestamp'] = timestamps.apply(lambda x: x.isoformat() + 'Z' if pd.notna(x) else '')
-                    except Exception:
-                        # Fallback: try simple isoformat if .dt access fails
-                        df_copy['record_timestamp'] = timestamps.apply(lambda x: x.isoformat() if pd.notna(x) else '')
-                else:
-                    # Fallback: handle object-dtype entries (python datetimes or strings)
-                    def _to_iso(val):
-                        try:
-                            if pd.isna(val):
-                                return ''
-                            ts = pd.to_datetime(val, errors='coerce')
-                            if pd.isna(ts):
-                                return ''
-                            # If tz-aware, convert to UTC then produce ISO + 'Z'
-                            if hasattr(ts, 'tzinfo') and ts.tzinfo is not None:
-                                try:
-                                    # pandas Timestamp may need tz_convert; try to normalize to UTC
-                                    ts_utc = ts.tz_convert('UTC') if hasattr(ts, 'tz_convert') else ts
-                                    # remove tzinfo for consistent formatting
-                                    try:
-                                        ts_utc = ts_utc.tz_localize(None)
-                                    except Exception:
-                                        pass
-                                    return ts_utc.isoformat() + 'Z'
-                                except Exception:
-                                    pass
-                            return ts.isoformat()
-                        except Exception:
-                            return ''
-                    df_copy['record_timestamp'] = df_copy['record_timestamp'].apply(_to_iso)
-            except Exception:
-                # Ensure column exists and is safe to write if anything unexpected occurs
-                df_copy['record_timestamp'] = df_copy['record_timestamp'].apply(lambda x: '' if pd.isna(x) else str(x))
-
-        db_schema_cols = ['user_id', 'password_hash', 'consent'] + list(DEMOGRAPHIC_OPTIONS.keys())
-        if sheet_name == 'data':
-            element_cols_ordered = [f's_element_{e}' for domain_key in DOMAINS for e in LONG_ELEMENTS[domain_key]]
-            db_schema_cols = (
-                ['user_id', 'date', 'record_timestamp', 'consent', 'mode'] + 
-                Q_COLS + S_COLS + 
-                ['g_happiness', 'event_log'] +
-                element_cols_ordered
-            )
-        
-        for col in db_schema_cols:
-            if col not in df_copy.columns:
-                df_copy[col] = '' 
+def read_data(sheet_name: str, spreadsheet_id: str) -> pd.DataFrame:
+    return _read_data_cached(sheet_name, spreadsheet_id, get_data_version(sheet_name, spreadsheet_id))
 
-        df_to_write = df_copy[db_schema_cols]
-        df_to_write = df_to_write.fillna('').astype(str)
-        
-        worksheet.clear()
-        worksheet.update([df_to_write.columns.values.tolist()] + df_to_write.values.tolist(), value_input_option='USER_ENTERED')
-        
-        st.cache_data.clear()
-        st.cache_resource.clear()
-        
+def read_user_data(sheet_name: str, spreadsheet_id: str, user_id: str) -> pd.DataFrame:
+    """指定したユーザーの行だけを読み込む。他のユーザーの履歴は取得しない。"""
+    return _read_user_data_cached(sheet_name, spreadsheet_id, user_id, get_data_version(sheet_name, spreadsheet_id, user_id))
+
+def _run_write(write_fn, sheet_name: str, spreadsheet_id: str, user_ids=None) -> bool:
+    """書き込み処理を実行し、成功した場合は影響範囲のキャッシュだけを無効化する"""
+    try:
+        write_fn()
+        _bump_data_version(sheet_name, spreadsheet_id, user_ids)
         return True
+    except StorageUnavailableError:
+        st.error("データベースクライアントが初期化されておらず、書き込みできません。")
     except Exception as e:
         st.error(f"データの書き込み中にエラー: {e}")
+    return False
+
+def _with_stored_metrics(sheet_name: str, df: pd.DataFrame, recompute_all: bool) -> pd.DataFrame:
+    """data テーブルに書き込む行に、派生指標（S, U, H）と計算に使った alpha・バージョンを付ける"""
+    if sheet_name != 'data' or df.empty:
+        return df
+    df_metrics = calculate_metrics(df, recompute_all=recompute_all)
+    df = df.copy()
+    df[METRIC_COLS] = df_metrics[METRIC_COLS].round(STORED_METRIC_DECIMALS)
+    df[METRICS_META_COLS] = df_metrics[METRICS_META_COLS]
+    return df
+
+def write_data(sheet_name: str, spreadsheet_id: str, df: pd.DataFrame) -> bool:
+    """テーブル全体を書き換える。スキーマ移行のためのフォールバック経路。"""
+    df = _with_stored_metrics(sheet_name, df, recompute_all=False)
+    return _run_write(lambda: get_storage_backend().write_table(sheet_name, spreadsheet_id, df), sheet_name, spreadsheet_id)
+
+def append_data(sheet_name: str, spreadsheet_id: str, df: pd.DataFrame) -> bool:
+    """既存の行には触れずに、新しい行をテーブルの末尾に追加する"""
+    if df.empty:
+        return True
+    df = _with_stored_metrics(sheet_name, df, recompute_all=True)
+    return _run_write(lambda: get_storage_backend().upsert_rows(sheet_name, spreadsheet_id, df, replace_existing=False),
+                      sheet_name, spreadsheet_id, df['user_id'].astype(str).tolist())
+
+def upsert_data(sheet_name: str, spreadsheet_id: str, df: pd.DataFrame) -> bool:
+    """
+    UPSERT_KEY_COLS が一致する行はその行の位置で上書きし、一致しない行は末尾に追加する。
+    書き込みの通信量は、テーブル全体ではなく変更した行数に比例する。
+    書き込む行は新規または編集された行なので、data テーブルでは派生指標を必ず計算し直して保存する。
+    """
+    if df.empty:
+        return True
+    df = _with_stored_metrics(sheet_name, df, recompute_all=True)
+    return _run_write(lambda: get_storage_backend().upsert_rows(sheet_name, spreadsheet_id, df, replace_existing=True),
+                      sheet_name, spreadsheet_id, df['user_id'].astype(str).tolist())
+
+def delete_user_data(sheet_name: str, spreadsheet_id: str, user_id: str) -> bool:
+    """指定したユーザーの行をテーブルから全て削除する"""
+    return _run_write(lambda: get_storage_backend().delete_user(sheet_name, spreadsheet_id, user_id),
+                      sheet_name, spreadsheet_id, [user_id])
+
+def update_user_state(users_sheet_id: str, user_id: str, updates: dict) -> bool:
+    """
+    users テーブルの指定ユーザーの行だけを読み込み、指定した列の値を更新して書き戻す（他の列はそのまま保持する）。
+    1回の呼び出しで読み込みと書き込みが1回ずつ発生するため、同時に更新する列は1つの updates にまとめて渡す。
+    """
+    user_row = read_user_data('users', users_sheet_id, user_id)
+    if user_row.empty:
         return False
-    # --- (D. データ永続化層 の後、E. UIコンポーネント の前に追加) ---
+    user_row = user_row.iloc[[0]].copy()
+    for col, value in updates.items():
+        user_row[col] = value
+    return upsert_data('users', users_sheet_id, user_row)
 
-def check_achievements(df: pd.DataFrame, rhi_results: dict, streak: int):
-    """ユーザーデータに基づいてアチーブメントの達成状況をチェックする"""
-    newly_unlocked = set()
-    currently_unlocked = st.session_state.unlocked_achievements.copy()
-
-    for ach_id, details in ACHIEVEMENTS.items():
-        if ach_id not in currently_unlocked:
-            condition_met = False
-            # 条件判定をラムダ関数の引数の数で分岐
-            if 'streak' in details['condition'].__code__.co_varnames:
-                condition_met = details['condition'](df, streak)
-            elif 'rhi_results' in details['condition'].__code__.co_varnames:
-                 condition_met = details['condition'](df, rhi_results)
-            else:
-                condition_met = details['condition'](df)
-            
-            if condition_met:
-                newly_unlocked.add(ach_id)
+# 計算済み指標のキャッシュ全体で保持するメモリの上限（バイト）
+METRICS_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+class MetricsCache:
+    """
+    calculate_metrics の結果を (user_id, data_version, フィンガープリント, alpha) をキーに保持する、メモリ上限つきの LRU キャッシュ。
+    キーはデータのバージョンと内容の要約から作るため、入力の DataFrame をハッシュせずに済む。
+    上限を超えた場合は、最も長く使われていない結果から破棄する。
+    """
+    def __init__(self, max_bytes: int):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: tuple):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: tuple, df: pd.DataFrame) -> None:
+        size = int(df.memory_usage(deep=True).sum())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.total_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (df, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'bytes': self.total_bytes, 'max_bytes': self.max_bytes}
+
+@st.cache_resource
+def get_metrics_cache() -> MetricsCache:
+    return MetricsCache(METRICS_CACHE_MAX_BYTES)
+
+def _data_fingerprint(df: pd.DataFrame) -> tuple:
+    """
+    記録の内容の要約（行数と最新の record_timestamp）。書き込みでは record_timestamp を必ず付け直すため、
+    データのバージョンを進めない変更（他のプロセスやセッションによる書き込み）も、行の追加・削除・上書きとして検知できる。
+    """
+    latest = df['record_timestamp'].max() if 'record_timestamp' in df.columns and not df.empty else None
+    return len(df), None if pd.isna(latest) else str(latest)
+
+def _session_data_key(data_version: tuple, df: pd.DataFrame) -> tuple:
+    """セッション内に保持する計算結果を、記録に対応づけるキー（データのバージョンと内容の指紋）"""
+    return data_version, _data_fingerprint(df)
+
+def get_user_metrics(df: pd.DataFrame, user_id: str, data_version: tuple, alpha: float = DEFAULT_ALPHA) -> pd.DataFrame:
+    """
+    ユーザーの記録の指標を計算する（同じバージョン・同じ内容のデータは再計算しない）。
+    data_version は df を読み込む前に get_data_version で取得した値を渡す。
+    読み込み中に書き込みがあっても、新しいデータが古いバージョンのキーで保存されるだけで、古い結果が使われることはない。
+    data_version はプロセス内でしか進まないため、他のプロセスで書き込まれたデータは _data_fingerprint で見分ける。
+    """
+    cache = get_metrics_cache()
+    key = (user_id, data_version, _data_fingerprint(df), alpha)
+    df_metrics = cache.get(key)
+    if df_metrics is None:
+        df_metrics = calculate_metrics(df, alpha=alpha)
+        cache.put(key, df_metrics)
+    # 呼び出し側が列を書き換えてもキャッシュが変わらないように、コピーを返す
+    return df_metrics.copy()
 
+    # --- (D. データ永続化層 の後、E. UIコンポーネント の前に追加) ---
+
+def _achievement_context(records: pd.DataFrame, record_count: int, streak: int) -> dict:
+    """
+    record_saved イベントの判定に使う値を作る。
+    records は判定する記録（保存時は新しい1件、保存済みの実績が無いユーザーの初回だけは全履歴）。
+    """
+    s_values = records.reindex(columns=S_COLS).astype('Float64').to_numpy(dtype=np.float64, na_value=np.nan)
+    return {
+        'record_count': record_count,
+        'streak': streak,
+        'has_deep': bool((records['mode'] == 'deep').any()) if 'mode' in records.columns else False,
+        'has_balanced_day': bool((s_values >= 70).all(axis=1).any()) if len(records) else False,
+    }
+
+def unlock_achievements(event: str, context: dict, users_sheet_id: str, user_id: str, state_updates: dict = None) -> set:
+    """
+    イベントに対応する未解除の実績だけを判定し、新たに解除した実績を通知して users テーブルに保存する。
+    state_updates を渡した場合は保存せずにその辞書に加え、呼び出し側で他の状態とまとめて書き込む。
+    判定のコストは、履歴の長さではなく context を作った記録の数だけで決まる。
+    """
+    unlocked = st.session_state.unlocked_achievements
+    newly_unlocked = {ach_id for ach_id, details in ACHIEVEMENTS.items()
+                      if details['event'] == event and ach_id not in unlocked and details['condition'](context)}
     if newly_unlocked:
-        for ach_id in newly_unlocked:
+        for ach_id in sorted(newly_unlocked):
             st.toast(f"{ACHIEVEMENTS[ach_id]['emoji']} 実績解除： {ACHIEVEMENTS[ach_id]['name']}", icon="🏆")
-        st.session_state.unlocked_achievements.update(newly_unlocked)
+        unlocked.update(newly_unlocked)
+        if state_updates is None:
+            update_user_state(users_sheet_id, user_id, {'achievements': json.dumps(sorted(unlocked))})
+        else:
+            state_updates['achievements'] = json.dumps(sorted(unlocked))
+    return newly_unlocked
 
-def calculate_streak(df: pd.DataFrame) -> int:
-    """連続記録日数を計算する"""
-    if df.empty:
-        return 0
+def load_achievements(users_sheet_id: str, user_id: str, user_data_df: pd.DataFrame) -> None:
+    """
+    users テーブルに保存した解除済みの実績をセッションに読み込む。
+    まだ保存されていないユーザー（この仕組みの導入前のユーザーや新規ユーザー）は、一度だけ全履歴で判定して保存する。
+    """
+    user_row = read_user_data('users', users_sheet_id, user_id)
+    user_row = user_row if 'achievements' in user_row.columns else pd.DataFrame()
+    stored = user_row['achievements'].iloc[0] if not user_row.empty else ''
+    try:
+        st.session_state.unlocked_achievements = set(json.loads(stored))
+        return
+    except (TypeError, ValueError):
+        st.session_state.unlocked_achievements = set()
+    dates = user_data_df['date'] if 'date' in user_data_df.columns else []
+    context = _achievement_context(user_data_df, len(user_data_df), StreakHistory(dates).longest())
+    if not unlock_achievements('record_saved', context, users_sheet_id, user_id):
+        update_user_state(users_sheet_id, user_id, {'achievements': json.dumps([])})
+
+class StreakHistory:
+    """
+    記録した日付の連続区間（ラン）の一覧。
+    日付を序数（1970-01-01 からの日数）にして重複を除いて並べ、隣との差が 1 でない位置で区切る（ランレングス符号化）。
+    記録の保存時は add で該当するランだけを延長・結合するため、履歴を走査し直さない。
+    """
+    def __init__(self, dates):
+        days = pd.to_datetime(pd.Series(dates), errors='coerce').dropna().to_numpy(dtype='datetime64[D]').astype(np.int64)
+        days = np.unique(days)
+        breaks = np.flatnonzero(np.diff(days) != 1) + 1
+        self.run_starts = days[np.r_[0, breaks]] if len(days) else days
+        self.run_ends = days[np.r_[breaks - 1, len(days) - 1]] if len(days) else days
+
+    @staticmethod
+    def _to_day(d: date) -> int:
+        return int(np.datetime64(d, 'D').astype(np.int64))
+
+    def add(self, d: date) -> None:
+        """記録した日付を1つ追加する"""
+        day = self._to_day(d)
+        i = int(np.searchsorted(self.run_ends, day - 1))
+        if i < len(self.run_starts) and self.run_starts[i] <= day <= self.run_ends[i]:
+            return
+        joins_left = i < len(self.run_ends) and self.run_ends[i] == day - 1
+        next_i = i + 1 if joins_left else i
+        joins_right = next_i < len(self.run_starts) and self.run_starts[next_i] == day + 1
+        if joins_left and joins_right:
+            self.run_ends[i] = self.run_ends[next_i]
+            self.run_starts = np.delete(self.run_starts, next_i)
+            self.run_ends = np.delete(self.run_ends, next_i)
+        elif joins_left:
+            self.run_ends[i] = day
+        elif joins_right:
+            self.run_starts[next_i] = day
+        else:
+            self.run_starts = np.insert(self.run_starts, i, day)
+            self.run_ends = np.insert(self.run_ends, i, day)
+
+    def current(self, today: date) -> int:
+        """今日または昨日まで続いている連続記録日数（どちらにも記録が無ければ 0）"""
+        day = self._to_day(today)
+        i = int(np.searchsorted(self.run_ends, day - 1))
+        if i == len(self.run_starts) or self.run_starts[i] > day:
+            return 0
+        return int(min(self.run_ends[i], day) - self.run_starts[i] + 1)
+
+    def longest(self) -> int:
+        return int((self.run_ends - self.run_starts).max() + 1) if len(self.run_starts) else 0
+
+    def runs(self) -> pd.DataFrame:
+        """全てのランの開始日・終了日・日数"""
+        return pd.DataFrame({
+            'start': self.run_starts.astype('datetime64[D]'),
+            'end': self.run_ends.astype('datetime64[D]'),
+            'days': self.run_ends - self.run_starts + 1,
+        })
+
+def get_streak_history(user_data_df: pd.DataFrame, data_version: tuple) -> StreakHistory:
+    """同じデータ（バージョンと内容の指紋が同じ）の StreakHistory を、セッション内で再利用する（保存時は add で更新済みのものを使う）"""
+    key = _session_data_key(data_version, user_data_df)
+    cached = st.session_state.get('streak_history')
+    if cached is None or cached[0] != key:
+        dates = user_data_df['date'] if 'date' in user_data_df.columns else []
+        cached = (key, StreakHistory(dates))
+        st.session_state.streak_history = cached
+    return cached[1]
+
+# イベントログからキーワードを切り出すパターン
+KEYWORD_PATTERN = re.compile(r'[\wぁ-んァ-ン一-龥ー]+')
+
+def _date_keys(dates) -> list:
+    """日付の列を、索引の行 ID（YYYY-MM-DD の文字列）に変換する"""
+    return pd.to_datetime(pd.Series(dates), errors='coerce').dt.strftime('%Y-%m-%d').tolist()
+
+def _log_digest(date_key: str, encrypted_log: str) -> int:
+    return int.from_bytes(hashlib.sha256(f"{date_key}\n{encrypted_log}".encode('utf-8')).digest()[:16], 'big')
+
+class KeywordIndex:
+    """
+    イベントログの転置索引（キーワード -> {記録日: [出現回数, ログ内で最初に現れた位置]}）。
+    記録はユーザーごとに日付で一意なため、記録日を行 ID とする。
+    期間の集計用に、同じ内容を記録日ごとに引ける形（by_date。ログ内の出現順に並べる）でもメモリ上に持つ。
+    索引は平文のキーワードを含むため保存せず、セッション内でのみ保持する。
+    digest は索引に含めた (記録日, 暗号文) ごとのハッシュの XOR で、保存時に差分だけで更新でき、
+    データのバージョンが変わったときに、索引が現在の記録と一致しているかの確認に使う。
+    """
+    def __init__(self, postings: dict = None, digest: int = 0):
+        self.postings = postings if postings is not None else {}
+        self.digest = digest
+        by_date = {}
+        for token, rows in self.postings.items():
+            for date_key, posting in rows.items():
+                by_date.setdefault(date_key, []).append((posting[1], token, posting))
+        self.by_date = {date_key: {token: posting for _, token, posting in sorted(day_tokens)} for date_key, day_tokens in by_date.items()}
+
+    @classmethod
+    def from_logs(cls, date_keys: list, encrypted_logs: list, decrypted_logs: list) -> 'KeywordIndex':
+        index = cls()
+        for date_key, encrypted_log, log_text in zip(date_keys, encrypted_logs, decrypted_logs):
+            index.add(date_key, encrypted_log, log_text)
+        return index
+
+    @staticmethod
+    def expected_digest(date_keys: list, encrypted_logs: list) -> int:
+        digest = 0
+        for date_key, encrypted_log in zip(date_keys, encrypted_logs):
+            if isinstance(encrypted_log, str) and encrypted_log:
+                digest ^= _log_digest(date_key, encrypted_log)
+        return digest
+
+    def add(self, date_key: str, encrypted_log: str, log_text: str) -> None:
+        """1日分のログを索引に加える"""
+        if not isinstance(encrypted_log, str) or not encrypted_log:
+            return
+        self.digest ^= _log_digest(date_key, encrypted_log)
+        day_tokens = self.by_date.setdefault(date_key, {})
+        for position, (token, count) in enumerate(Counter(KEYWORD_PATTERN.findall(log_text)).items()):
+            self.postings.setdefault(token, {})[date_key] = day_tokens[token] = [count, position]
+
+    def remove(self, date_key: str, encrypted_log: str) -> None:
+        """上書きされる1日分のログを索引から除く"""
+        if not isinstance(encrypted_log, str) or not encrypted_log:
+            return
+        self.digest ^= _log_digest(date_key, encrypted_log)
+        for token in self.by_date.pop(date_key, {}):
+            rows = self.postings[token]
+            del rows[date_key]
+            if not rows:
+                del self.postings[token]
+
+    def counts(self, date_keys) -> Counter:
+        """
+        指定した記録日の範囲での、キーワードごとの出現回数。
+        ログを日付順に走査して数えた場合と同じく、期間内で先に現れたキーワードほど前に並べる（most_common の同数の順序）。
+        """
+        counts = Counter()
+        for date_key in sorted(set(date_keys)):
+            for token, (count, _) in self.by_date.get(date_key, {}).items():
+                counts[token] += count
+        return counts
+
+    def rows(self, word: str, date_keys=None) -> set:
+        """word を含むログの記録日（キーワードの途中に含む場合も数える）。date_keys を渡すとその範囲に絞る"""
+        matched = set()
+        for token, rows in self.postings.items():
+            if word in token:
+                matched.update(rows)
+        return matched if date_keys is None else matched.intersection(date_keys)
+
+def get_keyword_index(user_data_df: pd.DataFrame, data_version: tuple) -> KeywordIndex:
+    """
+    ユーザーのキーワード索引を返す。ログイン後の最初の呼び出しで復号したログから作り、以降はセッション内で再利用する。
+    データのバージョンか内容の指紋が変わった場合は、記録と一致しない（別の端末での編集など）ときだけ作り直す。
+    """
+    key = _session_data_key(data_version, user_data_df)
+    cached = st.session_state.get('keyword_index')
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    date_keys = _date_keys(user_data_df['date'])
+    encrypted_logs = user_data_df['event_log'].tolist()
+    index = cached[1] if cached is not None else None
+    if index is None or index.digest != KeywordIndex.expected_digest(date_keys, encrypted_logs):
+        index = KeywordIndex.from_logs(date_keys, encrypted_logs, st.session_state.enc_manager.decrypt_logs(encrypted_logs))
+    st.session_state.keyword_index = (key, index)
+    return index
+
+# --- E. UIコンポーネント ---
+# 時系列チャートの1系列あたりに描く最大の点数（チャートの横幅のピクセル数の目安）。これを超える分は間引く
+CHART_MAX_POINTS = 1000
+# これを超える点数の系列は、SVG ではなく WebGL（Scattergl）で描画する
+WEBGL_MIN_POINTS = 500
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets で、折れ線の形を保つように残す点の位置を選ぶ。
+    両端の点は必ず残し、間の点を n_out - 2 個のバケツに分け、各バケツから
+    「直前に選んだ点」と「次のバケツの平均点」とで作る三角形の面積が最大の点を1つずつ選ぶ。
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    # 各バケツの平均点（最後のバケツの「次」は終点）
+    next_x = np.append(np.add.reduceat(x[1:n - 1], edges[:-1] - 1) / np.diff(edges), x[-1])[1:]
+    next_y = np.append(np.add.reduceat(y[1:n - 1], edges[:-1] - 1) / np.diff(edges), y[-1])[1:]
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    prev = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        area = np.abs((x[prev] - next_x[i]) * (y[start:end] - y[prev]) - (x[prev] - x[start:end]) * (next_y[i] - y[prev]))
+        prev = start + int(np.argmax(area))
+        selected[i + 1] = prev
+    return selected
+
+def time_series_trace(x, y, max_points: int = CHART_MAX_POINTS, **kwargs):
+    """
+    時系列の折れ線トレースを作る。点数が max_points を超える場合は欠損を除いて LTTB で間引き、
+    WEBGL_MIN_POINTS を超える場合は Scattergl で描画する。
+    """
+    import plotly.graph_objects as go
+    x, y = pd.Index(x), pd.Series(y).to_numpy(dtype=np.float64, na_value=np.nan)
+    if len(y) > max_points:
+        valid = ~np.isnan(y)
+        x, y = x[valid], y[valid]
+        keep = lttb_indices(x.to_numpy(dtype='datetime64[ns]').astype(np.int64).astype(np.float64) if isinstance(x, pd.DatetimeIndex) else x.to_numpy(dtype=np.float64), y, max_points)
+        x, y = x[keep], y[keep]
+    trace_class = go.Scattergl if len(y) > WEBGL_MIN_POINTS else go.Scatter
+    return trace_class(x=x, y=y, **kwargs)
+
+@st.fragment
+def show_rhi_section(df_valid: pd.DataFrame, df_period: pd.DataFrame, selected_period: int, rhi_cache_key: tuple, users_sheet_id: str, user_id: str, alpha: float = DEFAULT_ALPHA):
+    """
+    RHI（リスク許容度の設定・分析結果・感度マップ）と介入の提案のセクション。
+    フラグメントとして描画するため、スライダーを動かしてもこのセクションだけが再実行される。
+    """
+    import plotly.express as px
+    st.markdown("##### あなたのリスク許容度を設定")
+    col1, col2, col3 = st.columns(3)
+    lambda_min, lambda_max, lambda_step = RHI_PARAM_RANGES['lambda']
+    gamma_min, gamma_max, gamma_step = RHI_PARAM_RANGES['gamma']
+    tau_min, tau_max, tau_step = RHI_PARAM_RANGES['tau']
+    lambda_param = col1.slider("変動(不安定さ)へのペナルティ(λ)", lambda_min, lambda_max, 0.5, lambda_step, help="値が大きいほど、日々の幸福度の浮き沈みが激しいことを、より重く評価します。")
+    gamma_param = col2.slider("下振れ(不調)へのペナルティ(γ)", gamma_min, gamma_max, 1.0, gamma_step, help="値が大きいほど、幸福度が低い日が続くことを、より深刻な問題として評価します。")
+    tau_param = col3.slider("「不調」と見なす閾値(τ)", tau_min, tau_max, 0.5, tau_step, help="この値を下回る日を「不調な日」としてカウントします。")
+
+    rhi_engine = get_rhi_engine(df_valid['H'], rhi_cache_key)
+    # スライダーの値は格子点なので、期間ごとに一度だけ計算した RHI の表から引く
+    rhi_surface = get_rhi_surface(rhi_engine, selected_period, rhi_cache_key)
+    rhi_results = rhi_surface.lookup(lambda_param, gamma_param, tau_param)
+    if rhi_results is None:
+        rhi_results = rhi_engine.summary(selected_period, lambda_param, gamma_param, tau_param)
+
+    st.markdown("##### 分析結果")
+    col1a, col2a, col3a, col4a = st.columns(4)
+    col1a.metric("平均調和度 (H̄)", f"{rhi_results['mean_H']:.3f}")
+    col2a.metric("変動リスク (σ)", f"{rhi_results['std_H']:.3f}")
+    col3a.metric("不調日数割合", f"{rhi_results['frac_below']:.1%}")
+    col4a.metric("リスク調整済・幸福指数 (RHI)", f"{rhi_results['RHI']:.3f}", delta=f"{rhi_results['RHI'] - rhi_results['mean_H']:.3f} (平均との差)")
+
+    if rhi_engine.n > selected_period:
+        st.markdown(f"##### RHI の推移（直近{selected_period}日間の移動計算）")
+        rhi_series = rhi_engine.series(selected_period, lambda_param, gamma_param, tau_param)
+        rhi_series.index = pd.to_datetime(df_valid['date']).to_numpy()
+        st.line_chart(rhi_series[['RHI', 'mean_H']])
+
+    with st.expander("▼ リスク許容度の設定で、RHI はどう変わる？（感度マップ）"):
+        st.info(f"現在の閾値 τ = {tau_param:.2f} で、λ と γ を変えた場合の RHI です。色が急に変わる方向ほど、その設定が評価に強く影響しています。")
+        rhi_slice = rhi_surface.slice_at_tau(tau_param)
+        fig_rhi_surface = px.imshow(rhi_slice, x=[f"{v:.1f}" for v in rhi_slice.columns], y=[f"{v:.1f}" for v in rhi_slice.index], origin='lower', aspect="auto", color_continuous_scale='RdYlGn', labels=dict(x="変動へのペナルティ (λ)", y="下振れへのペナルティ (γ)", color="RHI"))
+        st.plotly_chart(fig_rhi_surface, use_container_width=True)
+
+    unlock_achievements('rhi_evaluated', {'rhi': rhi_results['RHI']}, users_sheet_id, user_id)
+
+    if rhi_results['RHI'] < 0.2: 
+        st.error("""
+        **【専門家への相談を検討してください】**\n
+        分析結果によると、あなたの幸福度は持続的に低いか、または非常に不安定な状態にある可能性が示唆されています。
+        もし、この状態が続いて辛いと感じる場合は、一人で抱え込まず、カウンセラーや医師といった専門家に相談することを検討してみてください。
+        """)
+
+    st.markdown("---")
+    st.subheader("🧭 次の航海へのヒント")
+
+    domain_impact = get_domain_impact(df_period, selected_period, alpha, rhi_cache_key)
+    focus_domain, proposal = generate_intervention_proposal(domain_impact, lambda_param, gamma_param, tau_param)
+
+    if focus_domain and proposal:
+        with st.container(border=True):
+            st.markdown(f"分析の結果、今週は特に **{DOMAIN_NAMES_JP_DICT[focus_domain]}** の領域が、あなたの幸福の安定性に影響を与えていたようです。")
+            st.info(f"もしよろしければ、今週は以下の小さなアクションを試してみませんか？")
+
+            for p in proposal:
+                st.button(f"「{p}」を試してみる", use_container_width=True)
+    else:
+        with st.container(border=True):
+            st.info("分析できる十分なデータがないか、全てのドメインが安定しています。素晴らしい航海です！")
+
+@st.cache_resource(max_entries=2)
+def get_sample_dashboard(today: date) -> dict:
+    """
+    サンプルダッシュボードの図を、日付ごとにプロセス全体で一度だけ作る。
+    全ての訪問者で共有するため、乱数はグローバルな状態に触れない専用の Generator で作る。
+    st.plotly_chart は Figure を書き換えずに JSON 化するため、作成済みの Figure をそのまま共有する
+    （dict や JSON で渡すと、表示のたびに Figure としての検証がやり直される）。
+    """
+    import plotly.express as px
+    import plotly.graph_objects as go
+    # サンプル用の架空データを作成（より現実的な相関を持つように調整）
+    rng = np.random.default_rng(0) # 再現性のためのシード固定
+    days = 30
+    dates = pd.to_datetime([today - timedelta(days=i) for i in range(days)][::-1])
     
-    df_dates = df['date'].dropna().unique()
-    df_dates = sorted(list(df_dates), reverse=True)
+    # 健康と余暇・心理に正の相関、経済（仕事の忙しさ）と人間関係に負の相関を持たせる
+    s_health = np.clip(rng.normal(70, 15, days), 0, 100)
+    s_leisure = np.clip(s_health * 0.5 + rng.normal(30, 15, days), 0, 100)
+    s_finance = np.clip(rng.normal(75, 20, days), 0, 100)
+    s_relationships = np.clip(100 - s_finance * 0.6 + rng.normal(0, 20, days), 0, 100)
+
+    sample_data = {
+        'date': dates,
+        'H': np.clip(rng.normal(0.7, 0.15, days), 0, 1),
+        'g_happiness': np.clip(rng.normal(70, 12, days), 0, 100),
+        'q_health': [20]*days, 'q_relationships': [25]*days, 'q_meaning': [20]*days,
+        'q_autonomy': [15]*days, 'q_finance': [10]*days, 'q_leisure': [5]*days, 'q_competition': [5]*days,
+        's_health': s_health,
+        's_relationships': s_relationships,
+        's_meaning': np.clip(rng.normal(80, 15, days), 0, 100),
+        's_autonomy': np.clip(rng.normal(65, 18, days), 0, 100),
+        's_finance': s_finance,
+        's_leisure': s_leisure,
+        's_competition': np.clip(rng.normal(50, 30, days), 0, 100),
+    }
+    df_sample = pd.DataFrame(sample_data)
+    df_sample['U'] = np.clip(rng.normal(0.8, 0.1, days), 0, 1)
+
+    df_plot = df_sample.set_index('date').copy()
+    df_plot['H_scaled'] = df_plot['H'] * 100
+
+    fig_hg = go.Figure()
+    fig_hg.add_trace(go.Scatter(x=df_plot.index, y=df_plot['H_scaled'], mode='lines+markers', name='調和度 (H) - モデルの分析', line=dict(color='blue')))
+    fig_hg.add_trace(go.Scatter(x=df_plot.index, y=df_plot['g_happiness'], mode='lines+markers', name='実感値 (G) - あなたの直感', line=dict(color='green')))
+
+    avg_q = df_sample[Q_COLS].mean().values
+    avg_s = df_sample[S_COLS].mean().values
     
-    today = date.today()
-    streak = 0
+    s_achieved_ratio = avg_s / 100.0
+    s_plot = avg_q * s_achieved_ratio
+
+    fig_radar = go.Figure()
+    fig_radar.add_trace(go.Scatterpolar(r=np.append(s_plot, s_plot[0]), theta=np.append(DOMAIN_NAMES_JP_VALUES, DOMAIN_NAMES_JP_VALUES[0]), fill='toself', name='あなたの経験 (現実の形)', line=dict(color='grey'), fillcolor='rgba(128,128,128,0.3)'))
+    fig_radar.add_trace(go.Scatterpolar(r=np.append(avg_q, avg_q[0]), theta=np.append(DOMAIN_NAMES_JP_VALUES, DOMAIN_NAMES_JP_VALUES[0]), fill='none', name='あなたの価値観 (理想の形)', line=dict(color='blue', dash='dash')))
+    dynamic_range_max = max(40, int(avg_q.max()) + 10)
+    fig_radar.update_layout(polar=dict(radialaxis=dict(visible=True, range=[0, dynamic_range_max])), showlegend=True, legend=dict(yanchor="top", y=1.15, xanchor="left", x=0.01))
+
+    q_norm = avg_q / avg_q.sum() * 100 if avg_q.sum() > 0 else avg_q
+    s_norm = avg_s / avg_s.sum() * 100 if avg_s.sum() > 0 else avg_s
+
+    gap_data = pd.DataFrame({'domain': DOMAIN_NAMES_JP_VALUES, 'gap': q_norm - s_norm}).sort_values('gap', ascending=False)
     
-    # 今日の記録があるか、または昨日の記録があるかで開始日を決める
-    if today in df_dates:
-        expected_date = today
-    elif (today - timedelta(days=1)) in df_dates:
-        expected_date = today - timedelta(days=1)
-        streak = 1 # 昨日は記録しているのでストリークは1から
-    else:
-        return 0
+    fig_bar = px.bar(gap_data, x='gap', y='domain', orientation='h', color='gap', color_continuous_scale='RdBu', color_continuous_midpoint=0, labels={'gap':'ギャップ (%ポイント)', 'domain':''}, title="+: 価値観 > 経験, -: 経験 > 価値観")
+    fig_bar.update_layout(yaxis={'categoryorder':'total ascending'}, title_x=0.5)
 
-    if streak == 0 and today in df_dates:
-        streak = 1
-        expected_date = today - timedelta(days=1)
+    corr_df = df_sample[S_COLS].corr()
+    corr_df.fillna(0, inplace=True)
+    corr_df.columns = DOMAIN_NAMES_JP_VALUES
+    corr_df.index = DOMAIN_NAMES_JP_VALUES
+    
+    fig_heatmap = px.imshow(corr_df, text_auto=True, aspect="auto", color_continuous_scale='RdBu', range_color=[-1, 1], title="相関ヒートマップ：幸福の「相乗効果」と「トレードオフ」")
+    fig_heatmap.update_layout(title_x=0.5)
 
-    for d in df_dates[1:]:
-        if d == expected_date:
-            streak += 1
-            expected_date -= timedelta(days=1)
-        else:
-            break
-            
-    return streak
+    return {'hg': fig_hg, 'radar': fig_radar, 'gap_bar': fig_bar, 'heatmap': fig_heatmap}
 
-# --- E. UIコンポーネント ---
 def show_sample_dashboard():
     """新規ユーザー向けに、ダッシュボードのサンプルを可視化する"""
     st.subheader("📊 このアプリで得られる分析（サンプル）")
     with st.container(border=True):
         st.info("💡 **これはサンプル表示です。** あなたが日々の記録を続けると、あなただけの、パーソナライズされた分析がここに表示されます。")
 
-        # サンプル用の架空データを作成（より現実的な相関を持つように調整）
-        np.random.seed(0) # 再現性のためのシード固定
-        days = 30
-        dates = pd.to_datetime([date.today() - timedelta(days=i) for i in range(days)][::-1])
-        
-        # 健康と余暇・心理に正の相関、経済（仕事の忙しさ）と人間関係に負の相関を持たせる
-        s_health = np.clip(np.random.normal(70, 15, days), 0, 100)
-        s_leisure = np.clip(s_health * 0.5 + np.random.normal(30, 15, days), 0, 100)
-        s_finance = np.clip(np.random.normal(75, 20, days), 0, 100)
-        s_relationships = np.clip(100 - s_finance * 0.6 + np.random.normal(0, 20, days), 0, 100)
-
-        sample_data = {
-            'date': dates,
-            'H': np.clip(np.random.normal(0.7, 0.15, days), 0, 1),
-            'g_happiness': np.clip(np.random.normal(70, 12, days), 0, 100),
-            'q_health': [20]*days, 'q_relationships': [25]*days, 'q_meaning': [20]*days,
-            'q_autonomy': [15]*days, 'q_finance': [10]*days, 'q_leisure': [5]*days, 'q_competition': [5]*days,
-            's_health': s_health,
-            's_relationships': s_relationships,
-            's_meaning': np.clip(np.random.normal(80, 15, days), 0, 100),
-            's_autonomy': np.clip(np.random.normal(65, 18, days), 0, 100),
-            's_finance': s_finance,
-            's_leisure': s_leisure,
-            's_competition': np.clip(np.random.normal(50, 30, days), 0, 100),
-        }
-        df_sample = pd.DataFrame(sample_data)
-        df_sample['U'] = np.clip(np.random.normal(0.8, 0.1, days), 0, 1)
+        sample_figures = get_sample_dashboard(date.today())
 
         # 2つのタブで、提供価値を分かりやすく提示
         tab1_sample, tab2_sample = st.tabs([
@@ -697,60 +2176,26 @@ def show_sample_dashboard():
         with tab1_sample:
             st.markdown("##### 心の航海図：モデルの分析(H) vs あなたの直感(G)")
             st.caption("あなたの日々の幸福度の推移を追い、変動のパターンや、モデルの分析とあなたの直感の『ズレ』を発見できます。")
-            
-            df_plot = df_sample.set_index('date').copy()
-            df_plot['H_scaled'] = df_plot['H'] * 100
-
-            fig_hg = go.Figure()
-            fig_hg.add_trace(go.Scatter(x=df_plot.index, y=df_plot['H_scaled'], mode='lines+markers', name='調和度 (H) - モデルの分析', line=dict(color='blue')))
-            fig_hg.add_trace(go.Scatter(x=df_plot.index, y=df_plot['g_happiness'], mode='lines+markers', name='実感値 (G) - あなたの直感', line=dict(color='green')))
-            st.plotly_chart(fig_hg, use_container_width=True)
+            st.plotly_chart(sample_figures['hg'], use_container_width=True)
 
         with tab2_sample:
-            avg_q = df_sample[Q_COLS].mean().values
-            avg_s = df_sample[S_COLS].mean().values
-            
             col_chart1, col_chart2 = st.columns(2)
             
             with col_chart1:
                 st.markdown("##### 価値観 vs 経験 レーダーチャート")
                 st.caption("「理想（青い線）」と「現実（灰色のエリア）」の形の『ズレ』を一目で把握できます。")
-                
-                s_achieved_ratio = avg_s / 100.0
-                s_plot = avg_q * s_achieved_ratio
-
-                fig_radar = go.Figure()
-                fig_radar.add_trace(go.Scatterpolar(r=np.append(s_plot, s_plot[0]), theta=np.append(DOMAIN_NAMES_JP_VALUES, DOMAIN_NAMES_JP_VALUES[0]), fill='toself', name='あなたの経験 (現実の形)', line=dict(color='grey'), fillcolor='rgba(128,128,128,0.3)'))
-                fig_radar.add_trace(go.Scatterpolar(r=np.append(avg_q, avg_q[0]), theta=np.append(DOMAIN_NAMES_JP_VALUES, DOMAIN_NAMES_JP_VALUES[0]), fill='none', name='あなたの価値観 (理想の形)', line=dict(color='blue', dash='dash')))
-                dynamic_range_max = max(40, int(avg_q.max()) + 10)
-                fig_radar.update_layout(polar=dict(radialaxis=dict(visible=True, range=[0, dynamic_range_max])), showlegend=True, legend=dict(yanchor="top", y=1.15, xanchor="left", x=0.01))
-                st.plotly_chart(fig_radar, use_container_width=True)
+                st.plotly_chart(sample_figures['radar'], use_container_width=True)
 
             with col_chart2:
                 # ★★★ ここに抜け落ちていた棒グラフを追加 ★★★
                 st.markdown("##### 価値観-経験 ギャップ分析 (棒グラフ)")
                 st.caption("プラスは「課題」、マイナスは「強みや見直しのヒント」を示唆します。")
-
-                q_norm = avg_q / avg_q.sum() * 100 if avg_q.sum() > 0 else avg_q
-                s_norm = avg_s / avg_s.sum() * 100 if avg_s.sum() > 0 else avg_s
-
-                gap_data = pd.DataFrame({'domain': DOMAIN_NAMES_JP_VALUES, 'gap': q_norm - s_norm}).sort_values('gap', ascending=False)
-                
-                fig_bar = px.bar(gap_data, x='gap', y='domain', orientation='h', color='gap', color_continuous_scale='RdBu', color_continuous_midpoint=0, labels={'gap':'ギャップ (%ポイント)', 'domain':''}, title="+: 価値観 > 経験, -: 経験 > 価値観")
-                fig_bar.update_layout(yaxis={'categoryorder':'total ascending'}, title_x=0.5)
-                st.plotly_chart(fig_bar, use_container_width=True)
+                st.plotly_chart(sample_figures['gap_bar'], use_container_width=True)
 
         st.markdown("---")
         st.markdown("##### さらに、こんな詳細分析も可能です")
         st.caption("各要素が互いにどう影響し合っているか、その隠れた関係性を可視化します。")
-        corr_df = df_sample[S_COLS].corr()
-        corr_df.fillna(0, inplace=True)
-        corr_df.columns = DOMAIN_NAMES_JP_VALUES
-        corr_df.index = DOMAIN_NAMES_JP_VALUES
-        
-        fig_heatmap = px.imshow(corr_df, text_auto=True, aspect="auto", color_continuous_scale='RdBu', range_color=[-1, 1], title="相関ヒートマップ：幸福の「相乗効果」と「トレードオフ」")
-        fig_heatmap.update_layout(title_x=0.5)
-        st.plotly_chart(fig_heatmap, use_container_width=True)
+        st.plotly_chart(sample_figures['heatmap'], use_container_width=True)
 def show_welcome_and_guide():
     st.header("ようこそ、Harmony Navigatorへ")
     st.subheader("あなたのための、内省支援ツール")
@@ -987,6 +2432,12 @@ def migrate_and_ensure_schema(df: pd.DataFrame, user_id: str, sheet_id: str) ->
                 st.error("スキーマ更新の保存に失敗しました。")
         except Exception as e:
             st.warning(f"スキーマ更新の保存中にエラーが発生しました: {e}")
+    else:
+        # 派生指標が保存されていない（または計算式が古い）記録だけを計算して保存し、次回以降の再計算を省く
+        # 同じ日付の記録が重複している行は、アップサートで1行にまとめられてしまうため対象外にする
+        stale_metrics = _stale_metrics_mask(df_migrated) & ~_normalize_key_frame('data', df_migrated).duplicated(keep=False).to_numpy()
+        if stale_metrics.any():
+            upsert_data('data', sheet_id, df_migrated[stale_metrics])
     
     final_order = [col for col in EXPECTED_COLUMNS if col in df_migrated.columns] + [c for c in df_migrated.columns if c not in EXPECTED_COLUMNS]
     return df_migrated[final_order]
@@ -1039,23 +2490,13 @@ def run_wizard_interface(container):
 
                 if st.button("✅ この価値観で航海を始める"):
                     user_id = st.session_state.user_id
-                    all_data_df = read_data('data', st.secrets["connections"]["gsheets"]["data_sheet_id"])
                     
                     new_record = {'user_id': user_id, 'date': date.today(), 'record_timestamp': datetime.now(JST)}
                     new_record.update({f'q_{d}': v for d, v in st.session_state.q_values.items()})
                     new_df_row = pd.DataFrame([new_record])
 
-                    all_data_df_updated = pd.concat([all_data_df, new_df_row], ignore_index=True)
-
-                    # ★★★ TypeError バグ修正：並べ替えの前にデータ型を統一 ★★★
-                    if 'date' in all_data_df_updated.columns:
-                        all_data_df_updated['date'] = pd.to_datetime(all_data_df_updated['date'], errors='coerce')
-                    if 'record_timestamp' in all_data_df_updated.columns:
-                        all_data_df_updated['record_timestamp'] = pd.to_datetime(all_data_df_updated['record_timestamp'], errors='coerce')
-                    
-                    all_data_df_updated = all_data_df_updated.sort_values(by=['user_id', 'date', 'record_timestamp']).reset_index(drop=True)
-
-                    if write_data('data', st.secrets["connections"]["gsheets"]["data_sheet_id"], all_data_df_updated):
+                    # 価値観の記録は、既存の行には触れずに末尾へ追加する
+                    if append_data('data', get_sheet_ids()[1], new_df_row):
                         st.session_state.auth_status = "AWAITING_DEMOGRAPHICS"
                         st.success("価値観を保存しました。次に、任意でプロフィール情報をご登録ください。")
                         time.sleep(1)
@@ -1076,7 +2517,7 @@ def run_demographics_interface(container):
         """)
         
         with st.form("profile_form_onboarding"):
-            users_df_for_profile = read_data('users', st.secrets["connections"]["gsheets"]["users_sheet_id"])
+            users_df_for_profile = read_data('users', get_sheet_ids()[0])
             user_info = users_df_for_profile[users_df_for_profile['user_id'] == st.session_state.user_id]
             current_profile = user_info.iloc[0] if not user_info.empty else pd.Series()
             
@@ -1098,7 +2539,7 @@ def run_demographics_interface(container):
                 skip_submitted = st.form_submit_button("⏩ 今は回答しない（スキップ）", use_container_width=True)
 
             if profile_submitted:
-                users_df_update = read_data('users', st.secrets["connections"]["gsheets"]["users_sheet_id"])
+                users_df_update = read_data('users', get_sheet_ids()[0])
                 # 全てのプロフィール項目を更新
                 users_df_update.loc[users_df_update['user_id'] == st.session_state.user_id, 'age_group'] = age_group
                 users_df_update.loc[users_df_update['user_id'] == st.session_state.user_id, 'gender'] = gender
@@ -1110,7 +2551,7 @@ def run_demographics_interface(container):
                 users_df_update.loc[users_df_update['user_id'] == st.session_state.user_id, 'chronic_illness'] = chronic_illness
                 users_df_update.loc[users_df_update['user_id'] == st.session_state.user_id, 'country'] = country
                 
-                if write_data('users', st.secrets["connections"]["gsheets"]["users_sheet_id"], users_df_update):
+                if write_data('users', get_sheet_ids()[0], users_df_update):
                     st.session_state.auth_status = "INITIALIZING_SESSION"
                     st.success("ご協力ありがとうございます！メイン画面に移動します。")
                     time.sleep(1)
@@ -1194,8 +2635,7 @@ def main():
     st.caption('v7.0.59 - Final Complete Code with All Fixes & Refinements')
     
     try:
-        users_sheet_id = st.secrets["connections"]["gsheets"]["users_sheet_id"]
-        data_sheet_id = st.secrets["connections"]["gsheets"]["data_sheet_id"]
+        users_sheet_id, data_sheet_id = get_sheet_ids()
     except KeyError:
         st.error("SecretsにスプレッドシートID (`users_sheet_id`, `data_sheet_id`) が設定されていません。")
         st.stop()
@@ -1445,10 +2885,9 @@ def main():
 
     elif auth_status == "CHECKING_USER_DATA":
         user_id = st.session_state.user_id
-        all_data_df = read_data('data', data_sheet_id)
-        if not all_data_df.empty and 'user_id' in all_data_df.columns and user_id in all_data_df['user_id'].values:
-            user_data_df = all_data_df[all_data_df['user_id'] == user_id].copy()
-            user_data_df = migrate_and_ensure_schema(user_data_df, user_id, data_sheet_id)
+        user_data_df = read_user_data('data', data_sheet_id, user_id)
+        if not user_data_df.empty:
+            user_data_df = migrate_and_ensure_schema(user_data_df.copy(), user_id, data_sheet_id)
             
             has_q_data = not user_data_df[Q_COLS].dropna(how='all').empty
             if not has_q_data:
@@ -1465,8 +2904,7 @@ def main():
 
     elif auth_status == "INITIALIZING_SESSION":
         user_id = st.session_state.user_id
-        all_data_df = read_data('data', data_sheet_id)
-        user_data_df = all_data_df[all_data_df['user_id'] == user_id].copy()
+        user_data_df = read_user_data('data', data_sheet_id, user_id).copy()
         
         if 'record_timestamp' in user_data_df.columns:
             user_data_df['record_timestamp'] = pd.to_datetime(user_data_df['record_timestamp'], errors='coerce')
@@ -1479,25 +2917,31 @@ def main():
             latest_q_row = q_data_rows.sort_values(by='record_timestamp', ascending=False).iloc[0]
             
             latest_q_dict = latest_q_row[Q_COLS].to_dict()
-            st.session_state.q_values = {key.replace('q_', ''): int(val) for key, val in latest_q_dict.items() if isinstance(val, (int, float)) and pd.notna(val)}
+            st.session_state.q_values = {key.replace('q_', ''): int(val) for key, val in latest_q_dict.items() if isinstance(val, (int, float, np.number)) and pd.notna(val)}
         
+        load_achievements(users_sheet_id, user_id, user_data_df)
         st.session_state.auth_status = "LOGGED_IN_UNLOCKED"
         st.rerun()
 
     elif auth_status == "LOGGED_IN_UNLOCKED":
         user_id = st.session_state.user_id
         
-        all_data_df = read_data('data', data_sheet_id)
-        user_data_df = all_data_df[all_data_df['user_id'] == user_id].copy()
+        # 指標のキャッシュのキーに使うため、読み込む前のデータのバージョンを控えておく
+        user_data_version = get_data_version('data', data_sheet_id, user_id)
+        user_data_df = read_user_data('data', data_sheet_id, user_id).copy()
 
         # ★★★ ゲーミフィケーション：ストリーク計算 ★★★
-        st.session_state.record_streak = calculate_streak(user_data_df)
+        streak_history = get_streak_history(user_data_df, user_data_version)
+        st.session_state.record_streak = streak_history.current(date.today())
             
         st.sidebar.header(f"ようこそ、{user_id} さん！")
         # ★★★ ゲーミフィケーション：ストリーク表示 ★★★
         st.sidebar.metric("🔥 連続記録日数", f"{st.session_state.record_streak} 日")
+        st.sidebar.caption(f"これまでの最長記録: {streak_history.longest()} 日")
 
         if st.sidebar.button("🚪 ログアウト（下船する）"):
+            if st.session_state.enc_manager is not None:
+                st.session_state.enc_manager.wipe_cache()
             for key in list(st.session_state.keys()):
                 del st.session_state[key]
             st.rerun()
@@ -1538,148 +2982,156 @@ def main():
             st.subheader("📜 法的情報")
             show_legal_documents()
 
-        tab1, tab2, tab3 = st.tabs(["**✍️ 今日の記録**", "**📊 ダッシュボード**", "**🔧 設定とガイド**"])
+        # 開いているタブの中身だけを実行する（記録の入力中にダッシュボードを計算しない）
+        tab1, tab2, tab3 = st.tabs(["**✍️ 今日の記録**", "**📊 ダッシュボード**", "**🔧 設定とガイド**"], key='main_tab', on_change='rerun')
 
         with tab1:
-            st.header(f"✍️ 今日の航海日誌を記録する")
-            container = st.container(border=True)
-            container.markdown("##### 記録する日付")
-            today = date.today()
-            target_date = container.date_input("記録する日付:", value=today, min_value=today - timedelta(days=365), max_value=today, label_visibility="collapsed")
+            if tab1.open:
+                st.header(f"✍️ 今日の航海日誌を記録する")
+                container = st.container(border=True)
+                container.markdown("##### 記録する日付")
+                today = date.today()
+                target_date = container.date_input("記録する日付:", value=today, min_value=today - timedelta(days=365), max_value=today, label_visibility="collapsed")
             
-            is_already_recorded = False
-            if not user_data_df.empty and 'date' in user_data_df.columns:
-                date_match = user_data_df[user_data_df['date'] == target_date]
-                if not date_match.empty and pd.notna(date_match.iloc[0].get('g_happiness')):
-                    is_already_recorded = True
+                is_already_recorded = False
+                if not user_data_df.empty and 'date' in user_data_df.columns:
+                    date_match = user_data_df[user_data_df['date'] == target_date]
+                    if not date_match.empty and pd.notna(date_match.iloc[0].get('g_happiness')):
+                        is_already_recorded = True
             
-            if is_already_recorded:
-                container.warning(f"⚠️ {target_date.strftime('%Y-%m-%d')} のデータは既に記録されています。保存すると上書きされます。")
+                if is_already_recorded:
+                    container.warning(f"⚠️ {target_date.strftime('%Y-%m-%d')} のデータは既に記録されています。保存すると上書きされます。")
 
-            container.markdown("##### 記録モード")
-            input_mode = container.radio("記録モード:", ('🚀 クイック・ログ (ドメイン別評価)', '🔬 ディープ・ダイブ (詳細項目評価)'), horizontal=True)
+                container.markdown("##### 記録モード")
+                input_mode = container.radio("記録モード:", ('🚀 クイック・ログ (ドメイン別評価)', '🔬 ディープ・ダイブ (詳細項目評価)'), horizontal=True)
             
-            with st.form(key='daily_input_form'):
-                s_element_values = {}
-                s_domain_values = {}
-
-                if 'クイック' in input_mode:
-                    mode_string = 'quick'
-                    st.info("今日一日を振り返り、7つの幸福の領域が、それぞれどれくらい満たされていたかを評価してください。")
-                    for domain in DOMAINS:
-                        st.markdown(f"**{DOMAIN_NAMES_JP_DICT[domain]}**")
-                        with st.expander("▼ このドメインには、どんな「材料」が含まれる？"):
-                            for element in LONG_ELEMENTS[domain]:
-                                st.markdown(f"- **{element}**: {ELEMENT_DEFINITIONS.get(element, '')}")
-                        s_domain_values['s_' + domain] = st.slider(label=f"slider_{domain}", min_value=0, max_value=100, value=50, key=f"s_{domain}", label_visibility="collapsed")
-                        st.caption(CAPTION_TEXT)
-                else:
-                    mode_string = 'deep'
-                    col1, col2 = st.columns(2)
-                    latest_s_elements = pd.Series(dtype=float)
-                    if not user_data_df.empty:
-                        sortable_df_deep = user_data_df.dropna(subset=['date']).sort_values(by='date', ascending=False)
-                        if not sortable_df_deep.empty:
-                            latest_s_elements = sortable_df_deep.iloc[0]
-
-                    for i, domain in enumerate(DOMAINS):
-                        container = col1 if i < 4 else col2
-                        with container:
-                            with st.expander(f"**{DOMAIN_NAMES_JP_DICT[domain]}**", expanded=True):
+                with st.form(key='daily_input_form'):
+                    s_element_values = {}
+                    s_domain_values = {}
+
+                    if 'クイック' in input_mode:
+                        mode_string = 'quick'
+                        st.info("今日一日を振り返り、7つの幸福の領域が、それぞれどれくらい満たされていたかを評価してください。")
+                        for domain in DOMAINS:
+                            st.markdown(f"**{DOMAIN_NAMES_JP_DICT[domain]}**")
+                            with st.expander("▼ このドメインには、どんな「材料」が含まれる？"):
                                 for element in LONG_ELEMENTS[domain]:
-                                    col_name = f's_element_{element}'
-                                    val = latest_s_elements.get(col_name, 50)
-                                    default_val = 50 if pd.isna(val) else int(val)
+                                    st.markdown(f"- **{element}**: {ELEMENT_DEFINITIONS.get(element, '')}")
+                            s_domain_values['s_' + domain] = st.slider(label=f"slider_{domain}", min_value=0, max_value=100, value=50, key=f"s_{domain}", label_visibility="collapsed")
+                            st.caption(CAPTION_TEXT)
+                    else:
+                        mode_string = 'deep'
+                        col1, col2 = st.columns(2)
+                        latest_s_elements = pd.Series(dtype=float)
+                        if not user_data_df.empty:
+                            sortable_df_deep = user_data_df.dropna(subset=['date']).sort_values(by='date', ascending=False)
+                            if not sortable_df_deep.empty:
+                                latest_s_elements = sortable_df_deep.iloc[0]
+
+                        for i, domain in enumerate(DOMAINS):
+                            container = col1 if i < 4 else col2
+                            with container:
+                                with st.expander(f"**{DOMAIN_NAMES_JP_DICT[domain]}**", expanded=True):
+                                    for element in LONG_ELEMENTS[domain]:
+                                        col_name = f's_element_{element}'
+                                        val = latest_s_elements.get(col_name, 50)
+                                        default_val = 50 if pd.isna(val) else int(val)
                                     
-                                    st.markdown(f"**{element}**")
-                                    st.caption(ELEMENT_DEFINITIONS.get(element, ""))
-                                    score = st.slider(label=f"slider_{col_name}", min_value=0, max_value=100, value=default_val, key=col_name, label_visibility="collapsed")
-                                    st.caption(CAPTION_TEXT)
-                                    s_element_values[col_name] = int(score)
-
-                st.markdown('**総合的な幸福感 (Gt)**')
-                with st.expander("▼ これはなぜ必要？"): st.markdown(EXPANDER_TEXTS['g_t'])
-                g_happiness = st.slider(label="slider_g_happiness", min_value=0, max_value=100, value=50, label_visibility="collapsed")
-                st.caption(CAPTION_TEXT)
+                                        st.markdown(f"**{element}**")
+                                        st.caption(ELEMENT_DEFINITIONS.get(element, ""))
+                                        score = st.slider(label=f"slider_{col_name}", min_value=0, max_value=100, value=default_val, key=col_name, label_visibility="collapsed")
+                                        st.caption(CAPTION_TEXT)
+                                        s_element_values[col_name] = int(score)
+
+                    st.markdown('**総合的な幸福感 (Gt)**')
+                    with st.expander("▼ これはなぜ必要？"): st.markdown(EXPANDER_TEXTS['g_t'])
+                    g_happiness = st.slider(label="slider_g_happiness", min_value=0, max_value=100, value=50, label_visibility="collapsed")
+                    st.caption(CAPTION_TEXT)
                 
-                st.markdown('**今日の出来事や気づきは？（あなたのパスワードで暗号化されます）**')
-                with st.expander("▼ なぜ書くのがおすすめ？"): st.markdown(EXPANDER_TEXTS['event_log'])
-                event_log = st.text_area('', height=100, label_visibility="collapsed")
+                    st.markdown('**今日の出来事や気づきは？（あなたのパスワードで暗号化されます）**')
+                    with st.expander("▼ なぜ書くのがおすすめ？"): st.markdown(EXPANDER_TEXTS['event_log'])
+                    event_log = st.text_area('', height=100, label_visibility="collapsed")
                 
-                st.markdown("---")
-                submitted = st.form_submit_button('💾 今日の航海日誌を保存する', use_container_width=True)
+                    st.markdown("---")
+                    submitted = st.form_submit_button('💾 今日の航海日誌を保存する', use_container_width=True)
                 
-                if submitted:
-                    if sum(st.session_state.q_values.values()) != 100:
-                        st.error('価値観 (q_t) の合計が100になっていません。サイドバーを確認してください。')
-                    else:
-                        # --- ★★★ ここからが、あなたの分析に基づく、新しい安全な保存ロジックです ★★★ ---
-                        
-                        # 1. 保存する新しいレコードを準備する
-                        new_record = {}
-                        if mode_string == 'deep':
-                            new_record.update({col: pd.NA for col in ALL_ELEMENT_COLS})
-                            new_record.update(s_element_values)
-                            s_domain_scores = calculate_s_domains_from_row(pd.Series(new_record))
-                            new_record.update(s_domain_scores.to_dict())
-                        else: # quick
-                            new_record.update(s_domain_values)
-
-                        encrypted_log = st.session_state.enc_manager.encrypt_log(event_log)
-                        
-                        users_df_in_form = read_data('users', users_sheet_id)
-                        user_info_in_form = users_df_in_form[users_df_in_form['user_id'] == user_id]
-                        consent_status = user_info_in_form['consent'].iloc[0] if not user_info_in_form.empty and 'consent' in user_info_in_form.columns else False
-
-                        new_record.update({
-                            'user_id': user_id, 
-                            'date': target_date,
-                            'record_timestamp': datetime.now(JST), # 本物のタイムスタンプを必ず付与
-                            'mode': mode_string,
-                            'consent': consent_status,
-                            'g_happiness': int(g_happiness), 
-                            'event_log': encrypted_log
-                        })
-                        new_record.update({f'q_{d}': v for d, v in st.session_state.q_values.items()})
-
-                        new_df_row = pd.DataFrame([new_record])
-
-                        # 2. 既存の全データを読み込む
-                        try:
-                            df_existing = read_data('data', data_sheet_id)
-                        except Exception as e:
-                            st.warning(f"既存データの読み込みに失敗しました。新しいデータのみで保存を試みます。エラー: {e}")
-                            df_existing = pd.DataFrame()
-
-                        # 3. 安全なマージ処理（「同じユーザー」かつ「同じ日付」の行だけを置換）
-                        if df_existing.empty:
-                            df_to_write = new_df_row
+                    if submitted:
+                        if sum(st.session_state.q_values.values()) != 100:
+                            st.error('価値観 (q_t) の合計が100になっていません。サイドバーを確認してください。')
                         else:
-                            # 既存データから、今回保存するユーザーと日付に一致する行を"除く"
-                            # これにより、他ユーザーのデータや、同じ日付でもuser_idが異なる行（デバッグ行など）を保護する
-                            condition_to_remove = (df_existing['user_id'] == user_id) & (pd.to_datetime(df_existing['date']).dt.date == target_date)
-                            df_preserved = df_existing[~condition_to_remove]
-                            
-                            # 除外したデータフレームに、新しいレコードを追加する
-                            df_to_write = pd.concat([df_preserved, new_df_row], ignore_index=True)
-
-                        # 4. 書き込み前の最終的なデータ型統一と並べ替え
-                        if 'date' in df_to_write.columns:
-                            df_to_write['date'] = pd.to_datetime(df_to_write['date'], errors='coerce')
-                        if 'record_timestamp' in df_to_write.columns:
-                            df_to_write['record_timestamp'] = pd.to_datetime(df_to_write['record_timestamp'], errors='coerce')
-
-                        df_to_write = df_to_write.sort_values(by=['user_id', 'date', 'record_timestamp']).reset_index(drop=True)
+                            # --- ★★★ ここからが、あなたの分析に基づく、新しい安全な保存ロジックです ★★★ ---
                         
-                        # 5. データベースへの書き込みとキャッシュのクリア
-                        if write_data('data', data_sheet_id, df_to_write):
-                            st.success(f'{target_date.strftime("%Y-%m-%d")} の記録を永続的に保存しました！')
-                            st.balloons()
-                            time.sleep(1)
-                            st.rerun() # 再実行して最新のデータを表示
-                        else:
-                             st.error("データの保存に失敗しました。後でもう一度お試しください。")
+                            # 1. 保存する新しいレコードを準備する
+                            new_record = {}
+                            if mode_string == 'deep':
+                                new_record.update({col: pd.NA for col in ALL_ELEMENT_COLS})
+                                new_record.update(s_element_values)
+                                s_domain_scores = calculate_s_domains(pd.DataFrame([new_record])).iloc[0]
+                                new_record.update({col: int(v) if pd.notna(v) else v for col, v in s_domain_scores.items()})
+                            else: # quick
+                                new_record.update(s_domain_values)
+
+                            encrypted_log = st.session_state.enc_manager.encrypt_log(event_log)
+                        
+                            users_df_in_form = read_data('users', users_sheet_id)
+                            user_info_in_form = users_df_in_form[users_df_in_form['user_id'] == user_id]
+                            consent_status = user_info_in_form['consent'].iloc[0] if not user_info_in_form.empty and 'consent' in user_info_in_form.columns else False
+
+                            new_record.update({
+                                'user_id': user_id, 
+                                'date': target_date,
+                                'record_timestamp': datetime.now(JST), # 本物のタイムスタンプを必ず付与
+                                'mode': mode_string,
+                                'consent': consent_status,
+                                'g_happiness': int(g_happiness), 
+                                'event_log': encrypted_log
+                            })
+                            new_record.update({f'q_{d}': v for d, v in st.session_state.q_values.items()})
+
+                            new_df_row = pd.DataFrame([new_record])
+                            same_date = (user_data_df['date'] == target_date) if not user_data_df.empty else pd.Series(dtype=bool)
+                            replaced_rows = user_data_df[same_date].dropna(subset=['g_happiness']) if not user_data_df.empty else user_data_df
+
+                            # 2. 「同じユーザー」かつ「同じ日付」の行だけを、その行の位置で置換（無ければ末尾に追加）
+                            if upsert_data('data', data_sheet_id, new_df_row):
+                                # 3. ズレの統計を、保存した記録の分だけ更新する（users テーブルへの書き込みは 7. でまとめて行う）
+                                state_updates = {}
+                                # H は保存される値と同じ桁に丸め、履歴から作り直した統計（digest）と一致させる
+                                new_h = calculate_metrics(new_df_row, alpha=DEFAULT_ALPHA, recompute_all=True)['H'].round(STORED_METRIC_DECIMALS).iloc[0]
+                                replaced_gaps = [] if replaced_rows.empty else (replaced_rows['g_happiness'].astype(np.float64) - calculate_metrics(replaced_rows, alpha=DEFAULT_ALPHA)['H'] * 100.0).tolist()
+                                st.session_state.gap_stats = update_gap_stats_on_save(st.session_state.get('gap_stats'), target_date, g_happiness - new_h * 100.0, replaced_gaps)
+                                if st.session_state.gap_stats is not None:
+                                    state_updates['gap_stats'] = st.session_state.gap_stats.to_json()
+                                # 4. 連続記録のランに保存した日付を加え、書き込み後のデータに対応づける
+                                #    （書き込み後のデータは、再実行時にも同じバージョンのキャッシュから読み込まれる）
+                                saved_data_key = _session_data_key(get_data_version('data', data_sheet_id, user_id), read_user_data('data', data_sheet_id, user_id))
+                                streak_history.add(target_date)
+                                st.session_state.streak_history = (saved_data_key, streak_history)
+                                # 5. キーワード索引から上書きした日のログを除き、保存したログを加える
+                                keyword_index = st.session_state.get('keyword_index')
+                                if keyword_index is not None and keyword_index[0] == _session_data_key(user_data_version, user_data_df):
+                                    keyword_index = keyword_index[1]
+                                    date_key = _date_keys([target_date])[0]
+                                    for old_log in (user_data_df.loc[same_date, 'event_log'].tolist() if not user_data_df.empty else []):
+                                        keyword_index.remove(date_key, old_log)
+                                    keyword_index.add(date_key, encrypted_log, event_log)
+                                    st.session_state.keyword_index = (saved_data_key, keyword_index)
+                                # 6. 保存した1件だけで、記録に関する実績を判定する
+                                record_count = len(user_data_df) - int(same_date.sum()) + 1
+                                unlock_achievements('record_saved', _achievement_context(new_df_row, record_count, streak_history.current(date.today())), users_sheet_id, user_id, state_updates)
+                                # 7. 更新したユーザーごとの状態を、users テーブルの自分の行に1回で書き込む
+                                if state_updates:
+                                    update_user_state(users_sheet_id, user_id, state_updates)
+                                st.success(f'{target_date.strftime("%Y-%m-%d")} の記録を永続的に保存しました！')
+                                st.balloons()
+                                time.sleep(1)
+                                st.rerun() # 再実行して最新のデータを表示
+                            else:
+                                 st.error("データの保存に失敗しました。後でもう一度お試しください。")
         with tab2:
+            if tab2.open:
+                    import plotly.express as px
+                    import plotly.graph_objects as go
                     st.header('📊 あなたの航海チャート')
                     with st.expander("▼ このチャートの見方", expanded=True):
                         st.info("""
@@ -1693,7 +3145,7 @@ def main():
                     if df_to_process.dropna(subset=Q_COLS, how='all').empty:
                         st.info('まだ記録がありません。まずは「今日の記録」タブから、最初の日誌を記録してみましょう！')
                     else:
-                        df_processed = calculate_metrics(df_to_process, alpha=0.6)
+                        df_processed = get_user_metrics(df_to_process, user_id, user_data_version, alpha=DEFAULT_ALPHA)
                         if 'date' in df_processed.columns:
                             df_processed['date'] = pd.to_datetime(df_processed['date'])
                             df_processed = df_processed.sort_values('date')
@@ -1707,65 +3159,33 @@ def main():
                             valid_periods = [p for p in period_options if len(df_processed.dropna(subset=['H'])) >= p]
                             default_index = len(valid_periods) - 1 if valid_periods else 0
                             selected_period = st.selectbox("分析期間を選択してください（日）:", valid_periods, index=default_index)
-                            df_period = df_processed.dropna(subset=['H', 'g_happiness']).tail(selected_period)
-        
-                            st.markdown("##### あなたのリスク許容度を設定")
-                            col1, col2, col3 = st.columns(3)
-                            lambda_param = col1.slider("変動(不安定さ)へのペナルティ(λ)", 0.0, 2.0, 0.5, 0.1, help="値が大きいほど、日々の幸福度の浮き沈みが激しいことを、より重く評価します。")
-                            gamma_param = col2.slider("下振れ(不調)へのペナルティ(γ)", 0.0, 2.0, 1.0, 0.1, help="値が大きいほど、幸福度が低い日が続くことを、より深刻な問題として評価します。")
-                            tau_param = col3.slider("「不調」と見なす閾値(τ)", 0.0, 1.0, 0.5, 0.05, help="この値を下回る日を「不調な日」としてカウントします。")
-        
-                            rhi_results = calculate_rhi_metrics(df_period, lambda_param, gamma_param, tau_param)
-        
-                            st.markdown("##### 分析結果")
-                            col1a, col2a, col3a, col4a = st.columns(4)
-                            col1a.metric("平均調和度 (H̄)", f"{rhi_results['mean_H']:.3f}")
-                            col2a.metric("変動リスク (σ)", f"{rhi_results['std_H']:.3f}")
-                            col3a.metric("不調日数割合", f"{rhi_results['frac_below']:.1%}")
-                            col4a.metric("リスク調整済・幸福指数 (RHI)", f"{rhi_results['RHI']:.3f}", delta=f"{rhi_results['RHI'] - rhi_results['mean_H']:.3f} (平均との差)")
-                            
-                            check_achievements(df_period, rhi_results, st.session_state.record_streak)
-        
-                            if rhi_results['RHI'] < 0.2: 
-                                st.error("""
-                                **【専門家への相談を検討してください】**\n
-                                分析結果によると、あなたの幸福度は持続的に低いか、または非常に不安定な状態にある可能性が示唆されています。
-                                もし、この状態が続いて辛いと感じる場合は、一人で抱え込まず、カウンセラーや医師といった専門家に相談することを検討してみてください。
-                                """)
-                            
-                            st.markdown("---")
-                            st.subheader("🧭 次の航海へのヒント")
-        
-                            focus_domain, proposal = generate_intervention_proposal(df_period, rhi_results)
-        
-                            if focus_domain and proposal:
-                                with st.container(border=True):
-                                    st.markdown(f"分析の結果、今週は特に **{DOMAIN_NAMES_JP_DICT[focus_domain]}** の領域が、あなたの幸福の安定性に影響を与えていたようです。")
-                                    st.info(f"もしよろしければ、今週は以下の小さなアクションを試してみませんか？")
-                                    
-                                    for p in proposal:
-                                        st.button(f"「{p}」を試してみる", use_container_width=True)
-                            else:
-                                with st.container(border=True):
-                                    st.info("分析できる十分なデータがないか、全てのドメインが安定しています。素晴らしい航海です！")
+                            df_valid = df_processed.dropna(subset=['H', 'g_happiness'])
+                            df_period = df_valid.tail(selected_period)
         
+                            # 指標のキャッシュと同じく、データのバージョンと内容の指紋の両方で RHI の計算結果を対応づける
+                            rhi_cache_key = (user_id, user_data_version, _data_fingerprint(user_data_df), DEFAULT_ALPHA)
+                            show_rhi_section(df_valid, df_period, selected_period, rhi_cache_key, users_sheet_id, user_id, alpha=DEFAULT_ALPHA)
+
                         else:
                             st.info(f"現在{len(df_processed.dropna(subset=['H']))}日分の有効なデータがあります。期間分析（RHIなど）には最低7日分のデータが必要です。")
         
                         if not df_processed.empty:
-                            analyze_discrepancy(df_processed)
+                            gap_stats = get_gap_stats(users_sheet_id, user_id, df_processed)
+                            analyze_discrepancy(df_processed, gap_stats)
                             
                             st.markdown("---")
                             st.subheader("🗺️ あなたの心の航海図")
         
-                            df_plot = df_period.set_index('date').copy()
+                            # 全期間の表示では、長い履歴の系列を time_series_trace が間引き、WebGL で描く
+                            show_full_history = len(df_processed) > len(df_period) and st.toggle("全期間を表示する", key='chart_full_history')
+                            df_plot = (df_processed if show_full_history else df_period).set_index('date').copy()
                             df_plot['H_scaled'] = df_plot['H'] * 100
                             
                             st.markdown("##### 心の天気図：モデルの分析(H) vs あなたの直感(G)")
                             
                             fig_hg = go.Figure()
-                            fig_hg.add_trace(go.Scatter(x=df_plot.index, y=df_plot['H_scaled'], mode='lines+markers', name='調和度 (H) - モデルの分析', line=dict(color='blue')))
-                            fig_hg.add_trace(go.Scatter(x=df_plot.index, y=df_plot['g_happiness'], mode='lines+markers', name='実感値 (G) - あなたの直感', line=dict(color='green')))
+                            fig_hg.add_trace(time_series_trace(df_plot.index, df_plot['H_scaled'], mode='lines+markers', name='調和度 (H) - モデルの分析', line=dict(color='blue')))
+                            fig_hg.add_trace(time_series_trace(df_plot.index, df_plot['g_happiness'], mode='lines+markers', name='実感値 (G) - あなたの直感', line=dict(color='green')))
                             st.plotly_chart(fig_hg, use_container_width=True)
         
                             if len(df_plot) > 1:
@@ -1780,16 +3200,20 @@ def main():
                                     """)
                                 
                                 df_plot['insight_gap'] = df_plot['g_happiness'] - df_plot['H_scaled']
-                                gap_mean = df_plot['insight_gap'].mean()
-                                gap_std = df_plot['insight_gap'].std()
+                                # 平常範囲は、保存時に更新しているズレの統計（全期間）から読む
+                                gap_mean = gap_stats.mean
+                                gap_std = gap_stats.std
                                 upper_band = gap_mean + 1.5 * gap_std
                                 lower_band = gap_mean - 1.5 * gap_std
         
+                                # 期間全体で一定の帯と平均線は、点の配列ではなく横線・帯の図形（shape）で描く
                                 fig_gap = go.Figure()
-                                fig_gap.add_trace(go.Scatter(x=df_plot.index, y=[upper_band]*len(df_plot), fill=None, mode='lines', line_color='rgba(128,128,128,0.2)', name='平常範囲の上限'))
-                                fig_gap.add_trace(go.Scatter(x=df_plot.index, y=[lower_band]*len(df_plot), fill='tonexty', mode='lines', line_color='rgba(128,128,128,0.2)', name='平常範囲の下限'))
-                                fig_gap.add_trace(go.Scatter(x=df_plot.index, y=[gap_mean]*len(df_plot), mode='lines', line=dict(dash='dash', color='grey'), name='あなたの「心のクセ」(平均)'))
-                                fig_gap.add_trace(go.Scatter(x=df_plot.index, y=df_plot['insight_gap'], mode='lines+markers', name='日々のズレ (G-H)', line=dict(color='black')))
+                                fig_gap.update_layout(shapes=[
+                                    dict(type='rect', xref='paper', x0=0, x1=1, y0=lower_band, y1=upper_band, fillcolor='rgba(128,128,128,0.2)', line_width=0, layer='below', name='平常範囲', showlegend=True),
+                                    dict(type='line', xref='paper', x0=0, x1=1, y0=gap_mean, y1=gap_mean, line=dict(dash='dash', color='grey'), name='あなたの「心のクセ」(平均)', showlegend=True),
+                                    dict(type='line', xref='paper', x0=0, x1=1, y0=gap_stats.ew_mean, y1=gap_stats.ew_mean, line=dict(dash='dot', color='orange'), name='最近の「心のクセ」(直近を重視した平均)', showlegend=True),
+                                ])
+                                fig_gap.add_trace(time_series_trace(df_plot.index, df_plot['insight_gap'], mode='lines+markers', name='日々のズレ (G-H)', line=dict(color='black')))
                                 
                                 st.plotly_chart(fig_gap, use_container_width=True)
                             
@@ -1877,19 +3301,17 @@ def main():
                                     あなたの日記（イベントログ）からキーワードを抽出し、その言葉が記録された日の幸福度が、全体の平均と比べてどれだけ高かったか（または低かったか）をランキングします。
                                     """)
                                 
-                                df_period_logs = df_period.copy()
-                                df_period_logs['event_log'] = df_period_logs['event_log'].apply(st.session_state.enc_manager.decrypt_log)
+                                keyword_index = get_keyword_index(user_data_df, user_data_version)
+                                period_keys = _date_keys(df_period['date'])
+                                h_by_date = pd.Series(df_period['H'].to_numpy(dtype=np.float64), index=period_keys)
                                 
                                 word_impact = {}
-                                mean_h_total = df_period_logs['H'].mean()
-                                
-                                df_period_logs['words'] = df_period_logs['event_log'].str.findall(r'[\wぁ-んァ-ン一-龥ー]+')
-                                all_words = [word for sublist in df_period_logs['words'].dropna() for word in sublist]
+                                mean_h_total = h_by_date.mean()
                                 
-                                common_words = [word for word, count in Counter(all_words).most_common(10) if len(word) > 1]
+                                common_words = [word for word, count in keyword_index.counts(period_keys).most_common(10) if len(word) > 1]
         
                                 for word in common_words:
-                                    impact_days_h = df_period_logs[df_period_logs['event_log'].str.contains(word, na=False)]['H'].mean()
+                                    impact_days_h = h_by_date[list(keyword_index.rows(word, period_keys))].mean()
                                     impact = impact_days_h - mean_h_total
                                     word_impact[word] = impact
         
@@ -1911,132 +3333,134 @@ def main():
                                 st.line_chart(df_period.set_index('date')['gap_U'])
         
                             st.markdown("---")
-                            st.subheader('📖 全記録データ')
-                            df_display = user_data_df.copy()
-                            if 'event_log' in df_display.columns:
-                                df_display['event_log'] = df_display['event_log'].apply(st.session_state.enc_manager.decrypt_log)
-                                df_display.rename(columns={'event_log': 'イベントログ（復号済）'}, inplace=True)
-                            st.dataframe(df_display.drop(columns=['user_id'], errors='ignore').sort_values(by='date', ascending=False).round(3))
+                            # 全記録の復号と表は、開いたときだけ作る
+                            records_expander = st.expander('📖 全記録データ', key='records_expander', on_change='rerun')
+                            if records_expander.open:
+                                with records_expander:
+                                    df_display = user_data_df.copy()
+                                    if 'event_log' in df_display.columns:
+                                        df_display['event_log'] = st.session_state.enc_manager.decrypt_logs(df_display['event_log'].tolist())
+                                        df_display.rename(columns={'event_log': 'イベントログ（復号済）'}, inplace=True)
+                                    st.dataframe(df_display.drop(columns=['user_id'], errors='ignore').sort_values(by='date', ascending=False).round(3))
 
         
         with tab3:
-            st.header("🔧 設定とガイド")
-            st.subheader("🏆 アチーブメント（実績）")
-            with st.container(border=True):
-                st.markdown("あなたの航海の記録です。")
-                unlocked_count = len(st.session_state.unlocked_achievements)
-                total_count = len(ACHIEVEMENTS)
-                st.progress(unlocked_count / total_count, text=f"{unlocked_count} / {total_count} 個 達成")
+            if tab3.open:
+                st.header("🔧 設定とガイド")
+                st.subheader("🏆 アチーブメント（実績）")
+                with st.container(border=True):
+                    st.markdown("あなたの航海の記録です。")
+                    unlocked_count = len(st.session_state.unlocked_achievements)
+                    total_count = len(ACHIEVEMENTS)
+                    st.progress(unlocked_count / total_count, text=f"{unlocked_count} / {total_count} 個 達成")
                 
-                cols = st.columns(4)
-                sorted_achievements = sorted(ACHIEVEMENTS.items(), key=lambda item: item[0])
+                    cols = st.columns(4)
+                    sorted_achievements = sorted(ACHIEVEMENTS.items(), key=lambda item: item[0])
                 
-                for i, (ach_id, details) in enumerate(sorted_achievements):
-                    col = cols[i % 4]
-                    if ach_id in st.session_state.unlocked_achievements:
-                        col.markdown(f"**{details['emoji']} {details['name']}**")
-                        col.caption(details['description'])
-                    else:
-                        col.markdown(f"**❔ ロック中**")
-                        col.caption("達成条件：？？？")
-            st.markdown("---")
+                    for i, (ach_id, details) in enumerate(sorted_achievements):
+                        col = cols[i % 4]
+                        if ach_id in st.session_state.unlocked_achievements:
+                            col.markdown(f"**{details['emoji']} {details['name']}**")
+                            col.caption(details['description'])
+                        else:
+                            col.markdown(f"**❔ ロック中**")
+                            col.caption("達成条件：？？？")
+                st.markdown("---")
             
-            with st.container(border=True):
-                st.subheader("🔒 プライバシー設定")
-                users_df_privacy = read_data('users', users_sheet_id)
-                user_info_privacy = users_df_privacy[users_df_privacy['user_id'] == user_id]
-                current_consent = user_info_privacy['consent'].iloc[0] if not user_info_privacy.empty and 'consent' in user_info_privacy.columns else False
+                with st.container(border=True):
+                    st.subheader("🔒 プライバシー設定")
+                    users_df_privacy = read_data('users', users_sheet_id)
+                    user_info_privacy = users_df_privacy[users_df_privacy['user_id'] == user_id]
+                    current_consent = user_info_privacy['consent'].iloc[0] if not user_info_privacy.empty and 'consent' in user_info_privacy.columns else False
                 
-                new_consent = st.checkbox("匿名化された数値データを学術研究に利用することに同意する", value=current_consent)
-                if new_consent != current_consent:
-                    users_df_privacy.loc[users_df_privacy['user_id'] == user_id, 'consent'] = new_consent
-                    if write_data('users', users_sheet_id, users_df_privacy):
-                        st.success("研究協力への同意状況を更新しました。")
-                    else:
-                        st.error("設定の保存に失敗しました。")
+                    new_consent = st.checkbox("匿名化された数値データを学術研究に利用することに同意する", value=current_consent)
+                    if new_consent != current_consent:
+                        users_df_privacy.loc[users_df_privacy['user_id'] == user_id, 'consent'] = new_consent
+                        if write_data('users', users_sheet_id, users_df_privacy):
+                            st.success("研究協力への同意状況を更新しました。")
+                        else:
+                            st.error("設定の保存に失敗しました。")
 
 
-            with st.container(border=True):
-                st.subheader("👤 プロフィール情報（研究協力用）")
-                with st.form("profile_form"):
-                    users_df_for_profile = read_data('users', users_sheet_id)
-                    user_info = users_df_for_profile[users_df_for_profile['user_id'] == user_id]
-                    current_profile = user_info.iloc[0] if not user_info.empty else pd.Series()
+                with st.container(border=True):
+                    st.subheader("👤 プロフィール情報（研究協力用）")
+                    with st.form("profile_form"):
+                        users_df_for_profile = read_data('users', users_sheet_id)
+                        user_info = users_df_for_profile[users_df_for_profile['user_id'] == user_id]
+                        current_profile = user_info.iloc[0] if not user_info.empty else pd.Series()
                     
-                    # 全てのプロフィール項目を追加
-                    age_group = st.selectbox("年代", options=DEMOGRAPHIC_OPTIONS['age_group'], index=get_safe_index(DEMOGRAPHIC_OPTIONS['age_group'], current_profile.get('age_group')))
-                    gender = st.selectbox("性別", options=DEMOGRAPHIC_OPTIONS['gender'], index=get_safe_index(DEMOGRAPHIC_OPTIONS['gender'], current_profile.get('gender')))
-                    occupation_category = st.selectbox("職業", options=DEMOGRAPHIC_OPTIONS['occupation_category'], index=get_safe_index(DEMOGRAPHIC_OPTIONS['occupation_category'], current_profile.get('occupation_category')))
-                    income_range = st.selectbox("年収", options=DEMOGRAPHIC_OPTIONS['income_range'], index=get_safe_index(DEMOGRAPHIC_OPTIONS['income_range'], current_profile.get('income_range')))
-                    marital_status = st.selectbox("婚姻状況", options=DEMOGRAPHIC_OPTIONS['marital_status'], index=get_safe_index(DEMOGRAPHIC_OPTIONS['marital_status'], current_profile.get('marital_status')))
-                    has_children = st.selectbox("子供の有無", options=DEMOGRAPHIC_OPTIONS['has_children'], index=get_safe_index(DEMOGRAPHIC_OPTIONS['has_children'], current_profile.get('has_children')))
-                    living_situation = st.selectbox("居住形態", options=DEMOGRAPHIC_OPTIONS['living_situation'], index=get_safe_index(DEMOGRAPHIC_OPTIONS['living_situation'], current_profile.get('living_situation')))
-                    chronic_illness = st.selectbox("慢性疾患", options=DEMOGRAPHIC_OPTIONS['chronic_illness'], index=get_safe_index(DEMOGRAPHIC_OPTIONS['chronic_illness'], current_profile.get('chronic_illness')))
-                    country = st.selectbox("国", options=DEMOGRAPHIC_OPTIONS['country'], index=get_safe_index(DEMOGRAPHIC_OPTIONS['country'], current_profile.get('country')))
+                        # 全てのプロフィール項目を追加
+                        age_group = st.selectbox("年代", options=DEMOGRAPHIC_OPTIONS['age_group'], index=get_safe_index(DEMOGRAPHIC_OPTIONS['age_group'], current_profile.get('age_group')))
+                        gender = st.selectbox("性別", options=DEMOGRAPHIC_OPTIONS['gender'], index=get_safe_index(DEMOGRAPHIC_OPTIONS['gender'], current_profile.get('gender')))
+                        occupation_category = st.selectbox("職業", options=DEMOGRAPHIC_OPTIONS['occupation_category'], index=get_safe_index(DEMOGRAPHIC_OPTIONS['occupation_category'], current_profile.get('occupation_category')))
+                        income_range = st.selectbox("年収", options=DEMOGRAPHIC_OPTIONS['income_range'], index=get_safe_index(DEMOGRAPHIC_OPTIONS['income_range'], current_profile.get('income_range')))
+                        marital_status = st.selectbox("婚姻状況", options=DEMOGRAPHIC_OPTIONS['marital_status'], index=get_safe_index(DEMOGRAPHIC_OPTIONS['marital_status'], current_profile.get('marital_status')))
+                        has_children = st.selectbox("子供の有無", options=DEMOGRAPHIC_OPTIONS['has_children'], index=get_safe_index(DEMOGRAPHIC_OPTIONS['has_children'], current_profile.get('has_children')))
+                        living_situation = st.selectbox("居住形態", options=DEMOGRAPHIC_OPTIONS['living_situation'], index=get_safe_index(DEMOGRAPHIC_OPTIONS['living_situation'], current_profile.get('living_situation')))
+                        chronic_illness = st.selectbox("慢性疾患", options=DEMOGRAPHIC_OPTIONS['chronic_illness'], index=get_safe_index(DEMOGRAPHIC_OPTIONS['chronic_illness'], current_profile.get('chronic_illness')))
+                        country = st.selectbox("国", options=DEMOGRAPHIC_OPTIONS['country'], index=get_safe_index(DEMOGRAPHIC_OPTIONS['country'], current_profile.get('country')))
                     
-                    profile_submitted = st.form_submit_button("プロフィールを保存する", use_container_width=True)
-
-                    if profile_submitted:
-                        users_df_update = read_data('users', users_sheet_id)
-                        # 全てのプロフィール項目を更新
-                        users_df_update.loc[users_df_update['user_id'] == user_id, 'age_group'] = age_group
-                        users_df_update.loc[users_df_update['user_id'] == user_id, 'gender'] = gender
-                        users_df_update.loc[users_df_update['user_id'] == user_id, 'occupation_category'] = occupation_category
-                        users_df_update.loc[users_df_update['user_id'] == user_id, 'income_range'] = income_range
-                        users_df_update.loc[users_df_update['user_id'] == user_id, 'marital_status'] = marital_status
-                        users_df_update.loc[users_df_update['user_id'] == user_id, 'has_children'] = has_children
-                        users_df_update.loc[users_df_update['user_id'] == user_id, 'living_situation'] = living_situation
-                        users_df_update.loc[users_df_update['user_id'] == user_id, 'chronic_illness'] = chronic_illness
-                        users_df_update.loc[users_df_update['user_id'] == user_id, 'country'] = country
+                        profile_submitted = st.form_submit_button("プロフィールを保存する", use_container_width=True)
+
+                        if profile_submitted:
+                            users_df_update = read_data('users', users_sheet_id)
+                            # 全てのプロフィール項目を更新
+                            users_df_update.loc[users_df_update['user_id'] == user_id, 'age_group'] = age_group
+                            users_df_update.loc[users_df_update['user_id'] == user_id, 'gender'] = gender
+                            users_df_update.loc[users_df_update['user_id'] == user_id, 'occupation_category'] = occupation_category
+                            users_df_update.loc[users_df_update['user_id'] == user_id, 'income_range'] = income_range
+                            users_df_update.loc[users_df_update['user_id'] == user_id, 'marital_status'] = marital_status
+                            users_df_update.loc[users_df_update['user_id'] == user_id, 'has_children'] = has_children
+                            users_df_update.loc[users_df_update['user_id'] == user_id, 'living_situation'] = living_situation
+                            users_df_update.loc[users_df_update['user_id'] == user_id, 'chronic_illness'] = chronic_illness
+                            users_df_update.loc[users_df_update['user_id'] == user_id, 'country'] = country
                         
-                        if write_data('users', users_sheet_id, users_df_update):
-                            st.success("プロフィール情報を更新しました！")
-                            time.sleep(1)
-                            st.rerun()
-                        else:
-                            st.error("プロフィールの保存に失敗しました。")
+                            if write_data('users', users_sheet_id, users_df_update):
+                                st.success("プロフィール情報を更新しました！")
+                                time.sleep(1)
+                                st.rerun()
+                            else:
+                                st.error("プロフィールの保存に失敗しました。")
 
-            with st.container(border=True):
-                st.subheader("📥 データのエクスポート")
-                if not user_data_df.empty:
-                    df_export = user_data_df.copy()
-                    if 'event_log' in df_export.columns:
-                        df_export['event_log_decrypted'] = df_export['event_log'].apply(st.session_state.enc_manager.decrypt_log)
+                with st.container(border=True):
+                    st.subheader("📥 データのエクスポート")
+                    if not user_data_df.empty:
+                        df_export = user_data_df.copy()
+                        if 'event_log' in df_export.columns:
+                            df_export['event_log_decrypted'] = st.session_state.enc_manager.decrypt_logs(df_export['event_log'].tolist())
                     
-                    csv_export = df_export.to_csv(index=False).encode('utf-8')
-                    st.download_button(label="📥 全データをCSV形式でダウンロード", data=csv_export, file_name=f'harmony_data_{user_id}.csv', use_container_width=True)
+                        csv_export = df_export.to_csv(index=False).encode('utf-8')
+                        st.download_button(label="📥 全データをCSV形式でダウンロード", data=csv_export, file_name=f'harmony_data_{user_id}.csv', use_container_width=True)
 
-            with st.container(border=True):
-                st.subheader("🗑️ アカウント削除")
-                with st.form("delete_form"):
-                    st.warning("この操作は取り消せません。アカウントを削除すると、関連する全てのデータが完全に消去されます。")
-                    password_for_delete = st.text_input("パスワードを入力してください", type="password")
-                    delete_submitted = st.form_submit_button("本当にアカウントと全データを完全に削除する", type="primary", use_container_width=True)
-
-                    if delete_submitted:
-                        users_df_to_delete = read_data('users', users_sheet_id)
-                        user_record = users_df_to_delete[users_df_to_delete['user_id'] == user_id]
-                        if not user_record.empty and EncryptionManager.check_password(password_for_delete, user_record.iloc[0]['password_hash']):
-                            users_df_updated = users_df_to_delete[users_df_to_delete['user_id'] != user_id]
-                            if write_data('users', users_sheet_id, users_df_updated):
-                                all_data_df_to_delete = read_data('data', data_sheet_id)
-                                all_data_df_updated = all_data_df_to_delete[all_data_df_to_delete['user_id'] != user_id]
-                                if write_data('data', data_sheet_id, all_data_df_updated):
-                                    for key in list(st.session_state.keys()):
-                                        del st.session_state[key]
-                                    st.success("アカウントと関連する全てのデータを削除しました。")
-                                    time.sleep(2)
-                                    st.rerun()
+                with st.container(border=True):
+                    st.subheader("🗑️ アカウント削除")
+                    with st.form("delete_form"):
+                        st.warning("この操作は取り消せません。アカウントを削除すると、関連する全てのデータが完全に消去されます。")
+                        password_for_delete = st.text_input("パスワードを入力してください", type="password")
+                        delete_submitted = st.form_submit_button("本当にアカウントと全データを完全に削除する", type="primary", use_container_width=True)
+
+                        if delete_submitted:
+                            users_df_to_delete = read_data('users', users_sheet_id)
+                            user_record = users_df_to_delete[users_df_to_delete['user_id'] == user_id]
+                            if not user_record.empty and EncryptionManager.check_password(password_for_delete, user_record.iloc[0]['password_hash']):
+                                if delete_user_data('users', users_sheet_id, user_id):
+                                    if delete_user_data('data', data_sheet_id, user_id):
+                                        st.session_state.enc_manager.wipe_cache()
+                                        for key in list(st.session_state.keys()):
+                                            del st.session_state[key]
+                                        st.success("アカウントと関連する全てのデータを削除しました。")
+                                        time.sleep(2)
+                                        st.rerun()
+                                    else:
+                                        st.error("データシートからのユーザーデータ削除に失敗しました。")
                                 else:
-                                    st.error("データシートからのユーザーデータ削除に失敗しました。")
+                                     st.error("ユーザーシートからのアカウント削除に失敗しました。")
                             else:
-                                 st.error("ユーザーシートからのアカウント削除に失敗しました。")
-                        else:
-                            st.error("パスワードが間違っています。")
+                                st.error("パスワードが間違っています。")
             
-            st.markdown("---")
-            st.subheader("このアプリについて")
-            show_welcome_and_guide()
+                st.markdown("---")
+                st.subheader("このアプリについて")
+                show_welcome_and_guide()
         
 if __name__ == '__main__':
     main()
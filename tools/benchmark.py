@@ -0,0 +1,293 @@
+"""
+コア計算のマイクロベンチマーク。
+
+tools/synthetic_data.py で作った N 人 × M 日の合成データに対して、指標の計算・RHI・連続記録・
+ズレの統計・介入の提案・暗号化・キーワード索引の各処理を計測し、サイズごとの実行時間（中央値・最小値）と
+ピークメモリ（tracemalloc）を表示する。calculate_metrics は、行数（--metrics-rows）ごとの規模でも計測し、
+--reference-max-rows 以下の行数では、行ごとに計算していた元の実装（tools/check_metrics_parity.py。scipy が必要）とも比べる。
+イベントログの暗号化・復号は、--crypto-logs 件の日誌でスループット（MB/s）を、1バイトずつ XOR していた元の実装と比べる。
+シートのセル値の変換（_decode_values）は、--decode-rows 行ごとに1万行あたりの時間を、get_all_records の行ごとの dict から
+1列ずつ to_numeric で変換していた元の実装と比べる。同じ行数で、元の実装が返すテーブルと、それを compact_data_frame で
+圧縮したテーブルのメモリ使用量（memory_usage(deep=True)）も比べる。
+結果は JSON に保存し、--compare で以前の結果と比べられる。
+
+使い方（リポジトリのルートで）:
+    python tools/benchmark.py                                 # 既定のサイズで計測し、bench_results/<コミット>.json に保存
+    python tools/benchmark.py --sizes 1x365,200x365 --repeat 7
+    python tools/benchmark.py --sizes '' --metrics-rows 1000,100000 --reference-max-rows 100000
+    python tools/benchmark.py --sizes '' --metrics-rows '' --crypto-logs 0 --decode-rows 10000,100000
+    python tools/benchmark.py --compare bench_results/abc1234.json
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import check_metrics_parity  # noqa: E402
+import synthetic_data  # noqa: E402
+from synthetic_data import app  # noqa: E402
+
+# Streamlit の実行環境の外で UI 関数を呼ぶため、その警告ログを抑える。
+# 設定は最初の st 呼び出しで読み込まれ、そのときログレベルが戻されるので、先に読み込ませておく
+app.st.config.get_option('logger.level')
+app.st.logger.set_log_level('error')
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SIZES = '1x30,1x365,1x1825,100x365'
+DEFAULT_METRICS_ROWS = '1000,100000,1000000'
+# 元の実装も計測する最大の行数（元の実装は 1,000 行で約1秒、10万行では2分近くかかる）
+DEFAULT_REFERENCE_MAX_ROWS = 1000
+# 暗号化のスループットの計測に使う日誌の件数
+DEFAULT_CRYPTO_LOGS = 10000
+# セル値の変換を計測する行数（元の実装は1万行で約1秒かかる）
+DEFAULT_DECODE_ROWS = '10000'
+# ダッシュボードの最長の分析期間と、RHI のスライダーの既定値
+PERIOD = 90
+RHI_PARAMS = (0.5, 1.0, 0.5)
+
+def _cases(df_table: pd.DataFrame, df_user: pd.DataFrame, password: str) -> dict:
+    """
+    計測する処理の一覧（名前 -> 引数なしの関数）。
+    キャッシュの効果を含めないよう、各関数は呼ばれるたびに必要なオブジェクトを作り直す。
+    """
+    df_valid = df_user.dropna(subset=['H', 'g_happiness'])
+    df_period = df_valid.tail(PERIOD)
+    h_values = df_valid['H'].to_numpy()
+    date_keys = app._date_keys(df_user['date'])
+    encrypted_logs = df_user['event_log'].tolist()
+    decrypted_logs = app.EncryptionManager(password).decrypt_logs(encrypted_logs)
+    raw_table = df_table.drop(columns=app.METRIC_COLS + app.METRICS_META_COLS)
+    raw_user = df_user.drop(columns=app.METRIC_COLS + app.METRICS_META_COLS)
+
+    def keyword_ranking():
+        index = app.KeywordIndex.from_logs(date_keys, encrypted_logs, decrypted_logs)
+        period_keys = date_keys[-PERIOD:]
+        return [index.rows(word, period_keys) for word, _ in index.counts(period_keys).most_common(10)]
+
+    def gap_analysis():
+        stats = app.GapStats.from_history(df_valid)
+        app.analyze_discrepancy(df_user, stats)
+
+    def rolling_rhi():
+        engine = app.RollingRHI(h_values)
+        engine.summary(PERIOD, *RHI_PARAMS)
+        engine.series(PERIOD, *RHI_PARAMS)
+
+    return {
+        'calculate_metrics (table, raw)': lambda: app.calculate_metrics(raw_table, recompute_all=True),
+        'calculate_metrics (user, raw)': lambda: app.calculate_metrics(raw_user, recompute_all=True),
+        'calculate_metrics (user, stored)': lambda: app.calculate_metrics(df_user),
+        'calculate_rhi_metrics (90d)': lambda: app.calculate_rhi_metrics(df_period, *RHI_PARAMS),
+        'RollingRHI summary+series': rolling_rhi,
+        'RollingRHI sweep (90d)': lambda: app.RollingRHI(h_values).sweep(PERIOD, *(app.RHI_PARAM_GRIDS[k] for k in ('lambda', 'gamma', 'tau'))),
+        'StreakHistory build+current': lambda: app.StreakHistory(df_user['date']).current(df_user['date'].iloc[-1]),
+        'GapStats+analyze_discrepancy': gap_analysis,
+        'DomainImpact+proposal (90d)': lambda: app.generate_intervention_proposal(app.DomainImpact(df_period), *RHI_PARAMS),
+        'encrypt_logs': lambda: app.EncryptionManager(password).encrypt_logs(decrypted_logs),
+        'decrypt_logs (cold)': lambda: app.EncryptionManager(password).decrypt_logs(encrypted_logs),
+        'KeywordIndex build+ranking': keyword_ranking,
+    }
+
+def measure(func, repeat: int) -> dict:
+    """repeat 回の実行時間（ミリ秒）と、別の1回で計測したピークメモリ（KiB）を返す"""
+    func()  # 初回だけ発生する遅延 import などを除く
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'median_ms': statistics.median(timings), 'min_ms': min(timings), 'peak_kib': peak / 1024}
+
+def git_revision() -> str:
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--', 'app.py'], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        return revision + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def _metrics_cases(n_rows: int, seed: int, reference_max_rows: int) -> dict:
+    """calculate_metrics を n_rows 行で計測する処理の一覧（合成データを n_rows 行になるまで繰り返す）"""
+    base = synthetic_data.generate_data(20, 365, seed=seed, encrypt=False)
+    df_stored = pd.concat([base] * -(-n_rows // len(base)), ignore_index=True).iloc[:n_rows]
+    df_raw = df_stored.drop(columns=app.METRIC_COLS + app.METRICS_META_COLS)
+    cases = {
+        'calculate_metrics (raw)': lambda: app.calculate_metrics(df_raw, recompute_all=True),
+        # 保存済みの S, U を再利用し、H だけを計算し直す
+        'calculate_metrics (stored, alpha 0.3)': lambda: app.calculate_metrics(df_stored, alpha=0.3),
+    }
+    if n_rows <= reference_max_rows:
+        score_cols = [c for c in app.NUMERIC_COLS if c in df_raw.columns]
+        df_reference_input = df_raw.astype({c: np.float64 for c in score_cols})
+        cases['reference per-row (before)'] = lambda: check_metrics_parity.reference_calculate_metrics(df_reference_input, app.DEFAULT_ALPHA)
+    return cases
+
+def _reference_xor(key: bytes, data: bytes) -> bytes:
+    """元の実装：1バイトずつ鍵と XOR する"""
+    return bytes([b ^ key[i % len(key)] for i, b in enumerate(data)])
+
+def _crypto_cases(n_logs: int, seed: int) -> tuple:
+    """暗号化のスループットを計測する処理の一覧と、平文の UTF-8 での合計バイト数を返す"""
+    rng = np.random.default_rng(seed)
+    logs = ['、'.join(rng.choice(synthetic_data.LOG_PHRASES, int(rng.integers(1, 30)))) for _ in range(n_logs)]
+    password = synthetic_data.user_password('benchmark')
+    encrypted_logs = app.EncryptionManager(password).encrypt_logs(logs)
+    warm_manager = app.EncryptionManager(password)
+    warm_manager.decrypt_logs(encrypted_logs)
+    key = warm_manager.key
+    cases = {
+        'encrypt_logs': lambda: app.EncryptionManager(password).encrypt_logs(logs),
+        'decrypt_logs (cold)': lambda: app.EncryptionManager(password).decrypt_logs(encrypted_logs),
+        'decrypt_logs (cached)': lambda: warm_manager.decrypt_logs(encrypted_logs),
+        'reference per-byte encrypt (before)': lambda: [base64.b64encode(_reference_xor(key, log.encode('utf-8'))).decode('utf-8') for log in logs],
+        'reference per-byte decrypt (before)': lambda: [_reference_xor(key, base64.b64decode(log.encode('utf-8'))).decode('utf-8') for log in encrypted_logs],
+    }
+    # 比べる2つの実装の結果が一致していることを、計測の前に確かめる
+    if cases['encrypt_logs']() != cases['reference per-byte encrypt (before)']() or cases['decrypt_logs (cold)']() != logs:
+        raise RuntimeError('暗号化・復号の結果が元の実装と一致しません')
+    return cases, sum(len(log.encode('utf-8')) for log in logs)
+
+def _reference_decode(header: list, rows: list) -> pd.DataFrame:
+    """元の実装：get_all_records と同じく行ごとの dict にしてから、日付と数値の列を1列ずつ変換する"""
+    from gspread.utils import numericise_all, to_records
+    df = pd.DataFrame(to_records(header, [numericise_all(row) for row in rows]))
+    df['date'] = pd.to_datetime(df['date'], errors='coerce').dt.date
+    df['record_timestamp'] = pd.to_datetime(df['record_timestamp'], errors='coerce')
+    for col in [c for c in app.NUMERIC_COLS + app.STORED_METRIC_COLS if c in df.columns]:
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+    return df
+
+def _decode_input(n_rows: int, seed: int) -> tuple:
+    """n_rows 行の合成データを、シートから読み込んだセル値（get_all_values と同じ形式）の見出しと行にする"""
+    base = synthetic_data.generate_data(20, 365, seed=seed, encrypt=False)
+    df = pd.concat([base] * -(-n_rows // len(base)), ignore_index=True).iloc[:n_rows]
+    cells = app._serialize_table('data', df)
+    return list(cells.columns), cells.values.tolist()
+
+def _decode_cases(header: list, rows: list) -> dict:
+    """セル値を n_rows 行のテーブルに変換する処理の一覧"""
+    cases = {
+        '_decode_values': lambda: app._decode_values(header, rows),
+        'reference get_all_records (before)': lambda: _reference_decode(header, rows),
+    }
+    # 比べる2つの実装の結果が一致していることを、計測の前に確かめる
+    decoded, expected = cases['_decode_values'](), cases['reference get_all_records (before)']()
+    numeric_cols = app.NUMERIC_COLS + app.STORED_METRIC_COLS
+    if not (np.allclose(decoded[numeric_cols].to_numpy(dtype=np.float64, na_value=np.nan), expected[numeric_cols].to_numpy(dtype=np.float64, na_value=np.nan), equal_nan=True)
+            and (decoded['date'].to_numpy() == expected['date'].to_numpy()).all()):
+        raise RuntimeError('セル値の変換の結果が元の実装と一致しません')
+    return cases
+
+def _measure_memory(results: list, size: str, header: list, rows: list) -> None:
+    """元の実装が返すテーブルと、それを compact_data_frame で圧縮したテーブルのメモリ使用量を比べる"""
+    raw = _reference_decode(header, rows)
+    frames = {'memory raw table (before)': raw, 'memory compact_data_frame': app.compact_data_frame(raw.copy())}
+    raw_kib = raw.memory_usage(deep=True).sum() / 1024
+    for name, df in frames.items():
+        result = {'size': size, 'case': name, 'rows': len(df), 'memory_kib': df.memory_usage(deep=True).sum() / 1024}
+        results.append(result)
+        print(f"{size:>9}  {name:<38} {len(df):>7} 行  メモリ {result['memory_kib']:>9.0f} KiB（元の {result['memory_kib'] / raw_kib:.0%}）", flush=True)
+
+def _measure_case(results: list, size: str, name: str, rows: int, func, repeat: int, payload_bytes: int = None, per_10k_rows: bool = False) -> None:
+    result = {'size': size, 'case': name, 'rows': rows, **measure(func, repeat)}
+    throughput = ''
+    if payload_bytes is not None:
+        result['mb_per_s'] = payload_bytes / 1e6 / (result['median_ms'] / 1000)
+        throughput = f"  {result['mb_per_s']:>7.1f} MB/s"
+    if per_10k_rows:
+        result['ms_per_10k_rows'] = result['median_ms'] * 10000 / rows
+        throughput = f"  {result['ms_per_10k_rows']:>7.2f} ms/1万行"
+    results.append(result)
+    print(f"{size:>9}  {name:<38} {rows:>7} 行  {result['median_ms']:>9.2f} ms (最小 {result['min_ms']:.2f})  ピーク {result['peak_kib']:>9.0f} KiB{throughput}", flush=True)
+
+def run(sizes: list, metrics_rows: list, decode_rows: list, crypto_logs: int, repeat: int, seed: int, reference_max_rows: int) -> list:
+    results = []
+    for n_users, n_days in sizes:
+        df_table = synthetic_data.generate_data(n_users, n_days, seed=seed)
+        # ユーザー単位の処理は、記録が最も多いユーザーで計測する
+        user_id = df_table['user_id'].value_counts().idxmax()
+        df_user = df_table[df_table['user_id'] == user_id].reset_index(drop=True)
+        for name, func in _cases(df_table, df_user, synthetic_data.user_password(user_id)).items():
+            rows = len(df_table) if '(table' in name else len(df_user)
+            _measure_case(results, f"{n_users}x{n_days}", name, rows, func, repeat)
+    for n_rows in metrics_rows:
+        for name, func in _metrics_cases(n_rows, seed, reference_max_rows).items():
+            _measure_case(results, f"{n_rows}r", name, n_rows, func, repeat)
+    for n_rows in decode_rows:
+        header, rows = _decode_input(n_rows, seed)
+        for name, func in _decode_cases(header, rows).items():
+            _measure_case(results, f"{n_rows}r", name, n_rows, func, repeat, per_10k_rows=True)
+        _measure_memory(results, f"{n_rows}r", header, rows)
+    if crypto_logs:
+        cases, payload_bytes = _crypto_cases(crypto_logs, seed)
+        for name, func in cases.items():
+            _measure_case(results, f"{crypto_logs}logs", name, crypto_logs, func, repeat, payload_bytes)
+    return results
+
+def compare(results: list, baseline_path: str) -> None:
+    """以前の結果と、同じサイズ・同じ処理の中央値を比べて表示する"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    before = {(r['size'], r['case']): r for r in baseline['results']}
+    print(f"\n比較: {baseline['meta']['revision']} -> 今回（中央値, 比率 < 1 が高速化）")
+    for r in results:
+        old = before.get((r['size'], r['case']))
+        if old is None:
+            continue
+        if 'memory_kib' in r:
+            print(f"{r['size']:>9}  {r['case']:<38} メモリ {old['memory_kib']:.0f} -> {r['memory_kib']:.0f} KiB  x{r['memory_kib'] / old['memory_kib']:.2f}")
+            continue
+        print(f"{r['size']:>9}  {r['case']:<38} {old['median_ms']:>9.2f} -> {r['median_ms']:>9.2f} ms  x{r['median_ms'] / old['median_ms']:.2f}"
+              f"   ピーク {old['peak_kib']:.0f} -> {r['peak_kib']:.0f} KiB")
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='ユーザー数x日数 をカンマ区切りで指定（例: 1x365,100x365）')
+    parser.add_argument('--metrics-rows', default=DEFAULT_METRICS_ROWS, help='calculate_metrics を計測する行数をカンマ区切りで指定')
+    parser.add_argument('--reference-max-rows', type=int, default=DEFAULT_REFERENCE_MAX_ROWS, help='元の実装も計測する最大の行数')
+    parser.add_argument('--decode-rows', default=DEFAULT_DECODE_ROWS, help='セル値の変換を計測する行数をカンマ区切りで指定')
+    parser.add_argument('--crypto-logs', type=int, default=DEFAULT_CRYPTO_LOGS, help='暗号化のスループットを計測する日誌の件数（0 で省略）')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='結果の保存先（既定: bench_results/<コミット>.json）')
+    parser.add_argument('--compare', help='比較する以前の結果の JSON')
+    args = parser.parse_args()
+
+    sizes = [tuple(int(v) for v in size.split('x')) for size in args.sizes.split(',') if size]
+    metrics_rows = [int(n) for n in args.metrics_rows.split(',') if n]
+    decode_rows = [int(n) for n in args.decode_rows.split(',') if n]
+    revision = git_revision()
+    results = run(sizes, metrics_rows, decode_rows, args.crypto_logs, args.repeat, args.seed, args.reference_max_rows)
+
+    output = args.output or os.path.join(REPO_ROOT, 'bench_results', f"{revision}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    meta = {
+        'revision': revision, 'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+        'machine': platform.machine(), 'repeat': args.repeat, 'seed': args.seed,
+        'reference_max_rows': args.reference_max_rows,
+    }
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({'meta': meta, 'results': results}, f, ensure_ascii=False, indent=2)
+    print(f"\n結果を保存しました: {output}")
+    if args.compare:
+        compare(results, args.compare)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
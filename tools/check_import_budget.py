@@ -0,0 +1,82 @@
+"""
+app.py の起動時（import 時）のコストが予算内かを確認する。
+
+新しいプロセスで `python -X importtime -c "import app"` を実行し、次の2点を検査する。
+  1. 遅延読み込みにしている重い依存（DEFERRED_MODULES）が、import 時に読み込まれていないこと
+  2. Streamlit・pandas・NumPy 自体の読み込みを除いた、app.py 固有の import 時間（複数回の中央値）が予算以内であること
+どちらかを満たさない場合は終了コード 1 で終わる。
+
+使い方（リポジトリのルートで）:
+    python tools/check_import_budget.py [--runs 5] [--budget-ms 50]
+"""
+import argparse
+import os
+import py_compile
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 画面や処理で必要になったときに初めて import する依存
+DEFERRED_MODULES = ['gspread', 'google.oauth2', 'google_auth_oauthlib', 'plotly.express', 'bcrypt', 'scipy']
+# アプリの実行に必ず必要な土台（import 時間の予算から除く）
+FRAMEWORK_MODULES = ['streamlit', 'pandas', 'numpy']
+# app.py 固有の import 時間の予算（ミリ秒）
+DEFAULT_BUDGET_MS = 50.0
+
+def measure_once() -> tuple:
+    """import app を1回計測し、(app 固有の時間[ms], 読み込まれたモジュール名の集合) を返す"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import app'],
+        cwd=REPO_ROOT, capture_output=True, text=True, check=True,
+    )
+    loaded = set()
+    app_total_us = 0
+    framework_us = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        loaded.add(name)
+        if name == 'app' and depth == 0:
+            app_total_us = int(cumulative)
+        elif depth == 1 and name.split('.')[0] in FRAMEWORK_MODULES:
+            framework_us += int(cumulative)
+    return (app_total_us - framework_us) / 1000.0, loaded
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS)
+    args = parser.parse_args()
+
+    # バイトコードのコンパイル時間は計測に含めない（コンテナのイメージには .pyc を含められるため）
+    py_compile.compile(os.path.join(REPO_ROOT, 'app.py'))
+    timings = []
+    loaded = set()
+    for _ in range(args.runs):
+        elapsed_ms, loaded_once = measure_once()
+        timings.append(elapsed_ms)
+        loaded |= loaded_once
+
+    failed = False
+    eager = [d for d in DEFERRED_MODULES if any(m == d or m.startswith(d + '.') for m in loaded)]
+    if eager:
+        print(f"NG: 遅延読み込みのはずの依存が import 時に読み込まれています: {', '.join(eager)}")
+        failed = True
+    median_ms = statistics.median(timings)
+    print(f"app.py 固有の import 時間: 中央値 {median_ms:.1f} ms（{args.runs} 回, 予算 {args.budget_ms:.0f} ms）")
+    if median_ms > args.budget_ms:
+        print("NG: import 時間が予算を超えています。")
+        failed = True
+    if not failed:
+        print("OK")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,182 @@
+"""
+calculate_metrics（行列単位の計算）が、行ごとに計算していた元の実装と同じ結果を返すかを確認する。
+
+合成データ（tools/synthetic_data.py）に、次のような境界の行を加えたテーブルで検査する。
+  - 価値観 q の合計が 0 の行、経験 s の合計が 0 の行（U は 0 になる）
+  - q や s が欠損している行、全ての値が欠損している行
+  - 詳細項目が1つも無い、または一部だけのディープ・ダイブの行
+検査するのは次の3点で、どれかが許容誤差を超えた場合は終了コード 1 で終わる。
+  1. 保存済みの指標を使わない計算（recompute_all=True）が、alpha ごとに元の実装と一致すること
+  2. 保存済みの指標がある行で alpha を変えた場合に、保存済みの S と U を再利用して H だけを計算し直し、
+     その結果が元の実装と（保存時の丸めの範囲で）一致すること
+  3. 計算式のバージョンが古い行は、保存済みの値を使わずに計算し直されること
+  4. 指標を保存した後に入力（経験 s）が編集された行も、保存済みの値を使わずに計算し直されること
+
+使い方（リポジトリのルートで。元の実装の計算に scipy を使うため、requirements-dev.txt の依存が必要）:
+    pip install -r requirements-dev.txt
+    python tools/check_metrics_parity.py [--users 5] [--days 120]
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic_data  # noqa: E402
+from synthetic_data import app  # noqa: E402
+
+# 検査する alpha（既定値と、スライダーで選べる別の値）
+ALPHAS = [app.DEFAULT_ALPHA, 0.3]
+# 保存済みの指標を使わない計算の許容誤差
+TOLERANCE = 1e-9
+# 保存済みの S, U を再利用する計算の許容誤差（保存時に STORED_METRIC_DECIMALS 桁に丸めるため）
+STORED_TOLERANCE = 10.0 ** -app.STORED_METRIC_DECIMALS
+
+def reference_s_domains_from_row(row: pd.Series) -> pd.Series:
+    """元の実装：1行の詳細項目からドメイン充足度を計算する"""
+    s_domain_scores = {}
+    for domain, elements in app.LONG_ELEMENTS.items():
+        domain_scores_list = []
+        for e in elements:
+            col = f's_element_{e}'
+            if col in row and pd.notna(row[col]):
+                domain_scores_list.append(row[col])
+        if domain_scores_list:
+            s_domain_scores['s_' + domain] = int(round(np.mean(domain_scores_list)))
+        else:
+            s_domain_scores['s_' + domain] = row.get('s_' + domain, np.nan)
+    return pd.Series(s_domain_scores)
+
+def reference_calculate_metrics(df: pd.DataFrame, alpha: float) -> pd.DataFrame:
+    """元の実装：行ごとに S_COLS・S・U・H を計算する"""
+    from scipy.spatial.distance import jensenshannon
+    df_copy = df.copy()
+    if df_copy.empty:
+        return df_copy
+
+    def get_s_domains_based_on_mode(row):
+        if row.get('mode') == 'deep':
+            return reference_s_domains_from_row(row)
+        return row[app.S_COLS]
+
+    df_copy[app.S_COLS] = df_copy.apply(get_s_domains_based_on_mode, axis=1)
+    for col in app.Q_COLS + app.S_COLS:
+        if col in df_copy.columns:
+            df_copy[col] = df_copy[col].fillna(0)
+
+    s_vectors_normalized = df_copy[app.S_COLS].values / 100.0
+    q_vectors = df_copy[app.Q_COLS].values / 100.0
+    df_copy['S'] = np.nansum(q_vectors * s_vectors_normalized, axis=1)
+
+    def calculate_unity(row):
+        q_vec = row[app.Q_COLS].values.astype(float)
+        s_vec_raw = row[app.S_COLS].values.astype(float)
+        if np.sum(q_vec) == 0:
+            return 0.0
+        q_vec_norm = q_vec / np.sum(q_vec)
+        if np.sum(s_vec_raw) == 0:
+            return 0.0
+        s_tilde = s_vec_raw / np.sum(s_vec_raw)
+        jsd_sqrt = jensenshannon(q_vec_norm, s_tilde)
+        return 1.0 - float(jsd_sqrt) ** 2
+
+    df_copy['U'] = df_copy.apply(calculate_unity, axis=1)
+    df_copy['H'] = alpha * df_copy['S'] + (1 - alpha) * df_copy['U']
+    return df_copy
+
+def edge_case_rows(df: pd.DataFrame) -> pd.DataFrame:
+    """合成データの先頭の行をもとに、境界の行を作る"""
+    base = df.iloc[[0]].drop(columns=app.METRIC_COLS + app.METRICS_META_COLS)
+    elements = {col: pd.NA for col in app.ALL_ELEMENT_COLS}
+
+    def variant(mode: str, **values) -> pd.DataFrame:
+        row = base.copy()
+        row['mode'] = mode
+        for col, value in {**elements, **values}.items():
+            row[col] = value
+        return row
+
+    deep_elements = {col: 40 + i for i, col in enumerate(app.ALL_ELEMENT_COLS)}
+    partial_elements = {col: 80 for col in app.ALL_ELEMENT_COLS[::3]}
+    rows = [
+        variant('quick', **{col: 0 for col in app.Q_COLS}),
+        variant('quick', **{col: 0 for col in app.S_COLS}),
+        variant('quick', **{col: 0 for col in app.Q_COLS + app.S_COLS}),
+        variant('quick', **{col: pd.NA for col in app.Q_COLS}),
+        variant('quick', **{col: pd.NA for col in app.S_COLS[:3]}),
+        variant('quick', **{col: pd.NA for col in app.Q_COLS + app.S_COLS}, g_happiness=pd.NA),
+        variant('deep', **deep_elements),
+        variant('deep', **partial_elements),
+        variant('deep'),
+        variant('deep', **{col: pd.NA for col in app.S_COLS}),
+        variant('deep', **deep_elements, **{col: 0 for col in app.Q_COLS}),
+    ]
+    return pd.concat(rows, ignore_index=True)
+
+def build_table(n_users: int, n_days: int) -> pd.DataFrame:
+    """保存済みの指標つきの合成データに、境界の行を指標つきで加える"""
+    df = synthetic_data.generate_data(n_users, n_days, seed=0, encrypt=False)
+    edges = app._with_stored_metrics('data', edge_case_rows(df), recompute_all=True)
+    return pd.concat([df, edges.reindex(columns=df.columns)], ignore_index=True)
+
+def max_difference(actual: pd.DataFrame, expected: pd.DataFrame, cols: list, rows=None) -> float:
+    a = actual[cols].to_numpy(dtype=np.float64, na_value=np.nan)
+    e = expected[cols].to_numpy(dtype=np.float64, na_value=np.nan)
+    if rows is not None:
+        a, e = a[rows], e[rows]
+    if (np.isnan(a) != np.isnan(e)).any():
+        return np.inf
+    return float(np.nanmax(np.abs(a - e), initial=0.0))
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=5)
+    parser.add_argument('--days', type=int, default=120)
+    args = parser.parse_args()
+
+    df_stored = build_table(args.users, args.days)
+    # 一部の行は、指標を保存した後に経験 s がシート上で直接編集された扱いにする（保存済みの指標はそのまま）
+    edited = np.zeros(len(df_stored), dtype=bool)
+    edited[3::11] = True
+    edited_col = app.S_COLS[0]
+    s_values = pd.to_numeric(df_stored[edited_col], errors='coerce').astype(np.float64)
+    df_stored[edited_col] = s_values.where(~edited, (s_values + 17) % 101)
+    df_raw = df_stored.drop(columns=app.METRIC_COLS + app.METRICS_META_COLS)
+    # 元の実装は、シートから読み込んだ float の列を前提にしている
+    score_cols = [c for c in app.NUMERIC_COLS if c in df_raw.columns]
+    df_reference_input = df_raw.copy()
+    df_reference_input[score_cols] = df_raw[score_cols].apply(pd.to_numeric, errors='coerce').astype(np.float64)
+    # 一部の行は、古い計算式のバージョンで保存された扱いにする
+    outdated = np.zeros(len(df_stored), dtype=bool)
+    outdated[::7] = True
+    df_stored.loc[outdated, 'metrics_version'] = app.METRICS_VERSION - 1
+    print(f"検査するテーブル: {len(df_stored)} 行（境界の行 {len(edge_case_rows(df_stored))} 行を含む）")
+
+    checks = []
+    for alpha in ALPHAS:
+        expected = reference_calculate_metrics(df_reference_input, alpha)
+        actual = app.calculate_metrics(df_raw, alpha=alpha, recompute_all=True)
+        checks.append((f"再計算 alpha={alpha} S_COLS/Q_COLS", max_difference(actual, expected, app.S_COLS + app.Q_COLS), TOLERANCE))
+        for col in app.METRIC_COLS:
+            checks.append((f"再計算 alpha={alpha} {col}", max_difference(actual, expected, [col]), TOLERANCE))
+
+        # 保存済みの指標（保存時の alpha は DEFAULT_ALPHA）を、別の alpha で読み直す
+        actual = app.calculate_metrics(df_stored, alpha=alpha)
+        reused = ~outdated & ~edited
+        checks.append((f"保存済み alpha={alpha} H", max_difference(actual, expected, ['H']), STORED_TOLERANCE))
+        checks.append((f"保存済み alpha={alpha} S/U の再利用", max_difference(actual, df_stored, ['S', 'U'], reused), 0.0))
+        checks.append((f"保存済み alpha={alpha} 古いバージョンの行 S/U/H", max_difference(actual, expected, app.METRIC_COLS, outdated), TOLERANCE))
+        checks.append((f"保存済み alpha={alpha} 入力を編集した行 S/U/H", max_difference(actual, expected, app.METRIC_COLS, edited), TOLERANCE))
+
+    failed = False
+    for name, difference, tolerance in checks:
+        ok = difference <= tolerance
+        failed |= not ok
+        print(f"{'OK' if ok else 'NG'}  {name:<44} 最大誤差 {difference:.3g}（許容 {tolerance:.0e}）")
+    print("NG: 元の実装と一致しない値があります。" if failed else "OK")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+"""
+ベンチマーク用の合成データ生成。
+
+N 人 × M 日分の記録を、write_data が data テーブルに保存するのと同じスキーマ
+（_get_db_schema_cols('data') の列順、保存用の派生指標つき）で作る。
+実際の記録に近づけるため、次のような偏りや欠損を持たせる。
+  - 記録しない日がある（続けて記録する日と、数日まとめて休む期間がある）
+  - クイック・ログとディープ・ダイブの割合がユーザーごとに異なる
+    （クイックの行は詳細項目が欠損、ディープの行は詳細項目から S を計算）
+  - 価値観 q はユーザーごとに異なり、ときどき見直される（合計は常に 100）
+  - 経験 S は各ユーザーの水準のまわりを日ごとに揺れ、ごく一部の行は実感値 G が欠損
+  - イベントログは空の日があり、書いた日はユーザーのパスワードで暗号化して保存
+"""
+import os
+import sys
+from datetime import datetime, date, timedelta
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+# イベントログに使う語句
+LOG_PHRASES = ['散歩した', '友人とランチ', '仕事が忙しい', '残業', '家族と夕食', '読書', 'ジムで運動', '会議が長い',
+               '映画を観た', '雨', 'よく眠れた', '寝不足', 'カフェで作業', '旅行の計画', '掃除', 'ヨガ', '締め切り', '料理']
+
+def user_password(user_id: str) -> str:
+    """合成ユーザーのパスワード（イベントログの暗号化に使う）"""
+    return f"pw-{user_id}"
+
+def _integer_weights(rng: np.random.Generator, concentration: float) -> np.ndarray:
+    """合計が 100 になる整数の価値観 q を作る（最大剰余法で丸める）"""
+    raw = rng.dirichlet(np.full(len(app.DOMAINS), concentration)) * 100
+    q = np.floor(raw).astype(int)
+    q[np.argsort(raw - q)[::-1][:100 - q.sum()]] += 1
+    return q
+
+def _recorded_days(rng: np.random.Generator, n_days: int) -> np.ndarray:
+    """記録した日の位置。記録中は 8% の確率で休み始め、休み中は 50% の確率で再開する"""
+    recorded = np.empty(n_days, dtype=bool)
+    state = True
+    for i in range(n_days):
+        recorded[i] = state
+        state = rng.random() >= 0.08 if state else rng.random() < 0.5
+    recorded[-1] = True
+    return np.flatnonzero(recorded)
+
+def generate_user_records(rng: np.random.Generator, user_id: str, n_days: int, end_date: date, encrypt: bool = True) -> pd.DataFrame:
+    """1人分の記録（保存前の形）を作る"""
+    day_offsets = _recorded_days(rng, n_days)
+    n = len(day_offsets)
+    dates = [end_date - timedelta(days=n_days - 1 - int(i)) for i in day_offsets]
+
+    deep_ratio = rng.uniform(0.1, 0.4)
+    is_deep = rng.random(n) < deep_ratio
+
+    # 価値観は平均 90 日ごとに見直す
+    q = _integer_weights(rng, 2.0)
+    q_rows = np.empty((n, len(app.DOMAINS)), dtype=int)
+    for i in range(n):
+        if rng.random() < 1 / 90:
+            q = _integer_weights(rng, 2.0)
+        q_rows[i] = q
+
+    # 経験はユーザーごとの水準のまわりを AR(1) で揺れる
+    level = rng.uniform(35, 80, len(app.DOMAINS))
+    noise = np.empty((n, len(app.DOMAINS)))
+    noise[0] = rng.normal(0, 12, len(app.DOMAINS))
+    for i in range(1, n):
+        noise[i] = 0.6 * noise[i - 1] + rng.normal(0, 10, len(app.DOMAINS))
+    s_values = np.clip(np.rint(level + noise), 0, 100)
+
+    records = pd.DataFrame({
+        'user_id': user_id,
+        'date': dates,
+        'record_timestamp': [app.JST.localize(datetime.combine(d, datetime.min.time()) + timedelta(hours=21, minutes=int(m)))
+                             for d, m in zip(dates, rng.integers(0, 180, n))],
+        'consent': bool(rng.random() < 0.7),
+        'mode': np.where(is_deep, 'deep', 'quick'),
+    })
+    records[app.Q_COLS] = q_rows
+    records[app.S_COLS] = s_values.astype(int)
+
+    # ディープ・ダイブの行は、ドメインの値のまわりに詳細項目を散らし、そこから S を計算し直す
+    element_domains = [app._ELEMENT_DOMAIN[col] for col in app.ALL_ELEMENT_COLS]
+    domain_index = np.array([app.DOMAINS.index(d) for d in element_domains])
+    elements = np.clip(np.rint(s_values[:, domain_index] + rng.normal(0, 12, (n, len(domain_index)))), 0, 100)
+    element_frame = pd.DataFrame(np.where(is_deep[:, None], elements, np.nan), columns=app.ALL_ELEMENT_COLS).astype('Int64')
+    records = pd.concat([records, element_frame], axis=1)
+    if is_deep.any():
+        records.loc[is_deep, app.S_COLS] = app.calculate_s_domains(records.loc[is_deep]).astype(int).to_numpy()
+
+    weighted_s = (records[app.S_COLS].to_numpy(dtype=np.float64) * q_rows).sum(axis=1) / 100
+    g_happiness = np.clip(np.rint(weighted_s + rng.normal(-5, 12, n)), 0, 100)
+    records['g_happiness'] = pd.array(np.where(rng.random(n) < 0.02, np.nan, g_happiness), dtype='Int64')
+
+    logs = ['' if rng.random() < 0.35 else '、'.join(rng.choice(LOG_PHRASES, int(rng.integers(1, 5)), replace=False)) for _ in range(n)]
+    records['event_log'] = app.EncryptionManager(user_password(user_id)).encrypt_logs(logs) if encrypt else logs
+    return records
+
+def generate_data(n_users: int, n_days: int, seed: int = 0, end_date: date = None, encrypt: bool = True) -> pd.DataFrame:
+    """
+    n_users 人 × 最大 n_days 日の data テーブルを、write_data が保存するのと同じ列・派生指標つきで返す。
+    同じ seed からは同じデータができる。
+    """
+    rng = np.random.default_rng(seed)
+    end_date = end_date or date.today()
+    frames = [generate_user_records(rng, f"user_{rng.bytes(6).hex()}", n_days, end_date, encrypt) for _ in range(n_users)]
+    df = pd.concat(frames, ignore_index=True)
+    df = app._with_stored_metrics('data', df, recompute_all=True)
+    return df.reindex(columns=app._get_db_schema_cols('data'))